@@ -1,5 +1,7 @@
 import numpy as np
 
+from gym_art.quadrotor_multi.sensor_noise import add_noise_batch
+
 ## NOTE: the state_* methods are static because otherwise getattr memorizes self
 
 def state_xyz_vxyz_R_omega(self):
@@ -482,4 +484,161 @@ def state_xyz_xyzi_vxyz_R_omega_t2w(self):
     ## prevent the accumulative error from exploding at the beginning of the training
     self.accumulative_pos_err = np.clip(self.accumulative_pos_err, a_min=-self.room_size, a_max=self.room_size)
 
-    return np.concatenate([pos_err, self.accumulative_pos_err, vel, rot.flatten(), omega, noisy_t2w])
\ No newline at end of file
+    return np.concatenate([pos_err, self.accumulative_pos_err, vel, rot.flatten(), omega, noisy_t2w])
+
+## Batched state functions: compute the state of the whole swarm in one call from the arrays of a SwarmState
+## (see quad_swarm_state.py). Each one mirrors the state_* function of the same obs_repr. sense_noises holds the
+## SensorNoise of every drone, see add_noise_batch.
+
+BATCHED_STATE_FUNCS = dict()
+
+
+def batched_state(obs_repr):
+    def register(func):
+        BATCHED_STATE_FUNCS[obs_repr] = func
+        return func
+    return register
+
+
+def get_batched_state_func(obs_repr):
+    """Returns None if there is no batched version for this obs_repr, the per-drone state_* is used then."""
+    return BATCHED_STATE_FUNCS.get(obs_repr, None)
+
+
+class StateHistory:
+    """Ring buffer with the last `length` values of a per-drone quantity."""
+    def __init__(self, length, num_agents, dim):
+        self.length = length
+        self.buffer = np.zeros((length, num_agents, dim))
+        self.head = 0
+
+    def reset(self, value):
+        self.buffer.fill(0.0)
+        self.head = 0
+        self.buffer[0] = value
+
+    def push(self, value):
+        self.head = (self.head - 1) % self.length
+        self.buffer[self.head] = value
+
+    def get(self):
+        """Shape (num_agents, length * dim), the newest value first."""
+        idx = (self.head + np.arange(self.length)) % self.length
+        hist = self.buffer[idx]
+        return hist.transpose(1, 0, 2).reshape(hist.shape[1], -1)
+
+
+def update_history(swarm, name, length, value):
+    hist = swarm.history.get(name, None)
+    if hist is None or hist.buffer.shape != (length,) + value.shape:
+        hist = StateHistory(length, *value.shape)
+        swarm.history[name] = hist
+
+    if swarm.tick == 0:
+        hist.reset(value)
+    else:
+        hist.push(value)
+    return hist.get()
+
+
+def noisy_swarm_state(swarm, sense_noises, dt):
+    return add_noise_batch(
+        sense_noises, pos=swarm.pos, vel=swarm.vel, rot=swarm.rot, omega=swarm.omega, acc=swarm.acc, dt=dt
+    )
+
+
+def to_body_frame(swarm, vec):
+    # rot.T @ vec for every drone
+    return np.einsum('nji,nj->ni', swarm.rot, vec)
+
+
+@batched_state('xyz_vxyz_R_omega')
+def batched_state_xyz_vxyz_R_omega(swarm, sense_noises, dt):
+    pos, vel, rot, omega, acc = noisy_swarm_state(swarm, sense_noises, dt)
+    return np.concatenate([pos - swarm.goal, vel, rot.reshape(-1, 9), omega], axis=1)
+
+
+@batched_state('xyz_vxyz_R_omega_wall')
+def batched_state_xyz_vxyz_R_omega_wall(swarm, sense_noises, dt):
+    pos, vel, rot, omega, acc = noisy_swarm_state(swarm, sense_noises, dt)
+    wall_box_0 = np.clip(pos - swarm.room_box[0], a_min=0.0, a_max=5.0)
+    wall_box_1 = np.clip(swarm.room_box[1] - pos, a_min=0.0, a_max=5.0)
+    return np.concatenate([pos - swarm.goal, vel, rot.reshape(-1, 9), omega, wall_box_0, wall_box_1], axis=1)
+
+
+@batched_state('xyz_vxyz_R_omega_h')
+def batched_state_xyz_vxyz_R_omega_h(swarm, sense_noises, dt):
+    pos, vel, rot, omega, acc = noisy_swarm_state(swarm, sense_noises, dt)
+    return np.concatenate([pos - swarm.goal, vel, rot.reshape(-1, 9), omega, pos[:, 2:3]], axis=1)
+
+
+@batched_state('xyzr_vxyzr_R_omega')
+def batched_state_xyzr_vxyzr_R_omega(swarm, sense_noises, dt):
+    pos, vel, rot, omega, acc = noisy_swarm_state(swarm, sense_noises, dt)
+    e_xyz_rel = to_body_frame(swarm, pos - swarm.goal)
+    vel_rel = to_body_frame(swarm, vel)
+    return np.concatenate([e_xyz_rel, vel_rel, rot.reshape(-1, 9), omega], axis=1)
+
+
+@batched_state('xyzr_vxyzr_R_omega_h')
+def batched_state_xyzr_vxyzr_R_omega_h(swarm, sense_noises, dt):
+    pos, vel, rot, omega, acc = noisy_swarm_state(swarm, sense_noises, dt)
+    e_xyz_rel = to_body_frame(swarm, pos - swarm.goal)
+    vel_rel = to_body_frame(swarm, vel)
+    return np.concatenate([e_xyz_rel, vel_rel, rot.reshape(-1, 9), omega, pos[:, 2:3]], axis=1)
+
+
+@batched_state('xyz_vxyz_R_omega_acc_act')
+def batched_state_xyz_vxyz_R_omega_acc_act(swarm, sense_noises, dt):
+    pos, vel, rot, omega, acc = noisy_swarm_state(swarm, sense_noises, dt)
+    return np.concatenate([pos - swarm.goal, vel, rot.reshape(-1, 9), omega, acc, swarm.actions[1]], axis=1)
+
+
+@batched_state('xyz_vxyz_R_omega_act')
+def batched_state_xyz_vxyz_R_omega_act(swarm, sense_noises, dt):
+    pos, vel, rot, omega, acc = noisy_swarm_state(swarm, sense_noises, dt)
+    return np.concatenate([pos - swarm.goal, vel, rot.reshape(-1, 9), omega, swarm.actions[1]], axis=1)
+
+
+@batched_state('act_tx2_xyz_vxyz_R_omega')
+def batched_state_act_tx2_xyz_vxyz_R_omega(swarm, sense_noises, dt):
+    pos, vel, rot, omega, acc = noisy_swarm_state(swarm, sense_noises, dt)
+    return np.concatenate(
+        [pos - swarm.goal, vel, rot.reshape(-1, 9), omega, swarm.actions[0], swarm.actions[1]], axis=1
+    )
+
+
+@batched_state('xyz_vxyz_tx3_R_omega')
+def batched_state_xyz_vxyz_tx3_R_omega(swarm, sense_noises, dt):
+    pos, vel, rot, omega, acc = noisy_swarm_state(swarm, sense_noises, dt)
+    pos_3 = update_history(swarm, 'pos_rel', 3, pos - swarm.goal)
+    vel_3 = update_history(swarm, 'vel', 3, vel)
+    return np.concatenate([pos_3, vel_3, rot.reshape(-1, 9), omega], axis=1)
+
+
+@batched_state('vxyz_tx3_xyz_R_omega')
+def batched_state_vxyz_tx3_xyz_R_omega(swarm, sense_noises, dt):
+    pos, vel, rot, omega, acc = noisy_swarm_state(swarm, sense_noises, dt)
+    vel_3 = update_history(swarm, 'vel', 3, vel)
+    return np.concatenate([pos - swarm.goal, vel_3, rot.reshape(-1, 9), omega], axis=1)
+
+
+@batched_state('xyz_tx3_vxyz_R_omega')
+def batched_state_xyz_tx3_vxyz_R_omega(swarm, sense_noises, dt):
+    pos, vel, rot, omega, acc = noisy_swarm_state(swarm, sense_noises, dt)
+    pos_3 = update_history(swarm, 'pos_rel', 3, pos - swarm.goal)
+    return np.concatenate([pos_3, vel, rot.reshape(-1, 9), omega], axis=1)
+
+
+@batched_state('xyz_tx2_vxyz_R_omega')
+def batched_state_xyz_tx2_vxyz_R_omega(swarm, sense_noises, dt):
+    pos, vel, rot, omega, acc = noisy_swarm_state(swarm, sense_noises, dt)
+    pos_2 = update_history(swarm, 'pos_rel', 2, pos - swarm.goal)
+    return np.concatenate([pos_2, vel, rot.reshape(-1, 9), omega], axis=1)
+
+
+@batched_state('vxyz_tx2_xyz_R_omega')
+def batched_state_vxyz_tx2_xyz_R_omega(swarm, sense_noises, dt):
+    pos, vel, rot, omega, acc = noisy_swarm_state(swarm, sense_noises, dt)
+    vel_2 = update_history(swarm, 'vel', 2, vel)
+    return np.concatenate([pos - swarm.goal, vel_2, rot.reshape(-1, 9), omega], axis=1)
@@ -0,0 +1,103 @@
+import os
+
+import numpy as np
+
+# kinds of collision events
+EVENT_DRONE, EVENT_OBSTACLE, EVENT_FLOOR = 0, 1, 2
+
+# one fixed-size record per collision. id2 is the other drone (EVENT_DRONE), the obstacle (EVENT_OBSTACLE) or -1,
+# pos2 the other drone / obstacle position, zeros for the floor
+COLLISION_EVENT_DTYPE = np.dtype([
+    ('episode', np.int64), ('tick', np.int32), ('kind', np.int32), ('id1', np.int32), ('id2', np.int32),
+    ('pos1', np.float32, 3), ('pos2', np.float32, 3), ('rel_speed', np.float32),
+])
+
+_MAGIC = b'QCOLLOG1'
+# magic, number of records
+_HEADER_SIZE = 16
+
+
+class CollisionEventLog:
+    """
+    Appends collision events as binary records to a memory-mapped file. The file grows in chunks when full, writing
+    a batch of events is a single slice assignment. Load the records with read_collision_log.
+    """
+    def __init__(self, path, capacity=1 << 16):
+        self.path = path
+        self.capacity = 0
+        self.count = 0
+        self.episode = 0
+
+        with open(self.path, 'wb') as f:
+            f.write(_MAGIC + np.int64(0).tobytes())
+        self.header = None
+        self.records = None
+        self._grow(capacity)
+
+    def __deepcopy__(self, memo):
+        # env copies (e.g. replay buffer checkpoints) keep writing to the same file
+        return self
+
+    def _grow(self, capacity):
+        self.records = None
+        with open(self.path, 'r+b') as f:
+            f.truncate(_HEADER_SIZE + capacity * COLLISION_EVENT_DTYPE.itemsize)
+        self.capacity = capacity
+        self.header = np.memmap(self.path, dtype=np.int64, mode='r+', offset=len(_MAGIC), shape=(1,))
+        self.records = np.memmap(self.path, dtype=COLLISION_EVENT_DTYPE, mode='r+', offset=_HEADER_SIZE,
+                                 shape=(capacity,))
+
+    def new_episode(self):
+        self.episode += 1
+
+    def log(self, tick, kind, id1, id2, pos1, pos2, rel_speed):
+        """Append len(id1) events of the same kind, the arguments are arrays with one entry per event."""
+        num_events = len(id1)
+        if num_events == 0:
+            return
+
+        if self.count + num_events > self.capacity:
+            self._grow(max(2 * self.capacity, self.count + num_events))
+
+        events = self.records[self.count:self.count + num_events]
+        events['episode'] = self.episode
+        events['tick'] = tick
+        events['kind'] = kind
+        events['id1'] = id1
+        events['id2'] = id2
+        events['pos1'] = pos1
+        events['pos2'] = pos2
+        events['rel_speed'] = rel_speed
+
+        self.count += num_events
+        self.header[0] = self.count
+
+    def flush(self):
+        if self.records is not None:
+            self.records.flush()
+            self.header.flush()
+
+    def close(self):
+        self.flush()
+        self.records = self.header = None
+
+
+def make_collision_log_path(log_dir):
+    """One file per env instance, several envs in the same worker process get different files."""
+    os.makedirs(log_dir, exist_ok=True)
+    make_collision_log_path.counter += 1
+    return os.path.join(log_dir, f'collisions_{os.getpid()}_{make_collision_log_path.counter}.bin')
+
+
+make_collision_log_path.counter = 0
+
+
+def read_collision_log(path):
+    """:return: structured array of COLLISION_EVENT_DTYPE with the records written so far"""
+    with open(path, 'rb') as f:
+        header = f.read(_HEADER_SIZE)
+    if header[:len(_MAGIC)] != _MAGIC:
+        raise ValueError(f'{path} is not a collision log')
+
+    count = int(np.frombuffer(header[len(_MAGIC):], dtype=np.int64)[0])
+    return np.array(np.memmap(path, dtype=COLLISION_EVENT_DTYPE, mode='r', offset=_HEADER_SIZE, shape=(count,)))
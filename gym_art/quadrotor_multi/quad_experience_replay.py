@@ -1,16 +1,48 @@
 import random
-from collections import deque
-from copy import deepcopy
 
 import gym
 import numpy as np
 
 
-class ReplayBufferEvent:
-    def __init__(self, env, obs):
-        self.env = env
-        self.obs = obs
-        self.num_replayed = 0
+class SnapshotArray:
+    """
+    Env snapshots (see QuadrotorEnvMulti.get_state) and their observations in contiguous arrays of a fixed number of
+    slots, allocated by the first save. Only the scenario part of a snapshot is kept as a Python object.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.states = None
+        self.obs = None
+        self.episode_states = [None] * capacity
+
+    def allocate(self, state_size, obs):
+        self.states = np.zeros((self.capacity, state_size))
+        self.obs = np.zeros((self.capacity,) + np.shape(obs), dtype=np.asarray(obs).dtype)
+
+    def save(self, idx, env, obs):
+        if self.states is None:
+            self.allocate(env.state_size(), obs)
+        _, self.episode_states[idx] = env.get_state(out=self.states[idx])
+        self.obs[idx] = obs
+
+    def copy_from(self, idx, other, other_idx):
+        if self.states is None:
+            self.allocate(other.states.shape[1], other.obs[other_idx])
+        self.states[idx] = other.states[other_idx]
+        self.obs[idx] = other.obs[other_idx]
+        self.episode_states[idx] = other.episode_states[other_idx]
+
+    def move(self, idx, other_idx):
+        self.copy_from(idx, self, other_idx)
+        self.episode_states[other_idx] = None
+
+    def restore(self, idx, env):
+        """:return: the observations of the snapshot"""
+        env.set_state(self.states[idx], self.episode_states[idx])
+        return self.obs[idx].copy()
+
+    def nbytes(self):
+        return 0 if self.states is None else self.states.nbytes + self.obs.nbytes
 
 
 class ReplayBuffer:
@@ -19,48 +51,57 @@ class ReplayBuffer:
         self.cp_step_size_sec = cp_step_size  # how often (seconds) a checkpoint is saved
         self.cp_step_size_freq = self.cp_step_size_sec * self.control_frequency
         self.buffer_idx = 0
-        self.buffer = deque([], maxlen=buffer_size)
+        self.buffer_size = buffer_size
+        # events are kept in slots 0..num_events-1
+        self.events = SnapshotArray(buffer_size)
+        self.num_replayed = np.zeros(buffer_size, dtype=np.int64)
+        self.num_events = 0
 
-    def write_cp_to_buffer(self, env, obs):
+    def write_cp_to_buffer(self, checkpoints, idx):
         """
         A collision was found and we want to load the corresponding checkpoint from X seconds ago into the buffer to be sampled later on
+        :param checkpoints: SnapshotArray with the checkpoints of the episode, idx is the slot of the checkpoint
         """
-        env.saved_in_replay_buffer = True
-
         # For example, replace the item with the lowest number of collisions in the last 10 replays
-        evt = ReplayBufferEvent(env, obs)
-        if len(self.buffer) < self.buffer.maxlen:
-            self.buffer.append(evt)
+        if self.num_events < self.buffer_size:
+            event_idx = self.num_events
+            self.num_events += 1
         else:
-            self.buffer[self.buffer_idx] = evt
-        print(f"Added new collision event to buffer at {self.buffer_idx}")
-        self.buffer_idx = (self.buffer_idx + 1) % self.buffer.maxlen
+            event_idx = self.buffer_idx
+        self.events.copy_from(event_idx, checkpoints, idx)
+        self.num_replayed[event_idx] = 0
+        self.buffer_idx = (self.buffer_idx + 1) % self.buffer_size
 
     def sample_event(self):
         """
         Sample an event to replay
+        :return: slot of the event in self.events
         """
-        idx = random.randint(0, len(self.buffer) - 1)
-        print(f'Replaying event at idx {idx}')
-        self.buffer[idx].num_replayed += 1
-        return self.buffer[idx]
+        idx = random.randint(0, self.num_events - 1)
+        self.num_replayed[idx] += 1
+        return idx
 
     def cleanup(self):
-        new_buffer = deque([], maxlen=self.buffer.maxlen)
-        for event in self.buffer:
-            if event.num_replayed < 10:
-                new_buffer.append(event)
-
-        self.buffer = new_buffer
+        # drop the events replayed 10 times, the last event takes the slot of a dropped one
+        idx = 0
+        while idx < self.num_events:
+            if self.num_replayed[idx] >= 10:
+                self.num_events -= 1
+                self.events.move(idx, self.num_events)
+                self.num_replayed[idx] = self.num_replayed[self.num_events]
+            else:
+                idx += 1
 
     def avg_num_replayed(self):
-        replayed_stats = [e.num_replayed for e in self.buffer]
-        if not replayed_stats:
+        if self.num_events == 0:
             return 0
-        return np.mean(replayed_stats)
+        return np.mean(self.num_replayed[:self.num_events])
+
+    def nbytes(self):
+        return self.events.nbytes() + self.num_replayed.nbytes
 
     def __len__(self):
-        return len(self.buffer)
+        return self.num_events
 
 
 class ExperienceReplayWrapper(gym.Wrapper):
@@ -70,7 +111,9 @@ class ExperienceReplayWrapper(gym.Wrapper):
         self.replay_buffer_sample_prob = replay_buffer_sample_prob
 
         self.max_episode_checkpoints_to_keep = int(3.0 / self.replay_buffer.cp_step_size_sec)  # keep only checkpoints from the last 3 seconds
-        self.episode_checkpoints = deque([], maxlen=self.max_episode_checkpoints_to_keep)
+        # ring buffer, the checkpoint number k of the episode is in slot k % max_episode_checkpoints_to_keep
+        self.episode_checkpoints = SnapshotArray(self.max_episode_checkpoints_to_keep)
+        self.num_episode_checkpoints = 0
 
         self.save_time_before_collision_sec = 1.5
         self.last_tick_added_to_buffer = -1e9
@@ -84,7 +127,9 @@ class ExperienceReplayWrapper(gym.Wrapper):
         Save a checkpoint every X steps so that we may load it later if a collision was found. This is NOT the same as the buffer
         Checkpoints are added to the buffer only if we find a collision and want to replay that event later on
         """
-        self.episode_checkpoints.append((deepcopy(self.env), deepcopy(obs)))
+        idx = self.num_episode_checkpoints % self.max_episode_checkpoints_to_keep
+        self.episode_checkpoints.save(idx, self.env, obs)
+        self.num_episode_checkpoints += 1
 
     def reset(self):
         """For reset we just use the default implementation."""
@@ -105,6 +150,7 @@ class ExperienceReplayWrapper(gym.Wrapper):
                     f"{tag}/new_episode_rate": (self.episode_counter - self.replayed_events) / self.episode_counter,
                     f"{tag}/replay_buffer_size": len(self.replay_buffer),
                     f"{tag}/avg_replayed": self.replay_buffer.avg_num_replayed(),
+                    f"{tag}/memory_mb": (self.replay_buffer.nbytes() + self.episode_checkpoints.nbytes()) / 2 ** 20,
                 })
 
         else:
@@ -112,19 +158,20 @@ class ExperienceReplayWrapper(gym.Wrapper):
                     and self.env.envs[0].tick % self.replay_buffer.cp_step_size_freq == 0:
                 self.save_checkpoint(obs)
 
-            if self.env.last_step_unique_collisions.any() and self.env.use_replay_buffer and self.env.activate_replay_buffer \
+            if len(self.env.last_step_unique_collisions) > 0 and self.env.use_replay_buffer and self.env.activate_replay_buffer \
                     and self.env.envs[0].tick > self.env.collisions_grace_period_seconds * self.env.envs[0].control_freq and not self.saved_in_replay_buffer:
 
                 if self.env.envs[0].tick - self.last_tick_added_to_buffer > 5 * self.env.envs[0].control_freq:
                     # added this check to avoid adding a lot of collisions from the same episode to the buffer
 
                     steps_ago = int(self.save_time_before_collision_sec / self.replay_buffer.cp_step_size_sec)
-                    if steps_ago > len(self.episode_checkpoints):
-                        print(f"Tried to read past the boundary of checkpoint_history. Steps ago: {steps_ago}, episode checkpoints: {len(self.episode_checkpoints)}, {self.env.envs[0].tick}")
+                    num_checkpoints = min(self.num_episode_checkpoints, self.max_episode_checkpoints_to_keep)
+                    if steps_ago > num_checkpoints:
+                        print(f"Tried to read past the boundary of checkpoint_history. Steps ago: {steps_ago}, episode checkpoints: {num_checkpoints}, {self.env.envs[0].tick}")
                         raise IndexError
                     else:
-                        env, obs = self.episode_checkpoints[-steps_ago]
-                        self.replay_buffer.write_cp_to_buffer(env, obs)
+                        idx = (self.num_episode_checkpoints - steps_ago) % self.max_episode_checkpoints_to_keep
+                        self.replay_buffer.write_cp_to_buffer(self.episode_checkpoints, idx)
                         self.env.collision_occurred = False  # this allows us to add a copy of this episode to the buffer once again if another collision happens
 
                         self.last_tick_added_to_buffer = self.env.envs[0].tick
@@ -138,20 +185,17 @@ class ExperienceReplayWrapper(gym.Wrapper):
         """
         self.episode_counter += 1
         self.last_tick_added_to_buffer = -1e9
-        self.episode_checkpoints = deque([], maxlen=self.max_episode_checkpoints_to_keep)
+        self.num_episode_checkpoints = 0
 
         if np.random.uniform(0, 1) < self.replay_buffer_sample_prob and self.replay_buffer and self.env.activate_replay_buffer \
                 and len(self.replay_buffer) > 0:
             self.replayed_events += 1
-            event = self.replay_buffer.sample_event()
-            env = event.env
-            obs = event.obs
-            replayed_env = deepcopy(env)
-            replayed_env.scene = self.env.scene
+            idx = self.replay_buffer.sample_event()
+            obs = self.replay_buffer.events.restore(idx, self.env)
+            self.env.saved_in_replay_buffer = True
 
             # we want to use these for tensorboard, so reset them to zero to get accurate stats
-            replayed_env.collisions_per_episode = replayed_env.collisions_after_settle = 0
-            self.env = replayed_env
+            self.env.collisions_per_episode = self.env.collisions_after_settle = 0
 
             self.replay_buffer.cleanup()
 
@@ -0,0 +1,96 @@
+from collections import namedtuple
+
+import numpy as np
+
+# size of the drone's own observation for each obs_repr
+OBS_SELF_DIMS = {
+    'xyz_vxyz_R_omega': 18,
+    'xyz_vxyz_R_omega_wall': 24,
+}
+
+# size of the observation of a single neighbor for each neighbor_obs_type (aka swarm_obs)
+OBS_NEIGHBOR_DIMS = {
+    'none': 0,
+    'pos_vel': 6,
+    'pos_vel_goals': 9,
+    'pos_vel_goals_ndist_gdist': 11,
+}
+
+# rel_pos (3), rel_vel (3), size (3), type (1)
+OBS_OBSTACLE_DIM = 10
+
+ObsComponent = namedtuple('ObsComponent', ['name', 'offset', 'shape', 'dtype'])
+
+
+def get_self_obs_dim(obs_repr):
+    if obs_repr not in OBS_SELF_DIMS:
+        raise NotImplementedError(f'{obs_repr} not supported!')
+    return OBS_SELF_DIMS[obs_repr]
+
+
+def get_neighbor_obs_dim(neighbor_obs_type):
+    if neighbor_obs_type not in OBS_NEIGHBOR_DIMS:
+        raise NotImplementedError(f'Unknown value {neighbor_obs_type} passed to --neighbor_obs_type')
+    return OBS_NEIGHBOR_DIMS[neighbor_obs_type]
+
+
+def make_obs_layout(obs_repr, neighbor_obs_type, num_use_neighbor_obs, num_obstacle_obs, obstacle_obs_mask=False,
+                    dtype=np.float32):
+    """
+    Describe where each component lives in the flat per-drone observation.
+    :param obstacle_obs_mask: obstacle observations are followed by a validity mask, one value per obstacle slot
+    (used when only the nearest obstacles are observed).
+    :return: dict name -> ObsComponent(name, offset, shape, dtype), ordered by offset. Components that are
+    absent from the observation (no neighbors, no obstacles) are not listed.
+    """
+    dtype = np.dtype(dtype)
+    layout = dict()
+    offset = 0
+
+    self_dim = get_self_obs_dim(obs_repr)
+    layout['self'] = ObsComponent('self', offset, (self_dim,), dtype)
+    offset += self_dim
+
+    neighbor_dim = get_neighbor_obs_dim(neighbor_obs_type)
+    if neighbor_dim > 0 and num_use_neighbor_obs > 0:
+        layout['neighbors'] = ObsComponent('neighbors', offset, (num_use_neighbor_obs, neighbor_dim), dtype)
+        offset += num_use_neighbor_obs * neighbor_dim
+
+    if num_obstacle_obs > 0:
+        layout['obstacles'] = ObsComponent('obstacles', offset, (num_obstacle_obs, OBS_OBSTACLE_DIM), dtype)
+        offset += num_obstacle_obs * OBS_OBSTACLE_DIM
+        if obstacle_obs_mask:
+            layout['obstacles_mask'] = ObsComponent('obstacles_mask', offset, (num_obstacle_obs,), dtype)
+
+    return layout
+
+
+def obs_layout_size(layout):
+    return sum(int(np.prod(comp.shape)) for comp in layout.values())
+
+
+def obs_component_view(obs, component):
+    """
+    Zero-copy view of one component in a batch of flat observations, i.e. (batch, obs_size) -> (batch, *shape).
+    Works with both numpy arrays and torch tensors.
+    """
+    obs = obs[:, component.offset:]
+    shape = (obs.shape[0],) + tuple(component.shape)
+
+    # row-major strides of the component in units of one observation element
+    elem_strides = []
+    acc = 1
+    for dim in reversed(component.shape):
+        elem_strides.append(acc)
+        acc *= dim
+    elem_strides = tuple(reversed(elem_strides))
+
+    if isinstance(obs, np.ndarray):
+        row_stride, col_stride = obs.strides
+        strides = (row_stride,) + tuple(s * col_stride for s in elem_strides)
+        return np.lib.stride_tricks.as_strided(obs, shape=shape, strides=strides)
+
+    # torch.Tensor, strides are in elements
+    row_stride, col_stride = obs.stride()
+    strides = (row_stride,) + tuple(s * col_stride for s in elem_strides)
+    return obs.as_strided(shape, strides, obs.storage_offset())
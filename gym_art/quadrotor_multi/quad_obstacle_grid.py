@@ -0,0 +1,67 @@
+import numpy as np
+
+
+class ObstacleGrid:
+    """
+    Uniform grid over a static obstacle layout, baked once per layout. Every cell lists the obstacles within reach of
+    some point of the cell, so a drone only tests the obstacles of its cell: one lookup per drone, then exact distances
+    to the few obstacles nearby, with the same result as testing all of them.
+    """
+    def __init__(self):
+        self.cell_size = 1.0
+        self.origin = np.zeros(3)
+        self.grid_shape = np.zeros(3, dtype=np.int64)
+        # (num_cells, max obstacles in a cell) obstacle ids, padded with -1
+        self.cells = np.full((0, 0), -1, dtype=np.int64)
+
+    def bake(self, ids, pos, reach):
+        """
+        :param ids: (M,) obstacle ids, in increasing order
+        :param pos: (M, 3) obstacle centers
+        :param reach: (M,) distance from the center beyond which a point is out of reach of the obstacle
+        """
+        if len(ids) == 0:
+            self.grid_shape = np.zeros(3, dtype=np.int64)
+            self.cells = np.full((0, 0), -1, dtype=np.int64)
+            return
+
+        # cells twice as wide as the largest reach, the reach box of an obstacle spans at most 2 cells per axis
+        self.cell_size = 2.0 * np.max(reach)
+        lo = pos - reach[:, None]
+        hi = pos + reach[:, None]
+        self.origin = lo.min(axis=0)
+        first = np.floor((lo - self.origin) / self.cell_size).astype(np.int64)
+        last = np.floor((hi - self.origin) / self.cell_size).astype(np.int64)
+        self.grid_shape = last.max(axis=0) + 1
+
+        # (cell, obstacle) pairs of the cells overlapping the reach box of each obstacle
+        cell_ids, obst_ids = [], []
+        for i in range(len(ids)):
+            axes = [np.arange(first[i, d], last[i, d] + 1) for d in range(3)]
+            cells = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+            cell_ids.append(np.ravel_multi_index(cells.T, self.grid_shape))
+            obst_ids.append(np.full(len(cells), ids[i]))
+        cell_ids, obst_ids = np.concatenate(cell_ids), np.concatenate(obst_ids)
+
+        # the stable sort keeps the obstacles of a cell in increasing order
+        order = np.argsort(cell_ids, kind='stable')
+        cell_ids, obst_ids = cell_ids[order], obst_ids[order]
+        counts = np.bincount(cell_ids, minlength=np.prod(self.grid_shape))
+        rank = np.arange(len(cell_ids)) - (np.cumsum(counts) - counts)[cell_ids]
+        self.cells = np.full((len(counts), counts.max()), -1, dtype=np.int64)
+        self.cells[cell_ids, rank] = obst_ids
+
+    def candidates(self, points):
+        """
+        Obstacles listed in the cell of each point, points outside the grid are out of reach of all obstacles.
+        :return: (K,) point ids and (K,) obstacle ids, ordered by point, then by obstacle
+        """
+        idx = np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+        inside = np.all((idx >= 0) & (idx < self.grid_shape), axis=1)
+        point_ids = np.flatnonzero(inside)
+        if len(point_ids) == 0:
+            return point_ids, np.zeros(0, dtype=np.int64)
+
+        cells = self.cells[np.ravel_multi_index(idx[inside].T, self.grid_shape)]
+        valid = cells >= 0
+        return np.broadcast_to(point_ids[:, None], cells.shape)[valid], cells[valid]
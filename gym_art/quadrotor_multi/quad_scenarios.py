@@ -1,16 +1,34 @@
 import numpy as np
-import bezier
 import copy
 
 from gym_art.quadrotor_multi.quad_scenarios_utils import QUADS_PARAMS_DICT, update_formation_and_max_agent_per_layer, \
-    update_layer_dist, get_formation_range, get_goal_by_formation, get_z_value, QUADS_MODE_LIST, \
+    update_layer_dist, get_formation_range, formation_template, bezier_curve, get_z_value, QUADS_MODE_LIST, \
     QUADS_MODE_LIST_OBSTACLES, QUADS_MODE_LIST_SIMPLE
-from gym_art.quadrotor_multi.quad_utils import generate_points, get_grid_dim_number
+from gym_art.quadrotor_multi.quad_utils import rand_int
 
 
-def create_scenario(quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size):
-    cls = eval('Scenario_' + quads_mode)
+# quads_mode -> scenario class
+SCENARIOS = dict()
+
+
+def register_scenario(cls):
+    """Class decorator, makes Scenario_<quads_mode> available to create_scenario."""
+    SCENARIOS[cls.__name__[len('Scenario_'):]] = cls
+    return cls
+
+
+def copy_scenario_state(state):
+    return {key: value.copy() if isinstance(value, np.ndarray) and key != 'goal_trajectory' else value
+            for key, value in state.items()}
+
+
+def create_scenario(quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size,
+                    precompute_goals=False):
+    if quads_mode not in SCENARIOS:
+        raise NotImplementedError(f'Unknown scenario {quads_mode}')
+    cls = SCENARIOS[quads_mode]
     scenario = cls(quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size)
+    scenario.precompute_goals = precompute_goals
     return scenario
 
 
@@ -24,6 +42,10 @@ class QuadrotorScenario:
         self.rew_coeff = rew_coeff
         self.goals = None
 
+        # If set, scenarios with moving goals compute the goals of the whole episode at reset, (ticks, num_agents, 3)
+        self.precompute_goals = False
+        self.goal_trajectory = None
+
         #  Set formation, num_agents_per_layer, lowest_formation_size, highest_formation_size, formation_size,
         #  layer_dist, formation_center
         #  Note: num_agents_per_layer for scalability, the maximum number of agent per layer
@@ -35,15 +57,6 @@ class QuadrotorScenario:
         self.layer_dist = self.lowest_formation_size
         self.formation_center = np.array([0.0, 0.0, 2.0])
 
-        # Reset episode time
-        if self.quads_mode != 'mix':
-            ep_time = QUADS_PARAMS_DICT[quads_mode][2]
-        else:
-            ep_time = QUADS_PARAMS_DICT['swap_goals'][2]
-
-        for env in self.envs:
-            env.reset_ep_len(ep_time=ep_time)
-
         # Aux variables for scenario: circular configuration
         self.settle_count = np.zeros(self.num_agents)
         self.metric_of_settle = 2.0 * quad_arm
@@ -56,87 +69,88 @@ class QuadrotorScenario:
         """
         return self.__class__.__name__
 
+    def episode_time(self):
+        if self.quads_mode != 'mix':
+            return QUADS_PARAMS_DICT[self.quads_mode][2]
+        return QUADS_PARAMS_DICT['swap_goals'][2]
+
+    def episode_len(self):
+        """:return: the ep_len reset_ep_len sets, without touching the envs"""
+        env = self.envs[0]
+        return int(self.episode_time() / (env.dt * env.sim_steps))
+
+    def reset_ep_len(self):
+        """Apply the episode length of this scenario to the envs, called by the env after reset()."""
+        ep_time = self.episode_time()
+        for env in self.envs:
+            env.reset_ep_len(ep_time=ep_time)
+
     def generate_goals(self, num_agents, formation_center=None, layer_dist=0.0):
         if formation_center is None:
             formation_center = np.array([0., 0., 2.])
 
-        if self.formation.startswith("circle"):
-            if num_agents <= self.num_agents_per_layer:
-                real_num_per_layer = [num_agents]
-            else:
-                whole_layer_num = num_agents // self.num_agents_per_layer
-                real_num_per_layer = [self.num_agents_per_layer for _ in range(whole_layer_num)]
-                rest_num = num_agents % self.num_agents_per_layer
-                if rest_num > 0:
-                    real_num_per_layer.append(rest_num)
-
-            pi = np.pi
-            goals = []
-            for i in range(num_agents):
-                cur_layer_num_agents = real_num_per_layer[i // self.num_agents_per_layer]
-                degree = 2 * pi * (i % cur_layer_num_agents) / cur_layer_num_agents
-                pos_0 = self.formation_size * np.cos(degree)
-                pos_1 = self.formation_size * np.sin(degree)
-                goal = get_goal_by_formation(formation=self.formation, pos_0=pos_0, pos_1=pos_1, layer_pos=(i//self.num_agents_per_layer) * layer_dist)
-                goals.append(goal)
-
-            goals = np.array(goals)
-            goals += formation_center
-        elif self.formation == "sphere":
-            goals = self.formation_size * np.array(generate_points(num_agents)) + formation_center
-        elif self.formation.startswith("grid"):
-            if num_agents <= self.num_agents_per_layer:
-                dim_1, dim_2 = get_grid_dim_number(num_agents)
-                dim_size_each_layer = [[dim_1, dim_2]]
-            else:
-                # whole layer
-                whole_layer_num = num_agents // self.num_agents_per_layer
-                max_dim_1, max_dim_2 = get_grid_dim_number(self.num_agents_per_layer)
-                dim_size_each_layer = [[max_dim_1, max_dim_2] for _ in range(whole_layer_num)]
-
-                # deal with the rest of the drones
-                rest_num = num_agents % self.num_agents_per_layer
-                if rest_num > 0:
-                    dim_1, dim_2 = get_grid_dim_number(rest_num)
-                    dim_size_each_layer.append([dim_1, dim_2])
-
-            goals = []
-            for i in range(num_agents):
-                dim_1, dim_2 = dim_size_each_layer[i//self.num_agents_per_layer]
-                pos_0 = self.formation_size * (i % dim_2)
-                pos_1 = self.formation_size * (int(i / dim_2) % dim_1)
-                goal = get_goal_by_formation(formation=self.formation, pos_0=pos_0, pos_1=pos_1, layer_pos=(i//self.num_agents_per_layer) * layer_dist)
-                goals.append(goal)
-
-            mean_pos = np.mean(goals, axis=0)
-            goals = goals - mean_pos + formation_center
-        elif self.formation.startswith("cube"):
-            dim_size = np.power(num_agents, 1.0 / 3)
-            floor_dim_size = int(dim_size)
-            goals = []
-            for i in range(num_agents):
-                pos_0 = self.formation_size * (int(i / floor_dim_size) % floor_dim_size)
-                pos_1 = self.formation_size * (i % floor_dim_size)
-                goal = np.array([formation_center[2] + self.formation_size * (i // np.square(floor_dim_size)), pos_0, pos_1])
-                goals.append(goal)
-
-            mean_pos = np.mean(goals, axis=0)
-            goals = goals - mean_pos + formation_center
-        else:
-            raise NotImplementedError("Unknown formation")
+        size_dir, layer_dir = formation_template(self.formation, num_agents, self.num_agents_per_layer)
+        return formation_center + self.formation_size * size_dir + layer_dist * layer_dir
 
-        return goals
+    def formation_basis(self, formation_center, layer_dist):
+        """
+        The goals of a formation are affine in the formation size.
+        :return: offset, direction such that the goals are offset + formation_size * direction
+        """
+        size_dir, layer_dir = formation_template(self.formation, self.num_agents, self.num_agents_per_layer)
+        return formation_center + layer_dist * layer_dir, size_dir
 
     def update_formation_size(self, new_formation_size):
         if new_formation_size != self.formation_size:
+            # the precomputed goals are outdated, compute the rest of the episode on the fly
+            self.goal_trajectory = None
             self.formation_size = new_formation_size if new_formation_size > 0.0 else 0.0
             self.goals = self.generate_goals(num_agents=self.num_agents, formation_center=self.formation_center, layer_dist=self.layer_dist)
             for i, env in enumerate(self.envs):
                 env.goal = self.goals[i]
 
-    def update_formation_and_relate_param(self):
+    def get_state(self):
+        """
+        :return: the attributes of the scenario for set_state, but the goals, which are part of the flat state of the
+        env. Arrays are copied, except the baked goal trajectory, which is never modified. The envs and callbacks are
+        shared
+        """
+        return copy_scenario_state({key: value for key, value in self.__dict__.items() if key != 'goals'})
+
+    def set_state(self, state, goals):
+        # the same state may be restored several times
+        self.__dict__.update(copy_scenario_state(state))
+        self.goals = np.array(goals)
+
+    def bake_goal_trajectory(self, num_ticks, rng=np.random):
+        """
+        :param rng: np.random or a np.random.Generator to draw from
+        :return: the goals of ticks 0..num_ticks-1 as a (num_ticks, num_agents, 3) array, None for scenarios that
+        compute their goals on the fly only
+        """
+        return None
+
+    def reset_goal_trajectory(self, rng=np.random):
+        """Called after reset(). Ticks run up to ep_len + 1 before the episode is done."""
+        self.goal_trajectory = None
+        if self.precompute_goals:
+            self.goal_trajectory = self.bake_goal_trajectory(num_ticks=self.episode_len() + 2, rng=rng)
+
+    def step_goal_trajectory(self):
+        """
+        Set the precomputed goals of the current tick.
+        :return: the tick
+        """
+        tick = min(self.envs[0].tick, len(self.goal_trajectory) - 1)
+        self.goals = self.goal_trajectory[tick]
+        for i, env in enumerate(self.envs):
+            env.goal = self.goals[i]
+        return tick
+
+    def update_formation_and_relate_param(self, rng=np.random):
         # Reset formation, num_agents_per_layer, lowest_formation_size, highest_formation_size, formation_size, layer_dist
-        self.formation, self.num_agents_per_layer = update_formation_and_max_agent_per_layer(mode=self.quads_mode)
+        self.formation, self.num_agents_per_layer = update_formation_and_max_agent_per_layer(mode=self.quads_mode,
+                                                                                             rng=rng)
         # QUADS_PARAMS_DICT:
         # Key: quads_mode; Value: 0. formation, 1: [formation_low_size, formation_high_size], 2: episode_time
         lowest_dist, highest_dist = QUADS_PARAMS_DICT[self.quads_mode][1]
@@ -144,27 +158,29 @@ class QuadrotorScenario:
             get_formation_range(mode=self.quads_mode, formation=self.formation, num_agents=self.num_agents,
                                 low=lowest_dist, high=highest_dist, num_agents_per_layer=self.num_agents_per_layer)
 
-        self.formation_size = np.random.uniform(low=self.lowest_formation_size, high=self.highest_formation_size)
-        self.layer_dist = update_layer_dist(low=self.lowest_formation_size, high=self.highest_formation_size)
+        self.formation_size = rng.uniform(low=self.lowest_formation_size, high=self.highest_formation_size)
+        self.layer_dist = update_layer_dist(low=self.lowest_formation_size, high=self.highest_formation_size, rng=rng)
 
     def step(self, infos, rewards, pos):
         raise NotImplementedError("Implemented in a specific scenario")
 
-    def reset(self):
+    def reset(self, rng=np.random):
+        """:param rng: np.random or a np.random.Generator to draw the episode from"""
         # Reset formation and related parameters
-        self.update_formation_and_relate_param()
+        self.update_formation_and_relate_param(rng)
 
         # Reset formation center
         self.formation_center = np.array([0.0, 0.0, 2.0])
+        self.settle_count = np.zeros(self.num_agents)
 
         # Regenerate goals, we don't have to assign goals to the envs,
         # the reset function in quadrotor_multi.py would do that
         self.goals = self.generate_goals(num_agents=self.num_agents, formation_center=self.formation_center, layer_dist=self.layer_dist)
-        np.random.shuffle(self.goals)
+        rng.shuffle(self.goals)
 
-    def standard_reset(self):
+    def standard_reset(self, rng=np.random):
         # Reset formation and related parameters
-        self.update_formation_and_relate_param()
+        self.update_formation_and_relate_param(rng)
 
         # Reset formation center
         self.formation_center = np.array([0.0, 0.0, 2.0])
@@ -172,9 +188,10 @@ class QuadrotorScenario:
         # Regenerate goals, we don't have to assign goals to the envs,
         # the reset function in quadrotor_multi.py would do that
         self.goals = self.generate_goals(num_agents=self.num_agents, formation_center=self.formation_center, layer_dist=self.layer_dist)
-        np.random.shuffle(self.goals)
+        rng.shuffle(self.goals)
 
 
+@register_scenario
 class Scenario_static_same_goal(QuadrotorScenario):
     def update_formation_size(self, new_formation_size):
         pass
@@ -183,11 +200,13 @@ class Scenario_static_same_goal(QuadrotorScenario):
         return infos, rewards
 
 
+@register_scenario
 class Scenario_static_diff_goal(QuadrotorScenario):
     def step(self, infos, rewards, pos):
         return infos, rewards
 
 
+@register_scenario
 class Scenario_dynamic_same_goal(QuadrotorScenario):
     def __init__(self, quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size):
         super().__init__(quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size)
@@ -212,15 +231,16 @@ class Scenario_dynamic_same_goal(QuadrotorScenario):
 
         return infos, rewards
 
-    def reset(self):
+    def reset(self, rng=np.random):
         # Update duration time
-        duration_time = np.random.uniform(low=4.0, high=6.0)
+        duration_time = rng.uniform(low=4.0, high=6.0)
         self.control_step_for_sec = int(duration_time * self.envs[0].control_freq)
 
         # Reset formation, and parameters related to the formation; formation center; goals
-        self.standard_reset()
+        self.standard_reset(rng)
 
 
+@register_scenario
 class Scenario_dynamic_diff_goal(QuadrotorScenario):
     def __init__(self, quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size):
         super().__init__(quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size)
@@ -255,15 +275,16 @@ class Scenario_dynamic_diff_goal(QuadrotorScenario):
 
         return infos, rewards
 
-    def reset(self):
+    def reset(self, rng=np.random):
         # Update duration time
-        duration_time = np.random.uniform(low=4.0, high=6.0)
+        duration_time = rng.uniform(low=4.0, high=6.0)
         self.control_step_for_sec = int(duration_time * self.envs[0].control_freq)
 
         # Reset formation, and parameters related to the formation; formation center; goals
-        self.standard_reset()
+        self.standard_reset(rng)
 
 
+@register_scenario
 class Scenario_ep_lissajous3D(QuadrotorScenario):
     # Based on https://mathcurve.com/courbes3d.gb/lissajous3d/lissajous3d.shtml
     @staticmethod
@@ -274,6 +295,10 @@ class Scenario_ep_lissajous3D(QuadrotorScenario):
         return x, y, z
 
     def step(self, infos, rewards, pos):
+        if self.goal_trajectory is not None:
+            self.step_goal_trajectory()
+            return infos, rewards
+
         control_freq = self.envs[0].control_freq
         tick = self.envs[0].tick / control_freq
         x, y, z = self.lissajous3D(tick)
@@ -289,48 +314,74 @@ class Scenario_ep_lissajous3D(QuadrotorScenario):
     def update_formation_size(self, new_formation_size):
         pass
 
-    def reset(self):
+    def reset(self, rng=np.random):
         # Reset formation and related parameters
-        self.update_formation_and_relate_param()
+        self.update_formation_and_relate_param(rng)
 
         # Generate goals
         self.formation_center = np.array([-2.0, 0.0, 2.0])  # prevent drones from crashing into the wall
         self.goals = self.generate_goals(num_agents=self.num_agents, formation_center=self.formation_center, layer_dist=0.0)
 
+    def bake_goal_trajectory(self, num_ticks, rng=np.random):
+        # every tick moves the shared goal by the curve value at that tick
+        t = np.arange(1, num_ticks) / self.envs[0].control_freq
+        offsets = np.cumsum(np.stack(self.lissajous3D(t), axis=1), axis=0)
 
+        goal_trajectory = np.empty((num_ticks, self.num_agents, 3))
+        goal_trajectory[0] = self.goals
+        goal_trajectory[1:] = (self.goals[0] + offsets)[:, None]
+        return goal_trajectory
+
+
+@register_scenario
 class Scenario_ep_rand_bezier(QuadrotorScenario):
-    def step(self, infos, rewards, pos):
-        # randomly sample new goal pos in free space and have the goal move there following a bezier curve
-        tick = self.envs[0].tick
-        control_freq = self.envs[0].control_freq
-        num_secs = 5
-        control_steps = int(num_secs * control_freq)
-        t = tick % control_steps
+    # a new curve every num_secs
+    num_secs = 5
+    # goal candidates sampled at once
+    num_candidates = 16
+
+    def sample_goal_curve(self, start, control_steps, rng=np.random):
+        """
+        Randomly sample a new goal pos in free space and a bezier curve from start to it.
+        :return: (3, control_steps) goal positions along the curve
+        """
         room_dims = np.array(self.room_dims) - self.formation_size
         # min and max distance the goal can spawn away from its current location. 30 = empirical upper bound on
         # velocity that the drones can handle.
         max_dist = min(30, max(room_dims))
         min_dist = max_dist / 2
+        low, high = np.array([-room_dims[0] / 2, -room_dims[1] / 2, 0]), np.array(
+            [room_dims[0] / 2, room_dims[1] / 2, room_dims[2]])
+        lower_bound = np.expand_dims(low, axis=1)
+        upper_bound = np.expand_dims(high, axis=1)
+        # sample a new goal pos that's within the room boundaries and satisfies the distance constraint,
+        # a batch of candidates at a time
+        while True:
+            # need an intermediate point for a deg=2 curve
+            new_pos = rng.uniform(low=-high, high=high, size=(self.num_candidates, 2, 3)).reshape(-1, 3, 2)
+            # add some velocity randomization = random magnitude * unit direction
+            magnitude = rand_int(min_dist, max_dist + 1, size=(self.num_candidates, 1, 1), rng=rng)
+            new_pos = new_pos * magnitude / np.linalg.norm(new_pos, axis=1, keepdims=True)
+            new_pos = start.reshape(3, 1) + new_pos
+            # check bounds that are slightly smaller than the room dims
+            new_goal_found = np.all((new_pos > lower_bound + 0.5) & (new_pos < upper_bound - 0.5), axis=(1, 2))
+            if new_goal_found.any():
+                break
+
+        nodes = np.concatenate((start.reshape(3, 1), new_pos[np.argmax(new_goal_found)]), axis=1)
+        return bezier_curve(nodes, control_steps)
+
+    def step(self, infos, rewards, pos):
+        if self.goal_trajectory is not None:
+            self.step_goal_trajectory()
+            return infos, rewards
+
+        # randomly sample new goal pos in free space and have the goal move there following a bezier curve
+        tick = self.envs[0].tick
+        control_steps = int(self.num_secs * self.envs[0].control_freq)
+        t = tick % control_steps
         if tick % control_steps == 0 or tick == 1:
-            # sample a new goal pos that's within the room boundaries and satisfies the distance constraint
-            new_goal_found = False
-            while not new_goal_found:
-                low, high = np.array([-room_dims[0] / 2, -room_dims[1] / 2, 0]), np.array(
-                    [room_dims[0] / 2, room_dims[1] / 2, room_dims[2]])
-                # need an intermediate point for a deg=2 curve
-                new_pos = np.random.uniform(low=-high, high=high, size=(2, 3)).reshape(3, 2)
-                # add some velocity randomization = random magnitude * unit direction
-                new_pos = new_pos * np.random.randint(min_dist, max_dist + 1) / np.linalg.norm(new_pos, axis=0)
-                new_pos = self.goals[0].reshape(3, 1) + new_pos
-                lower_bound = np.expand_dims(low, axis=1)
-                upper_bound = np.expand_dims(high, axis=1)
-                new_goal_found = (new_pos > lower_bound + 0.5).all() and (
-                        new_pos < upper_bound - 0.5).all()  # check bounds that are slightly smaller than the room dims
-            nodes = np.concatenate((self.goals[0].reshape(3, 1), new_pos), axis=1)
-            nodes = np.asfortranarray(nodes)
-            pts = np.linspace(0, 1, control_steps)
-            curve = bezier.Curve(nodes, degree=2)
-            self.interp = curve.evaluate_multi(pts)
+            self.interp = self.sample_goal_curve(self.goals[0], control_steps)
             # self.interp = np.clip(self.interp, a_min=np.array([0,0,0.2]).reshape(3,1), a_max=high.reshape(3,1)) # want goal clipping to be slightly above the floor
         if tick % control_steps != 0 and tick > 1:
             self.goals = np.array([self.interp[:, t] for _ in range(self.num_agents)])
@@ -340,10 +391,26 @@ class Scenario_ep_rand_bezier(QuadrotorScenario):
 
         return infos, rewards
 
+    def bake_goal_trajectory(self, num_ticks, rng=np.random):
+        control_steps = int(self.num_secs * self.envs[0].control_freq)
+        goal_trajectory = np.empty((num_ticks, self.num_agents, 3))
+        goal_trajectory[0] = self.goals
+
+        # the goals stay put on the ticks a new curve is sampled and follow it in between
+        ticks = np.arange(num_ticks)
+        curve_ticks = [1] + list(range(control_steps, num_ticks, control_steps))
+        for start, end in zip(curve_ticks, curve_ticks[1:] + [num_ticks]):
+            goal_trajectory[start] = goal_trajectory[start - 1]
+            self.interp = self.sample_goal_curve(goal_trajectory[start - 1, 0], control_steps, rng=rng)
+            goal_trajectory[start + 1:end] = self.interp[:, ticks[start + 1:end] % control_steps].T[:, None]
+
+        return goal_trajectory
+
     def update_formation_size(self, new_formation_size):
         pass
 
 
+@register_scenario
 class Scenario_swap_goals(QuadrotorScenario):
     def __init__(self, quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size):
         super().__init__(quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size)
@@ -357,6 +424,10 @@ class Scenario_swap_goals(QuadrotorScenario):
             env.goal = goal
 
     def step(self, infos, rewards, pos):
+        if self.goal_trajectory is not None:
+            self.step_goal_trajectory()
+            return infos, rewards
+
         tick = self.envs[0].tick
         # Switch every [4, 6] seconds
         if tick % self.control_step_for_sec == 0 and tick > 0:
@@ -364,15 +435,26 @@ class Scenario_swap_goals(QuadrotorScenario):
 
         return infos, rewards
 
-    def reset(self):
+    def bake_goal_trajectory(self, num_ticks, rng=np.random):
+        goal_trajectory = np.empty((num_ticks, self.num_agents, 3))
+        goals, start = self.goals, 0
+        for switch in range(self.control_step_for_sec, num_ticks, self.control_step_for_sec):
+            goal_trajectory[start:switch] = goals
+            goals = goals[rng.permutation(self.num_agents)]
+            start = switch
+        goal_trajectory[start:] = goals
+        return goal_trajectory
+
+    def reset(self, rng=np.random):
         # Update duration time
-        duration_time = np.random.uniform(low=4.0, high=6.0)
+        duration_time = rng.uniform(low=4.0, high=6.0)
         self.control_step_for_sec = int(duration_time * self.envs[0].control_freq)
 
         # Reset formation, and parameters related to the formation; formation center; goals
-        self.standard_reset()
+        self.standard_reset(rng)
 
 
+@register_scenario
 class Scenario_circular_config(QuadrotorScenario):
     def update_goals(self):
         np.random.shuffle(self.goals)
@@ -407,6 +489,7 @@ class Scenario_circular_config(QuadrotorScenario):
         return infos, rewards
 
 
+@register_scenario
 class Scenario_dynamic_formations(QuadrotorScenario):
     def __init__(self, quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size):
         super().__init__(quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size)
@@ -415,6 +498,8 @@ class Scenario_dynamic_formations(QuadrotorScenario):
         self.increase_formation_size = True
         # low: 0.1m/s, high: 0.3m/s
         self.control_speed = np.random.uniform(low=1.0, high=3.0)
+        # per tick formation_size, increase_formation_size, control_speed of the precomputed goals
+        self.formation_states = None
 
     # change formation sizes on the fly
     def update_goals(self):
@@ -423,6 +508,11 @@ class Scenario_dynamic_formations(QuadrotorScenario):
             env.goal = goal
 
     def step(self, infos, rewards, pos):
+        if self.goal_trajectory is not None:
+            tick = self.step_goal_trajectory()
+            self.formation_size, self.increase_formation_size, self.control_speed = self.formation_states[tick]
+            return infos, rewards
+
         if self.formation_size <= -self.highest_formation_size:
             self.increase_formation_size = True
             self.control_speed = np.random.uniform(low=1.0, high=3.0)
@@ -438,19 +528,45 @@ class Scenario_dynamic_formations(QuadrotorScenario):
         self.update_goals()
         return infos, rewards
 
-    def reset(self):
-        self.increase_formation_size = True if np.random.uniform(low=0.0, high=1.0) < 0.5 else False
-        self.control_speed = np.random.uniform(low=1.0, high=3.0)
+    def reset(self, rng=np.random):
+        self.increase_formation_size = True if rng.uniform(low=0.0, high=1.0) < 0.5 else False
+        self.control_speed = rng.uniform(low=1.0, high=3.0)
 
         # Reset formation, and parameters related to the formation; formation center; goals
-        self.standard_reset()
+        self.standard_reset(rng)
+
+    def bake_goal_trajectory(self, num_ticks, rng=np.random):
+        formation_size, increase_formation_size, control_speed = \
+            self.formation_size, self.increase_formation_size, self.control_speed
+        self.formation_states = [(formation_size, increase_formation_size, control_speed)]
+        for _ in range(1, num_ticks):
+            if formation_size <= -self.highest_formation_size:
+                increase_formation_size = True
+                control_speed = rng.uniform(low=1.0, high=3.0)
+            elif formation_size >= self.highest_formation_size:
+                increase_formation_size = False
+                control_speed = rng.uniform(low=1.0, high=3.0)
+
+            if increase_formation_size:
+                formation_size += 0.001 * control_speed
+            else:
+                formation_size -= 0.001 * control_speed
+            self.formation_states.append((formation_size, increase_formation_size, control_speed))
+
+        formation_sizes = np.array([state[0] for state in self.formation_states])
+        offset, direction = self.formation_basis(self.formation_center, self.layer_dist)
+        goal_trajectory = offset + formation_sizes[:, None, None] * direction
+        goal_trajectory[0] = self.goals
+        return goal_trajectory
 
     def update_formation_size(self, new_formation_size):
         if new_formation_size != self.formation_size:
+            self.goal_trajectory = None
             self.formation_size = new_formation_size if new_formation_size > 0.0 else 0.0
             self.update_goals()
 
 
+@register_scenario
 class Scenario_swarm_vs_swarm(QuadrotorScenario):
     def __init__(self, quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size):
         super().__init__(quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size)
@@ -460,7 +576,7 @@ class Scenario_swarm_vs_swarm(QuadrotorScenario):
         self.goals_1, self.goals_2 = None, None
         self.goal_center_1, self.goal_center_2 = None, None
 
-    def formation_centers(self):
+    def formation_centers(self, rng=np.random):
         if self.formation_center is None:
             self.formation_center = np.array([0., 0., 2.])
 
@@ -468,18 +584,18 @@ class Scenario_swarm_vs_swarm(QuadrotorScenario):
         box_size = self.envs[0].box
         dist_low_bound = self.lowest_formation_size
         # Get the 1st goal center
-        x, y = np.random.uniform(low=-box_size, high=box_size, size=(2,))
+        x, y = rng.uniform(low=-box_size, high=box_size, size=(2,))
         # Get z value, and make sure all goals will above the ground
         z = get_z_value(num_agents=self.num_agents, num_agents_per_layer=self.num_agents_per_layer,
-                        box_size=box_size, formation=self.formation, formation_size=self.formation_size)
+                        box_size=box_size, formation=self.formation, formation_size=self.formation_size, rng=rng)
 
         goal_center_1 = np.array([x, y, z])
 
         # Get the 2nd goal center
-        goal_center_distance = np.random.uniform(low=box_size/4, high=box_size)
+        goal_center_distance = rng.uniform(low=box_size/4, high=box_size)
 
-        phi = np.random.uniform(low=-np.pi, high=np.pi)
-        theta = np.random.uniform(low=-0.5 * np.pi, high=0.5 * np.pi)
+        phi = rng.uniform(low=-np.pi, high=np.pi)
+        theta = rng.uniform(low=-0.5 * np.pi, high=0.5 * np.pi)
         goal_center_2 = goal_center_1 + goal_center_distance * np.array(
             [np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)])
         diff_x, diff_y, diff_z = goal_center_2 - goal_center_1
@@ -522,16 +638,16 @@ class Scenario_swarm_vs_swarm(QuadrotorScenario):
             self.update_goals()
         return infos, rewards
 
-    def reset(self):
+    def reset(self, rng=np.random):
         # Update duration time
-        duration_time = np.random.uniform(low=4.0, high=6.0)
+        duration_time = rng.uniform(low=4.0, high=6.0)
         self.control_step_for_sec = int(duration_time * self.envs[0].control_freq)
 
         # Reset formation and related parameters
-        self.update_formation_and_relate_param()
+        self.update_formation_and_relate_param(rng)
 
         # Reset the formation size and the goals of swarms
-        self.goal_center_1, self.goal_center_2 = self.formation_centers()
+        self.goal_center_1, self.goal_center_2 = self.formation_centers(rng)
         self.create_formations(self.goal_center_1, self.goal_center_2)
 
         # This is for initialize the pos for obstacles
@@ -545,6 +661,7 @@ class Scenario_swarm_vs_swarm(QuadrotorScenario):
                 env.goal = self.goals[i]
 
 
+@register_scenario
 class Scenario_tunnel(QuadrotorScenario):
     def update_goals(self, formation_center):
         self.goals = self.generate_goals(num_agents=self.num_agents, formation_center=formation_center, layer_dist=self.layer_dist)
@@ -562,18 +679,19 @@ class Scenario_tunnel(QuadrotorScenario):
                     env.goal[1] = -env.goal[1]
         return infos, rewards
 
-    def reset(self):
+    def reset(self, rng=np.random):
         # tunnel could be in the x or y direction
-        p = np.random.uniform(0, 1)
+        p = rng.uniform(0, 1)
         if p <= 0.5:
             self.update_room_dims((10, 2, 2))
             formation_center = np.array([-4, 0, 1])
         else:
             self.update_room_dims((2, 10, 2))
             formation_center = np.array([0, -4, 1])
-        self.update_goals(formation_center)
+        self.goals = self.generate_goals(num_agents=self.num_agents, formation_center=formation_center, layer_dist=self.layer_dist)
 
 
+@register_scenario
 class Scenario_run_away(QuadrotorScenario):
     def __init__(self, quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size):
         super().__init__(quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size)
@@ -596,16 +714,16 @@ class Scenario_run_away(QuadrotorScenario):
 
         return infos, rewards
 
-    def reset(self):
+    def reset(self, rng=np.random):
         # Reset formation and related parameters
-        self.update_formation_and_relate_param()
+        self.update_formation_and_relate_param(rng)
         # Reset formation center
         self.formation_center = np.array([0.0, 0.0, 2.0])
 
         # Regenerate goals, we don't have to assign goals to the envs,
         # the reset function in quadrotor_multi.py would do that
         self.goals = self.generate_goals(num_agents=self.num_agents, formation_center=self.formation_center, layer_dist=self.layer_dist)
-        np.random.shuffle(self.goals)
+        rng.shuffle(self.goals)
 
     def update_formation_size(self, new_formation_size):
         if new_formation_size != self.formation_size:
@@ -613,6 +731,7 @@ class Scenario_run_away(QuadrotorScenario):
             self.update_goals()
 
 
+@register_scenario
 class Scenario_mix(QuadrotorScenario):
     def __init__(self, quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size):
         super().__init__(quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size)
@@ -634,6 +753,8 @@ class Scenario_mix(QuadrotorScenario):
 
         # actual scenario being used
         self.scenario = None
+        # scenarios are built once and reused by later episodes, keyed by quads_mode
+        self.scenario_pool = dict()
 
     def name(self):
         """
@@ -648,16 +769,43 @@ class Scenario_mix(QuadrotorScenario):
         self.formation_size = self.scenario.formation_size
         return infos, rewards
 
-    def reset(self):
-        mode_index = np.random.randint(low=0, high=len(self.quads_mode_list))
+    def reset(self, rng=np.random):
+        mode_index = rand_int(low=0, high=len(self.quads_mode_list), rng=rng)
         mode = self.quads_mode_list[mode_index]
 
-        # Init the scenario
-        self.scenario = create_scenario(quads_mode=mode, envs=self.envs, num_agents=self.num_agents,
-                                        room_dims=self.room_dims, room_dims_callback=self.room_dims_callback,
-                                        rew_coeff=self.rew_coeff, quads_formation=self.formation,
-                                        quads_formation_size=self.formation_size)
+        self.scenario = self.pooled_scenario(mode)
 
-        self.scenario.reset()
+        self.scenario.reset(rng)
         self.goals = self.scenario.goals
         self.formation_size = self.scenario.formation_size
+
+    def pooled_scenario(self, mode):
+        if mode not in self.scenario_pool:
+            self.scenario_pool[mode] = create_scenario(
+                quads_mode=mode, envs=self.envs, num_agents=self.num_agents, room_dims=self.room_dims,
+                room_dims_callback=self.room_dims_callback, rew_coeff=self.rew_coeff, quads_formation=self.formation,
+                quads_formation_size=self.formation_size, precompute_goals=self.precompute_goals)
+        return self.scenario_pool[mode]
+
+    def get_state(self):
+        state = super().get_state()
+        # restored into the pooled scenario of the same mode, the state may come from another Scenario_mix instance
+        del state['scenario_pool']
+        state['scenario'] = (self.scenario.quads_mode, self.scenario.get_state())
+        return state
+
+    def set_state(self, state, goals):
+        mode, scenario_state = state['scenario']
+        scenario = self.pooled_scenario(mode)
+        scenario.set_state(scenario_state, goals)
+        super().set_state(dict(state, scenario=scenario), goals)
+        self.goals = scenario.goals
+
+    def reset_ep_len(self):
+        if self.scenario is None:
+            super().reset_ep_len()
+        else:
+            self.scenario.reset_ep_len()
+
+    def reset_goal_trajectory(self, rng=np.random):
+        self.scenario.reset_goal_trajectory(rng)
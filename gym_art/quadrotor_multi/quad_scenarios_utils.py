@@ -1,5 +1,9 @@
+from functools import lru_cache
+from math import comb
+
 import numpy as np
-from gym_art.quadrotor_multi.quad_utils import get_circle_radius, get_sphere_radius, get_grid_dim_number
+from gym_art.quadrotor_multi.quad_utils import get_circle_radius, get_sphere_radius, get_grid_dim_number, \
+    generate_points, rand_int
 
 QUADS_MODE_LIST = ['static_same_goal', 'static_diff_goal', 'dynamic_same_goal', 'dynamic_diff_goal', 'circular_config',
                    'ep_lissajous3D', 'ep_rand_bezier', 'swarm_vs_swarm', 'dynamic_formations', 'swap_goals']
@@ -41,8 +45,8 @@ QUADS_PARAMS_DICT = {
 }
 
 
-def update_formation_and_max_agent_per_layer(mode):
-    formation_index = np.random.randint(low=0, high=len(QUADS_PARAMS_DICT[mode][0]))
+def update_formation_and_max_agent_per_layer(mode, rng=np.random):
+    formation_index = rand_int(low=0, high=len(QUADS_PARAMS_DICT[mode][0]), rng=rng)
     formation = QUADS_FORMATION_LIST[formation_index]
     if formation.startswith("circle"):
         num_agents_per_layer = 8
@@ -55,8 +59,8 @@ def update_formation_and_max_agent_per_layer(mode):
     return formation, num_agents_per_layer
 
 
-def update_layer_dist(low, high):
-    layer_dist = np.random.uniform(low=low, high=high)
+def update_layer_dist(low, high, rng=np.random):
+    layer_dist = rng.uniform(low=low, high=high)
     return layer_dist
 
 
@@ -97,8 +101,79 @@ def get_goal_by_formation(formation, pos_0, pos_1, layer_pos=0.):
     return goal
 
 
-def get_z_value(num_agents, num_agents_per_layer, box_size, formation, formation_size):
-    z = np.random.uniform(low=-0.5 * box_size, high=0.5 * box_size) + 2.0
+@lru_cache(maxsize=128)
+def formation_template(formation, num_agents, num_agents_per_layer):
+    """
+    Unit layout of a formation, the goals are formation_center + formation_size * size_dir + layer_dist * layer_dir.
+    The arrays are shared between calls and read-only.
+    :return: size_dir, layer_dir
+    """
+    i = np.arange(num_agents)
+    layer = i // num_agents_per_layer
+    zeros = np.zeros(num_agents)
+
+    if formation.startswith("circle"):
+        # the last layer holds the rest of the drones
+        cur_layer_num_agents = np.minimum(num_agents_per_layer, num_agents - layer * num_agents_per_layer)
+        degree = 2 * np.pi * (i % cur_layer_num_agents) / cur_layer_num_agents
+        size_dir = get_goal_by_formation(formation=formation, pos_0=np.cos(degree), pos_1=np.sin(degree), layer_pos=zeros).T
+        layer_dir = get_goal_by_formation(formation=formation, pos_0=zeros, pos_1=zeros, layer_pos=layer).T
+    elif formation == "sphere":
+        size_dir = np.array(generate_points(num_agents))
+        layer_dir = np.zeros_like(size_dir)
+    elif formation.startswith("grid"):
+        if num_agents <= num_agents_per_layer:
+            dim_size_each_layer = [get_grid_dim_number(num_agents)]
+        else:
+            whole_layer_num = num_agents // num_agents_per_layer
+            dim_size_each_layer = [get_grid_dim_number(num_agents_per_layer)] * whole_layer_num
+            rest_num = num_agents % num_agents_per_layer
+            if rest_num > 0:
+                dim_size_each_layer.append(get_grid_dim_number(rest_num))
+
+        dim_1, dim_2 = np.array(dim_size_each_layer)[layer].T
+        size_dir = get_goal_by_formation(formation=formation, pos_0=i % dim_2, pos_1=(i // dim_2) % dim_1, layer_pos=zeros).T
+        layer_dir = get_goal_by_formation(formation=formation, pos_0=zeros, pos_1=zeros, layer_pos=layer).T
+        size_dir, layer_dir = size_dir - size_dir.mean(axis=0), layer_dir - layer_dir.mean(axis=0)
+    elif formation.startswith("cube"):
+        floor_dim_size = int(np.power(num_agents, 1.0 / 3))
+        size_dir = np.stack([i // np.square(floor_dim_size), (i // floor_dim_size) % floor_dim_size,
+                             i % floor_dim_size], axis=1)
+        size_dir = size_dir - size_dir.mean(axis=0)
+        layer_dir = np.zeros_like(size_dir)
+    else:
+        raise NotImplementedError("Unknown formation")
+
+    size_dir, layer_dir = size_dir.astype(np.float64), layer_dir.astype(np.float64)
+    size_dir.setflags(write=False)
+    layer_dir.setflags(write=False)
+    return size_dir, layer_dir
+
+
+@lru_cache(maxsize=16)
+def bezier_basis(degree, num_pts):
+    """
+    Bernstein polynomials of the degree at num_pts uniformly spaced parameters in [0, 1].
+    :return: read-only (degree + 1, num_pts)
+    """
+    pts = np.linspace(0, 1, num_pts)
+    k = np.arange(degree + 1)[:, None]
+    binom = np.array([comb(degree, i) for i in range(degree + 1)])[:, None]
+    basis = binom * pts ** k * (1.0 - pts) ** (degree - k)
+    basis.setflags(write=False)
+    return basis
+
+
+def bezier_curve(nodes, num_pts):
+    """
+    Evaluate the Bezier curve with control points nodes (dim, degree + 1) at num_pts uniformly spaced parameters.
+    :return: (dim, num_pts)
+    """
+    return nodes @ bezier_basis(nodes.shape[1] - 1, num_pts)
+
+
+def get_z_value(num_agents, num_agents_per_layer, box_size, formation, formation_size, rng=np.random):
+    z = rng.uniform(low=-0.5 * box_size, high=0.5 * box_size) + 2.0
     z_lower_bound = 0.25
     if formation == "sphere" or formation.startswith("circle_vertical"):
         z_lower_bound = formation_size + 0.25
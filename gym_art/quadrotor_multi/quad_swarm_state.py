@@ -0,0 +1,43 @@
+import numpy as np
+
+
+class SwarmState:
+    """
+    Swarm-wide arrays gathered from the per-drone dynamics, so that batched functions (see get_state.py)
+    can process all drones in one call instead of N Python calls per tick.
+    """
+    def __init__(self, num_agents):
+        self.num_agents = num_agents
+
+        self.pos = np.zeros((num_agents, 3))
+        self.vel = np.zeros((num_agents, 3))
+        self.rot = np.tile(np.eye(3), (num_agents, 1, 1))
+        self.omega = np.zeros((num_agents, 3))
+        self.acc = np.zeros((num_agents, 3))
+        self.goal = np.zeros((num_agents, 3))
+        # [current, previous] actions, same convention as QuadrotorSingle.actions
+        self.actions = np.zeros((2, num_agents, 4))
+        self.crashed = np.zeros(num_agents, dtype=bool)
+        self.arm = np.zeros(num_agents)
+
+        self.room_box = np.array([[-5., -5., 0.], [5., 5., 10.]])
+        self.tick = 0
+
+        # buffers of the history-based state functions, keyed by name
+        self.history = dict()
+
+    def gather(self, envs):
+        for i, e in enumerate(envs):
+            self.pos[i] = e.dynamics.pos
+            self.vel[i] = e.dynamics.vel
+            self.rot[i] = e.dynamics.rot
+            self.omega[i] = e.dynamics.omega
+            self.acc[i] = e.dynamics.accelerometer
+            self.goal[i] = e.goal[:3]
+            self.actions[0, i] = e.actions[0]
+            self.actions[1, i] = e.actions[1]
+            self.crashed[i] = e.crashed
+            self.arm[i] = e.dynamics.arm
+
+        self.room_box = envs[0].room_box
+        self.tick = envs[0].tick
@@ -60,6 +60,61 @@ def rand_uniform_rot3d():
     rot = np.column_stack([fwd, left, up])
     return rot
 
+def rand_int(low, high, size=None, rng=np.random):
+    """np.random.randint(low, high, size), or the same range drawn from the np.random.Generator rng."""
+    if rng is np.random:
+        return np.random.randint(low, high, size=size)
+    return rng.integers(low, high, size=size)
+
+def rng_state_size(rng):
+    """Number of float64 values of get_rng_state, for a PCG64 np.random.Generator or a np.random.RandomState."""
+    if isinstance(rng, np.random.RandomState):
+        return 627
+    if isinstance(rng, np.random.Generator) and isinstance(rng.bit_generator, np.random.PCG64):
+        return 10
+    raise ValueError(f'Unsupported random number generator {rng}')
+
+def get_rng_state(rng, out):
+    """
+    Write the state of rng to the float64 array out, of size rng_state_size(rng). The 128 bit PCG64 integers are split
+    into 32 bit words, which float64 holds exactly.
+    """
+    if isinstance(rng, np.random.RandomState):
+        _, keys, pos, has_gauss, cached_gaussian = rng.get_state()
+        out[:624], out[624:] = keys, [pos, has_gauss, cached_gaussian]
+    else:
+        state = rng.bit_generator.state
+        words = [(state['state'][key] >> (32 * k)) & 0xffffffff for key in ['state', 'inc'] for k in range(4)]
+        out[:] = words + [state['has_uint32'], state['uinteger']]
+    return out
+
+def set_rng_state(rng, state):
+    """Restore the state of rng written by get_rng_state."""
+    if isinstance(rng, np.random.RandomState):
+        rng.set_state(('MT19937', state[:624].astype(np.uint32), int(state[624]), int(state[625]), float(state[626])))
+    else:
+        words = [int(w) for w in state[:8]]
+        state_int, inc = [sum(w << (32 * k) for k, w in enumerate(words[i:i + 4])) for i in [0, 4]]
+        rng.bit_generator.state = dict(bit_generator='PCG64', state=dict(state=state_int, inc=inc),
+                                       has_uint32=int(state[8]), uinteger=int(state[9]))
+
+def rand_uniform_rot3d_batch(num, rng=np.random):
+    """rand_uniform_rot3d for num drones at once, the close up/forward pairs are resampled in bulk. (num, 3, 3)"""
+    def randunit(n):
+        v = rng.normal(size=(n, 3))
+        return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+    up, fwd = randunit(num), randunit(num)
+    rejected = np.flatnonzero(np.sum(fwd * up, axis=1) > 0.95)
+    while len(rejected) > 0:
+        fwd[rejected] = randunit(len(rejected))
+        rejected = rejected[np.sum(fwd[rejected] * up[rejected], axis=1) > 0.95]
+
+    left = np.cross(up, fwd)
+    left /= np.linalg.norm(left, axis=1, keepdims=True)
+    up = np.cross(fwd, left)
+    return np.stack([fwd, left, up], axis=2)
+
 # shorter way to construct a numpy array
 def npa(*args):
     return np.array(args)
@@ -130,6 +185,13 @@ def rotZ(theta):
     r[:2,:2] = rot2D(theta)
     return r
 
+def rot_z_batch(theta):
+    """3x3 rotations about z by the angles theta (N,). (N, 3, 3)"""
+    c, s = np.cos(theta), np.sin(theta)
+    rot = np.zeros((len(theta), 3, 3))
+    rot[:, 0, 0], rot[:, 0, 1], rot[:, 1, 0], rot[:, 1, 1], rot[:, 2, 2] = c, -s, s, c, 1.0
+    return rot
+
 def rpy2R(r, p, y):
     R_x = np.array([[1, 0, 0],
                     [0, np.cos(r), -np.sin(r)],
@@ -258,6 +320,149 @@ def calculate_collision_matrix(positions, arm, hitbox_radius):
     return collision_matrix, all_collisions, dist
 
 
+@njit
+def _collision_pairs_numba(positions, threshold, dist, bits):
+    num_agents = positions.shape[0]
+    k = 0
+    for i in range(num_agents):
+        for j in range(i + 1, num_agents):
+            dx = positions[i, 0] - positions[j, 0]
+            dy = positions[i, 1] - positions[j, 1]
+            dz = positions[i, 2] - positions[j, 2]
+            d = np.sqrt(dx * dx + dy * dy + dz * dz)
+            dist[k] = d
+            if d < threshold:
+                # same bit order as np.packbits
+                bits[k >> 3] |= np.uint8(128 >> (k & 7))
+            k += 1
+
+
+@njit
+def _swept_collision_pairs_numba(prev_positions, positions, threshold, dist, bits):
+    num_agents = positions.shape[0]
+    k = 0
+    for i in range(num_agents):
+        for j in range(i + 1, num_agents):
+            # relative position at the start of the interval and its displacement, assuming linear motion
+            p0x = prev_positions[i, 0] - prev_positions[j, 0]
+            p0y = prev_positions[i, 1] - prev_positions[j, 1]
+            p0z = prev_positions[i, 2] - prev_positions[j, 2]
+            p1x = positions[i, 0] - positions[j, 0]
+            p1y = positions[i, 1] - positions[j, 1]
+            p1z = positions[i, 2] - positions[j, 2]
+            dx, dy, dz = p1x - p0x, p1y - p0y, p1z - p0z
+            dd = dx * dx + dy * dy + dz * dz
+            t = 0.0
+            if dd > 0.0:
+                t = min(max(-(p0x * dx + p0y * dy + p0z * dz) / dd, 0.0), 1.0)
+            cx, cy, cz = p0x + t * dx, p0y + t * dy, p0z + t * dz
+
+            dist[k] = np.sqrt(p1x * p1x + p1y * p1y + p1z * p1z)
+            if np.sqrt(cx * cx + cy * cy + cz * cz) < threshold:
+                bits[k >> 3] |= np.uint8(128 >> (k & 7))
+            k += 1
+
+
+def calculate_collision_pairs(positions, arm, hitbox_radius, prev_positions=None):
+    """
+    Pairwise drone distances in condensed form (pair k = (i, j), i < j, in scipy's pdist order) and the colliding
+    pairs as a bitset packed with np.packbits, so that new and ongoing collisions are bitwise ops:
+    curr & ~prev and curr & prev.
+    :param prev_positions: positions at the start of the control interval. If given, a pair collides if the
+    drones got closer than the hitbox at any point of the interval (swept spheres), not only at the end of it
+    """
+    num_agents = len(positions)
+    num_pairs = num_agents * (num_agents - 1) // 2
+    dist = np.empty(num_pairs)
+    bits = np.zeros((num_pairs + 7) // 8, dtype=np.uint8)
+    positions = np.ascontiguousarray(positions, dtype=np.float64)
+    if prev_positions is None:
+        _collision_pairs_numba(positions, hitbox_radius * arm, dist, bits)
+    else:
+        prev_positions = np.ascontiguousarray(prev_positions, dtype=np.float64)
+        _swept_collision_pairs_numba(prev_positions, positions, hitbox_radius * arm, dist, bits)
+    return dist, bits
+
+
+def segment_point_distance(start, end, point):
+    """Distance from the segments start -> end (..., 3) to the points (..., 3), broadcast against each other."""
+    d = end - start
+    dd = np.sum(d * d, axis=-1)
+    t = np.sum((point - start) * d, axis=-1) / np.where(dd > 0.0, dd, 1.0)
+    closest = start + np.clip(t, 0.0, 1.0)[..., None] * d
+    return np.linalg.norm(closest - point, axis=-1)
+
+
+def segment_box_distance(start, end, box_min, box_max, iters=40):
+    """
+    Distance from the segments start -> end (..., 3) to the axis-aligned boxes [box_min, box_max] (..., 3),
+    broadcast against each other.
+    The squared distance to a box is convex along a segment, so a golden-section search over the segment
+    parameter finds its minimum.
+    """
+    shape = np.broadcast_shapes(start.shape[:-1], end.shape[:-1], box_min.shape[:-1], box_max.shape[:-1])
+
+    def sq_dist(t):
+        p = start + t[..., None] * (end - start)
+        return np.sum((p - np.clip(p, box_min, box_max)) ** 2, axis=-1)
+
+    inv_phi = (np.sqrt(5.0) - 1.0) / 2.0
+    lo, hi = np.zeros(shape), np.ones(shape)
+    for _ in range(iters):
+        t1 = hi - inv_phi * (hi - lo)
+        t2 = lo + inv_phi * (hi - lo)
+        left = sq_dist(t1) < sq_dist(t2)
+        hi = np.where(left, t2, hi)
+        lo = np.where(left, lo, t1)
+
+    # the ends are checked explicitly, the search only approaches them
+    best = np.minimum(sq_dist((lo + hi) / 2.0), np.minimum(sq_dist(np.zeros(shape)), sq_dist(np.ones(shape))))
+    return np.sqrt(best)
+
+
+def condensed_to_pairs(k, num_agents):
+    """(len(k), 2) drone ids (i, j), i < j, of the condensed pair indices k."""
+    k = np.asarray(k, dtype=np.int64)
+    n = num_agents
+    i = n - 2 - np.floor(np.sqrt(4 * n * (n - 1) - 8 * k - 7) / 2.0 - 0.5).astype(np.int64)
+    j = k + i + 1 - n * (n - 1) // 2 + (n - i) * (n - i - 1) // 2
+    return np.stack([i, j], axis=1)
+
+
+def collision_bits_to_pairs(bits, num_agents):
+    """(num_collisions, 2) drone ids of the pairs set in a bitset returned by calculate_collision_pairs."""
+    nonzero_bytes = np.flatnonzero(bits)
+    rows, cols = np.nonzero(np.unpackbits(bits[nonzero_bytes]).reshape(-1, 8))
+    return condensed_to_pairs(nonzero_bytes[rows] * 8 + cols, num_agents)
+
+
+# Per-drone room contact flags, see calculate_room_contacts
+CONTACT_FLOOR, CONTACT_CEILING, CONTACT_WALL, CONTACT_GROUND = 1, 2, 4, 8
+
+
+def calculate_room_contacts(pos, room_box, arm, ground_height=0.25):
+    """
+    Contacts of all drones with the room at once.
+    CONTACT_FLOOR: drone on the floor (pos z <= arm), CONTACT_CEILING / CONTACT_WALL: drone at the room box,
+    CONTACT_GROUND: drone below ground_height, counted as a ground collision.
+    :param arm: arm length, scalar or (num_agents,)
+    :return: (num_agents,) uint8 bitmask of CONTACT_* flags and the (num_agents,) crashed mask, i.e. drones on the
+    floor or outside the room box
+    """
+    at_min = pos <= room_box[0]
+    at_max = pos >= room_box[1]
+
+    contacts = np.zeros(len(pos), dtype=np.uint8)
+    contacts[pos[:, 2] <= arm] |= CONTACT_FLOOR
+    contacts[at_max[:, 2]] |= CONTACT_CEILING
+    contacts[np.any(at_min[:, :2] | at_max[:, :2], axis=1)] |= CONTACT_WALL
+    contacts[pos[:, 2] < ground_height] |= CONTACT_GROUND
+
+    outside = np.any((pos < room_box[0]) | (pos > room_box[1]), axis=1)
+    crashed = ((contacts & CONTACT_FLOOR) > 0) | outside
+    return contacts, crashed
+
+
 def calculate_drone_proximity_penalties(distance_matrix, arm, dt, penalty_fall_off, max_penalty, num_agents):
     if not penalty_fall_off:
         # smooth penalties is disabled, so noop
@@ -281,6 +486,53 @@ def calculate_obst_drone_proximity_penalties(distance_matrix, arm, dt, penalty_f
     return dt * penalties  # actual penalties per tick to be added to the overall reward
 
 
+def drone_pairs_within(distances, radius, num_agents):
+    """
+    Candidate pairs for the sparse proximity penalties from the condensed distances of calculate_collision_pairs.
+    :return: (K, 2) drone ids and (K,) distances of the pairs closer than radius
+    """
+    k = np.flatnonzero(distances < radius)
+    return condensed_to_pairs(k, num_agents), distances[k]
+
+
+def calculate_drone_proximity_penalties_sparse(pairs, pair_distances, arm, dt, penalty_fall_off, max_penalty,
+                                               num_agents):
+    """
+    Same as calculate_drone_proximity_penalties, computed only for the candidate pairs. Pairs further than
+    penalty_fall_off * arm can be left out, they contribute nothing.
+    :param pairs: (K, 2) drone ids, every pair listed once
+    """
+    if not penalty_fall_off:
+        # smooth penalties is disabled, so noop
+        return np.zeros(num_agents)
+    penalties = (-max_penalty / (penalty_fall_off * arm)) * pair_distances + max_penalty
+    penalties = np.maximum(penalties, 0.0)
+    # each pair penalizes both drones
+    penalties = np.bincount(pairs.ravel(), weights=np.repeat(penalties, 2), minlength=num_agents)
+
+    return dt * penalties  # actual penalties per tick to be added to the overall reward
+
+
+def calculate_obst_drone_proximity_penalties_sparse(pairs, pair_distances, arm, dt, penalty_fall_off, max_penalty,
+                                                    num_agents, obstacles_radius):
+    """
+    Same as calculate_obst_drone_proximity_penalties, computed only for the candidate drone-obstacle pairs, see
+    MultiObstacles.collision_detection. Pairs further than penalty_fall_off * arm + obstacles_radius can be left out,
+    they contribute nothing.
+    :param pairs: (K, 2) drone ids and obstacle ids
+    :param pair_distances: (K,) distances between the drone and the obstacle center
+    """
+    if not penalty_fall_off:
+        # smooth penalties is disabled, so noop
+        return np.zeros(num_agents)
+    radius = penalty_fall_off * arm + obstacles_radius[pairs[:, 1]]
+    penalties = (-max_penalty / radius) * pair_distances + max_penalty
+    penalties = np.maximum(penalties, 0.0)
+    penalties = np.bincount(pairs[:, 0], weights=penalties, minlength=num_agents)
+
+    return dt * penalties  # actual penalties per tick to be added to the overall reward
+
+
 def compute_col_norm_and_new_velocities(dyn1, dyn2):
     # Ge the collision normal, i.e difference in position
     collision_norm = dyn1.pos - dyn2.pos
@@ -327,6 +579,51 @@ def perform_collision_between_drones(dyn1, dyn2):
     dyn2.omega -= new_omega
 
 
+def perform_collisions_between_drones_batch(pos, vel, omega, pairs):
+    """
+    Same impulse model as perform_collision_between_drones, applied to all colliding pairs at once.
+    vel and omega (num_agents, 3) are updated in place. All impulses are computed from the velocities before the
+    collisions and summed, so a drone that appears in several pairs gets the response of every pair regardless of
+    their order.
+    :param pairs: (num_collisions, 2) drone ids
+    """
+    num_pairs = len(pairs)
+    if num_pairs == 0:
+        return
+    i, j = pairs[:, 0], pairs[:, 1]
+
+    collision_norm = pos[i] - pos[j]
+    coll_norm_mag = np.linalg.norm(collision_norm, axis=1, keepdims=True)
+    collision_norm /= np.where(coll_norm_mag == 0.0, 0.00001, coll_norm_mag)
+
+    v1new = np.sum(vel[i] * collision_norm, axis=1, keepdims=True)
+    v2new = np.sum(vel[j] * collision_norm, axis=1, keepdims=True)
+
+    # elastic response plus the momentum preserving and the non-preserving random components
+    cons_rand_val = np.random.normal(0, 0.8, (num_pairs, 3))
+    rand_val = np.random.normal(0, 0.15, (2, num_pairs, 3))
+    dvel1 = (v2new - v1new) * collision_norm + cons_rand_val + rand_val[0]
+    dvel2 = (v1new - v2new) * collision_norm - cons_rand_val + rand_val[1]
+
+    # Random forces for omega
+    omega_max = 20 * np.pi  # this will amount to max 3.5 revolutions per second
+    eps = 1e-5
+    new_omega = np.random.uniform(low=-1, high=1, size=(num_pairs, 3))  # random direction in 3D space
+    zero_dir = np.all(np.abs(new_omega) < eps, axis=1)
+    while zero_dir.any():
+        new_omega[zero_dir] = np.random.uniform(low=-1, high=1, size=(zero_dir.sum(), 3))
+        zero_dir = np.all(np.abs(new_omega) < eps, axis=1)
+
+    new_omega /= np.linalg.norm(new_omega, axis=1, keepdims=True) + eps  # normalize
+    new_omega *= np.random.uniform(low=omega_max / 2, high=omega_max, size=(num_pairs, 1))
+
+    np.add.at(vel, i, dvel1)
+    np.add.at(vel, j, dvel2)
+    # angular momentum is preserved
+    np.add.at(omega, i, new_omega)
+    np.add.at(omega, j, -new_omega)
+
+
 def perform_collision_with_obstacle(drone_dyn, obstacle_dyn, quad_arm):
     v1new, v2new, collision_norm = compute_col_norm_and_new_velocities(obstacle_dyn, drone_dyn)
     drone_dyn.vel += (v1new - v2new) * collision_norm
@@ -383,6 +680,45 @@ def perform_collision_with_obstacle_v2(drone_dyn, obstacle_dyn, quad_arm=0.046):
     drone_dyn.omega += new_omega
 
 
+class RunningStats:
+    """
+    Running count, sum, sum of squares, min and max of a fixed-shape quantity, updated in place every tick, so that
+    episode statistics do not require keeping the whole history. Used by QuadsRewardShapingWrapper for the action
+    stats and the per-drone reward sums.
+    """
+    def __init__(self, shape):
+        self.shape = (shape,) if np.isscalar(shape) else tuple(shape)
+        self.dim = self.shape[-1]
+        self.count = 0
+        self.sum = np.zeros(self.shape)
+        self.sq_sum = np.zeros(self.shape)
+        self.min = np.full(self.shape, np.inf)
+        self.max = np.full(self.shape, -np.inf)
+
+    def reset(self):
+        self.count = 0
+        self.sum[:] = 0.0
+        self.sq_sum[:] = 0.0
+        self.min[:] = np.inf
+        self.max[:] = -np.inf
+
+    def update(self, values):
+        """:param values: (..., *shape), all leading axes are reduced"""
+        values = np.asarray(values, dtype=np.float64).reshape((-1,) + self.shape)
+        self.count += len(values)
+        self.sum += values.sum(axis=0)
+        self.sq_sum += np.square(values).sum(axis=0)
+        np.minimum(self.min, values.min(axis=0), out=self.min)
+        np.maximum(self.max, values.max(axis=0), out=self.max)
+
+    def mean(self):
+        return self.sum / max(self.count, 1)
+
+    def std(self):
+        mean = self.mean()
+        return np.sqrt(np.maximum(self.sq_sum / max(self.count, 1) - mean * mean, 0.0))
+
+
 class OUNoise:
     """Ornstein–Uhlenbeck process"""
     def __init__(self, action_dimension, mu=0, theta=0.15, sigma=0.3, use_seed=False):
@@ -1,19 +1,30 @@
 import copy
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import time
 import gym
 
 from copy import deepcopy
-
-from gym_art.quadrotor_multi.quad_utils import perform_collision_between_drones, perform_collision_with_obstacle, \
-    calculate_collision_matrix, calculate_drone_proximity_penalties, calculate_obst_drone_proximity_penalties
+from gym import spaces
+
+from gym_art.quadrotor_multi.get_state import get_batched_state_func
+from gym_art.quadrotor_multi.quad_obs_layout import get_self_obs_dim, get_neighbor_obs_dim, make_obs_layout, \
+    obs_layout_size
+from gym_art.quadrotor_multi.quad_collision_log import CollisionEventLog, make_collision_log_path, EVENT_DRONE, \
+    EVENT_OBSTACLE, EVENT_FLOOR
+from gym_art.quadrotor_multi.quad_utils import perform_collisions_between_drones_batch, perform_collision_with_obstacle, \
+    calculate_collision_pairs, collision_bits_to_pairs, drone_pairs_within, calculate_room_contacts, CONTACT_GROUND, \
+    CONTACT_FLOOR, calculate_drone_proximity_penalties_sparse, calculate_obst_drone_proximity_penalties_sparse, \
+    rand_uniform_rot3d_batch, rot_z_batch, rng_state_size, get_rng_state, set_rng_state
 
 from gym_art.quadrotor_multi.quadrotor_multi_obstacles import MultiObstacles
-from gym_art.quadrotor_multi.quadrotor_single import GRAV, QuadrotorSingle
+from gym_art.quadrotor_multi.quadrotor_single import GRAV, EPS, QuadrotorSingle, compute_reward_weighted_batch, \
+    reward_info_dicts, REWARD_INFO_KEYS
 from gym_art.quadrotor_multi.quadrotor_multi_visualization import Quadrotor3DSceneMulti
 from gym_art.quadrotor_multi.quad_scenarios import create_scenario
+from gym_art.quadrotor_multi.quad_swarm_state import SwarmState
 from gym_art.quadrotor_multi.quad_obstacle_utils import OBSTACLES_SHAPE_LIST
 
 EPS = 1E-6
@@ -36,7 +47,10 @@ class QuadrotorEnvMulti(gym.Env):
                  collision_falloff_radius=2.0, collision_smooth_max_penalty=10.0,
                  local_metric='dist', local_coeff=0.0, use_replay_buffer=False,
                  obstacle_obs_mode='relative', obst_penalty_fall_off=10.0, vis_acc_arrows=False,
-                 viz_traces=25, viz_trace_nth_step=1):
+                 viz_traces=25, viz_trace_nth_step=1, obs_dtype='float32', obstacle_obs_num=-1,
+                 info_mode='dict', collision_ccd=False,
+                 obstacle_grid=False, collision_log_dir=None,
+                 precompute_goals=False, async_reset=False, stagger_resets=False):
 
         super().__init__()
 
@@ -47,6 +61,10 @@ class QuadrotorEnvMulti(gym.Env):
             self.num_use_neighbor_obs = self.num_agents - 1
         else:
             self.num_use_neighbor_obs = local_obs
+        if quads_obstacle_mode != 'no_obstacles' and quads_obstacle_num > 0:
+            assert obstacle_obs_num == -1 or 0 < obstacle_obs_num <= quads_obstacle_num, \
+                f'Invalid value ({obstacle_obs_num}) passed to --quads_obstacle_obs_num. Should be ' \
+                f'0 < n <= quads_obstacle_num ({quads_obstacle_num}), or -1'
 
         self.local_metric = local_metric
         self.local_coeff = local_coeff
@@ -67,10 +85,24 @@ class QuadrotorEnvMulti(gym.Env):
                 rew_coeff, sense_noise, verbose, gravity, t2w_std, t2t_std, excite, dynamics_simplification,
                 quads_use_numba, self.swarm_obs, self.num_agents, quads_settle, quads_settle_range_meters,
                 quads_vel_reward_out_range, quads_view_mode, quads_obstacle_mode, quads_obstacle_num,
-                self.num_use_neighbor_obs
+                self.num_use_neighbor_obs, obstacle_obs_num
             )
             self.envs.append(e)
 
+        # States of all drones are computed in one call from swarm arrays, if obs_repr has a batched version
+        self.batched_state_func = get_batched_state_func(obs_repr)
+        # the batched states draw the noise of all drones with one set of noise parameters
+        noise_params = self.envs[0].sense_noise.params()
+        if any(e.sense_noise.params() != noise_params for e in self.envs):
+            self.batched_state_func = None
+        self.swarm_state = SwarmState(self.num_agents)
+        self.room_contacts = np.zeros(self.num_agents, dtype=np.uint8)
+        for e in self.envs:
+            e.compute_state = self.batched_state_func is None
+            e.compute_reward = False
+            # floor and room box contacts of all drones are handled by calculate_room_contacts
+            e.compute_crash = False
+
         self.resample_goals = resample_goals
 
         # we don't actually create a scene object unless we want to render stuff
@@ -104,36 +136,33 @@ class QuadrotorEnvMulti(gym.Env):
         self.control_dt = 1.0 / self.control_freq
         self.pos = np.zeros([self.num_agents, 3])  # Matrix containing all positions
         self.quads_mode = quads_mode
-        if obs_repr == 'xyz_vxyz_R_omega':
-            obs_self_size = 18
-        elif obs_repr == 'xyz_vxyz_R_omega_wall':
-            obs_self_size = 24
-        else:
-            raise NotImplementedError(f'{obs_repr} not supported!')
-
-        if self.swarm_obs == 'pos_vel':
-            self.neighbor_obs_size = 6
-        elif self.swarm_obs == 'pos_vel_goals_ndist_gdist':
-            self.neighbor_obs_size = 11
-        elif self.swarm_obs == 'pos_vel_goals':
-            self.neighbor_obs_size = 9
-        elif self.swarm_obs == 'none':
-            self.neighbor_obs_size = 0
-        else:
-            raise NotImplementedError(f'Unknown value {self.swarm_obs} passed to --neighbor_obs_type')
+        obs_self_size = get_self_obs_dim(obs_repr)
+        self.neighbor_obs_size = get_neighbor_obs_dim(self.swarm_obs)
         self.clip_neighbor_space_length = self.num_use_neighbor_obs * self.neighbor_obs_size
         self.clip_neighbor_space_min_box = self.observation_space.low[obs_self_size:obs_self_size+self.clip_neighbor_space_length]
         self.clip_neighbor_space_max_box = self.observation_space.high[obs_self_size:obs_self_size+self.clip_neighbor_space_length]
 
+        # Observations can be emitted in half precision to halve the memory traffic between the sampler and the learner.
+        # The model decodes them back to float32 before the first linear layer (see QuadMultiEncoder)
+        self.obs_dtype = np.dtype(obs_dtype)
+        if self.obs_dtype not in (np.float32, np.float16):
+            raise NotImplementedError(f'{obs_dtype} is not supported for observations!')
+        if self.obs_dtype != np.float32:
+            self.observation_space = spaces.Box(
+                self.observation_space.low.astype(self.obs_dtype), self.observation_space.high.astype(self.obs_dtype),
+                dtype=self.obs_dtype,
+            )
+
         # Aux variables for rewards
         self.rews_settle = np.zeros(self.num_agents)
         self.rews_settle_raw = np.zeros(self.num_agents)
 
         # Aux variables for scenarios
-        self.scenario = create_scenario(quads_mode=quads_mode, envs=self.envs, num_agents=self.num_agents,
-                                        room_dims=self.room_dims, room_dims_callback=self.set_room_dims, rew_coeff=self.rew_coeff,
-                                        quads_formation=quads_formation, quads_formation_size=quads_formation_size)
+        self.quads_formation = quads_formation
         self.quads_formation_size = quads_formation_size
+        self.precompute_goals = precompute_goals
+        self.scenario = self.make_scenario()
+        self.scenario.reset_ep_len()
         self.goal_central = np.array([0., 0., 2.])
 
         # Set Obstacles
@@ -141,6 +170,22 @@ class QuadrotorEnvMulti(gym.Env):
         self.obstacle_mode = quads_obstacle_mode
         self.obstacle_num = quads_obstacle_num
         self.use_obstacles = self.obstacle_mode != 'no_obstacles' and self.obstacle_num > 0
+        # Number of obstacles in each drone's observation, -1 means all of them
+        self.obstacle_obs_num = obstacle_obs_num
+        if not self.use_obstacles:
+            self.num_obstacle_obs = 0
+        elif obstacle_obs_num == -1:
+            self.num_obstacle_obs = self.obstacle_num
+        else:
+            self.num_obstacle_obs = obstacle_obs_num
+
+        # Machine-readable description of the flat observation, consumers build views from it instead of slicing
+        self.obs_layout = make_obs_layout(
+            obs_repr=obs_repr, neighbor_obs_type=self.swarm_obs, num_use_neighbor_obs=self.num_use_neighbor_obs,
+            num_obstacle_obs=self.num_obstacle_obs, obstacle_obs_mask=obstacle_obs_num > 0, dtype=self.obs_dtype,
+        )
+        assert obs_layout_size(self.obs_layout) == self.observation_space.shape[0]
+
         if self.use_obstacles:
             obstacle_max_init_vel = 4.0 * self.envs[0].max_init_vel
             obstacle_init_box = self.envs[0].box  # box of env is: 2 meters
@@ -153,13 +198,26 @@ class QuadrotorEnvMulti(gym.Env):
             self.multi_obstacles = MultiObstacles(
                 mode=self.obstacle_mode, num_obstacles=self.obstacle_num, max_init_vel=obstacle_max_init_vel,
                 init_box=obstacle_init_box, dt=dt, quad_size=self.quad_arm, shape=self.obstacle_shape,
-                size=quads_obstacle_size, traj=obstacle_traj, obs_mode=obstacle_obs_mode
+                size=quads_obstacle_size, traj=obstacle_traj, obs_mode=obstacle_obs_mode, obs_top_k=obstacle_obs_num,
+                use_grid=obstacle_grid,
+                proximity_radius=(obst_penalty_fall_off or 0.0) * self.quad_arm,
             )
 
             # collisions between obstacles and quadrotors
             self.obst_quad_collisions_per_episode = 0
             self.prev_obst_quad_collisions = []
 
+        # Per-drone reward terms and flags of a step, as one structured array. With info_mode='dict' every info gets
+        # its 'rewards' dict built from it, with info_mode='array' infos carry views into the array instead
+        assert info_mode in ['dict', 'array'], f'Invalid value ({info_mode}) passed to info_mode'
+        self.info_mode = info_mode
+        self.rew_info_keys = REWARD_INFO_KEYS + ['rew_quadcol', 'rewraw_quadcol', 'rew_proximity']
+        if self.use_obstacles:
+            self.rew_info_keys += ['rew_quadcol_obstacle', 'rewraw_quadcol_obstacle', 'rew_obst_quad_proximity']
+        self.rew_info_keys += ['rew_quadsettle', 'rewraw_quadsettle']
+        self.rew_info_flags = ['crashed', 'drone_collision', 'obstacle_collision', 'ground_collision', 'room_contact']
+        self.rew_info_dtype = np.dtype([(key, np.float64) for key in self.rew_info_keys + self.rew_info_flags])
+
         # set render
         self.simulation_start_time = 0
         self.frames_since_last_render = self.render_skip_frames = 0
@@ -180,9 +238,17 @@ class QuadrotorEnvMulti(gym.Env):
         self.collision_falloff_radius = collision_falloff_radius
         self.collision_smooth_max_penalty = collision_smooth_max_penalty
 
-        self.prev_drone_collisions, self.curr_drone_collisions = [], []
+        # colliding pairs of the previous tick as a bitset (see calculate_collision_pairs), current ones as (K, 2) ids
+        self.prev_drone_collisions = np.zeros((self.num_agents * (self.num_agents - 1) // 2 + 7) // 8, dtype=np.uint8)
+        self.curr_drone_collisions = np.zeros((0, 2), dtype=np.int64)
         self.all_collisions = {}
         self.apply_collision_force = collision_force
+        # swept-sphere collision checks over each control interval instead of the post-step positions only
+        self.collision_ccd = collision_ccd
+        # optional binary log of every drone-drone, drone-obstacle and drone-floor collision, one file per env
+        self.collision_log = None
+        if collision_log_dir is not None:
+            self.collision_log = CollisionEventLog(make_collision_log_path(collision_log_dir))
 
         # set to true whenever we need to reset the OpenGL scene in render()
         self.reset_scene = False
@@ -193,10 +259,31 @@ class QuadrotorEnvMulti(gym.Env):
         self.use_replay_buffer = use_replay_buffer
         self.activate_replay_buffer = False  # only start using the buffer after the drones learn how to fly
         self.saved_in_replay_buffer = False  # since the same collisions happen during replay, we don't want to keep resaving the same event
-        self.last_step_unique_collisions = False
+        self.last_step_unique_collisions = np.zeros(0, dtype=np.int64)
         self.crashes_in_recent_episodes = deque([], maxlen=100)
         self.crashes_last_episode = 0
 
+        # Prepare the scenario, dynamics, spawn states and obstacle layout of the next episode in a background thread
+        # right after each reset, so that the reset on the done tick only swaps them in. The thread works on a second
+        # scenario and MultiObstacles instance, created on first use
+        assert not async_reset or self.envs[0].dim_mode == '3D', 'async_reset is only supported in 3D'
+        self.async_reset = async_reset
+        self.reset_executor = None
+        self.next_episode = None
+        self.next_scenario = None
+        self.next_multi_obstacles = None
+        self.reset_rng = None
+
+        # Cut the first episode at a random tick, so that the envs of a worker, all started at once with the same
+        # ep_time, reset on different ticks from then on
+        self.stagger_next_reset = stagger_resets
+
+    def make_scenario(self):
+        return create_scenario(quads_mode=self.quads_mode, envs=self.envs, num_agents=self.num_agents,
+                               room_dims=self.room_dims, room_dims_callback=self.set_room_dims, rew_coeff=self.rew_coeff,
+                               quads_formation=self.quads_formation, quads_formation_size=self.quads_formation_size,
+                               precompute_goals=self.precompute_goals)
+
     def set_room_dims(self, dims):
         # dims is a (x, y, z) tuple
         self.room_dims = dims
@@ -308,6 +395,23 @@ class QuadrotorEnvMulti(gym.Env):
         else:
             return obs
 
+    def batched_state(self):
+        return self.batched_state_func(self.swarm_state, [e.sense_noise for e in self.envs], self.envs[0].dt)
+
+    def batched_reward(self, out=None):
+        swarm, e = self.swarm_state, self.envs[0]
+        return compute_reward_weighted_batch(
+            pos=swarm.pos, vel=swarm.vel, rot=swarm.rot, omega=swarm.omega, goal=swarm.goal, action=swarm.actions[0],
+            action_prev=swarm.actions[1], dt=e.dt, crashed=swarm.crashed, rew_coeff=self.rew_coeff,
+            quads_settle=e.quads_settle, quads_settle_range_meters=e.quads_settle_range_meters,
+            quads_vel_reward_out_range=e.quads_vel_reward_out_range, out=out,
+        )
+
+    def cast_obs(self, obs):
+        if self.obs_dtype == np.float32:
+            return obs
+        return np.asarray(obs, dtype=self.obs_dtype)
+
     def can_drones_fly(self):
         """
         Here we count the average number of collisions with the walls and ground in the last N episodes
@@ -326,9 +430,131 @@ class QuadrotorEnvMulti(gym.Env):
             vis_acc_arrows=self.vis_acc_arrows, viz_traces=self.viz_traces, viz_trace_nth_step=self.viz_trace_nth_step,
         )
 
+    def reset_drones(self, initial_states=None, dynamics_params=None):
+        """
+        Reset all drones at once, the initial states are sampled as arrays and written to the drones and the swarm
+        state. Same distribution as QuadrotorSingle.reset in 3D.
+        :param initial_states: pos, vel, rot, omega sampled ahead of time by sample_initial_states
+        :param dynamics_params: per drone dynamics sampled ahead of time, used if the dynamics are randomized
+        :return: per drone observations, None entries if the drones don't compute their own
+        """
+        if dynamics_params is None:
+            dynamics_params = [None] * self.num_agents
+        for e, params in zip(self.envs, dynamics_params):
+            e.prepare_reset(dynamics_params=params)
+
+        goal = np.array([e.goal[:3] for e in self.envs])
+        if initial_states is None:
+            initial_states = self.sample_initial_states(goal, np.array([e.box for e in self.envs]))
+        pos, vel, rot, omega = initial_states
+
+        obs = [e.reset_state(pos[i], vel[i], rot[i], omega[i]) for i, e in enumerate(self.envs)]
+
+        swarm = self.swarm_state
+        swarm.pos[:], swarm.vel[:], swarm.rot[:], swarm.goal[:] = pos, vel, rot, goal
+        swarm.omega[:] = omega.astype(np.float32)
+        swarm.acc[:] = [0, 0, GRAV]
+        swarm.actions[:] = 0.0
+        swarm.crashed[:] = False
+        swarm.arm[:] = [e.dynamics.arm for e in self.envs]
+        swarm.room_box = self.envs[0].room_box
+        swarm.tick = 0
+        return obs
+
+    def sample_initial_states(self, goal, box, rng=None):
+        """
+        :param goal: (num_agents, 3) goals of the drones
+        :param box: (num_agents,) spawn box of each drone around its goal
+        :param rng: np.random.Generator to draw from, by default the positions come from the env's generator as in
+        QuadrotorSingle._reset and the rest from np.random
+        :return: pos, vel, rot, omega of all drones
+        """
+        e = self.envs[0]
+        pos_rng = e.np_random if rng is None else rng
+        rng = np.random if rng is None else rng
+        pos = pos_rng.uniform(-box[:, None], box[:, None], size=(self.num_agents, 3)) + goal
+        # Since being near the groud means crash we have to start above
+        pos[:, 2] = np.maximum(pos[:, 2], 0.25)
+
+        if e.init_random_state:
+            # random direction, uniform magnitude, as QuadrotorDynamics.random_state
+            vel = rng.uniform(low=-e.max_init_vel, high=e.max_init_vel, size=(self.num_agents, 3))
+            vel_magn = rng.uniform(low=0., high=e.max_init_vel, size=(self.num_agents, 1))
+            vel = vel_magn / (np.linalg.norm(vel, axis=1, keepdims=True) + EPS) * vel
+
+            omega = rng.uniform(low=-e.max_init_omega, high=e.max_init_omega, size=(self.num_agents, 3))
+            omega_magn = rng.uniform(low=0., high=e.max_init_omega, size=(self.num_agents, 1))
+            omega = omega_magn / (np.linalg.norm(omega, axis=1, keepdims=True) + EPS) * omega
+
+            rot = rand_uniform_rot3d_batch(self.num_agents, rng)
+        else:
+            vel, omega = np.zeros((self.num_agents, 3)), np.zeros((self.num_agents, 3))
+            # sort of pointing towards the goal: the yaw is within 60 degrees of the direction to the room center,
+            # which is what the randyaw rejection loop samples
+            yaw = np.arctan2(-pos[:, 1], -pos[:, 0]) + rng.uniform(-np.pi / 3, np.pi / 3, size=self.num_agents)
+            rot = rot_z_batch(yaw)
+
+        return pos, vel, rot, omega
+
+    def prepare_episode(self, randomize_dynamics, box):
+        """
+        Runs in the background thread, on the second scenario and MultiObstacles instance, and draws from its own
+        generator, reset_rng. The per-episode state of the envs it needs is read beforehand on the main thread and
+        passed in. The scenario still shares the envs with the current one, so scenario resets must not write env.goal.
+        :param randomize_dynamics: per drone, whether the dynamics are randomized in the prepared episode
+        :param box: (num_agents,) spawn box of each drone in the prepared episode
+        """
+        rng = self.reset_rng
+        scenario = self.next_scenario
+        scenario.reset(rng)
+        scenario.reset_goal_trajectory(rng)
+
+        dynamics_params = [e.sample_dynamics_params(rng) if randomize else None
+                           for e, randomize in zip(self.envs, randomize_dynamics)]
+        goal = np.array(scenario.goals[:self.num_agents])
+        initial_states = self.sample_initial_states(goal, box, rng)
+
+        if self.use_obstacles:
+            set_obstacles = np.full(self.obstacle_num, self.obstacle_mode == 'static')
+            self.next_multi_obstacles.reset_layout(set_obstacles=set_obstacles, formation_size=scenario.formation_size,
+                                                   goal_central=np.mean(scenario.goals, axis=0), rng=rng)
+        return initial_states, dynamics_params
+
+    def start_next_episode(self):
+        if self.reset_executor is None:
+            self.reset_executor = ThreadPoolExecutor(max_workers=1)
+            self.next_scenario = self.make_scenario()
+            self.next_multi_obstacles = copy.deepcopy(self.multi_obstacles)
+            if self.reset_rng is None:
+                # seeded from the envs, so that seeding them also seeds the episodes prepared in the background
+                self.reset_rng = np.random.default_rng(int(self.envs[0].np_random.uniform(0, 2 ** 32)))
+
+        # the episode is prepared while the current one runs, traj_count is only incremented when it ends
+        randomize_dynamics = [e.dynamics_randomization_due(episodes_ahead=1) for e in self.envs]
+        box = np.array([e.next_box() for e in self.envs])
+        self.next_episode = self.reset_executor.submit(self.prepare_episode, randomize_dynamics, box)
+
     def reset(self):
         obs, rewards, dones, infos = [], [], [], []
-        self.scenario.reset()
+        initial_states = dynamics_params = None
+        if self.next_episode is not None:
+            initial_states, dynamics_params = self.next_episode.result()
+            self.next_episode = None
+            self.scenario, self.next_scenario = self.next_scenario, self.scenario
+            self.multi_obstacles, self.next_multi_obstacles = self.next_multi_obstacles, self.multi_obstacles
+            self.scenario.reset_ep_len()
+        else:
+            self.scenario.reset()
+            self.scenario.reset_ep_len()
+            self.scenario.reset_goal_trajectory()
+
+        if self.stagger_next_reset:
+            self.stagger_next_reset = False
+            # np_random is a RandomState on older gym versions, without integers()
+            ep_len = int(self.envs[0].np_random.uniform(1, self.envs[0].ep_len + 1))
+            for e in self.envs:
+                e.ep_len = ep_len
+
         self.quads_formation_size = self.scenario.formation_size
         self.goal_central = np.mean(self.scenario.goals, axis=0)
 
@@ -348,35 +574,57 @@ class QuadrotorEnvMulti(gym.Env):
             e.rew_coeff = self.rew_coeff
             e.update_env(*self.room_dims)
 
-            observation = e.reset()
-            obs.append(observation)
+        if self.envs[0].dim_mode == '3D':
+            obs = self.reset_drones(initial_states=initial_states, dynamics_params=dynamics_params)
+        else:
+            obs = [e.reset() for e in self.envs]
+            self.swarm_state.gather(self.envs)
+        self.pos[:] = self.swarm_state.pos
+
+        if self.batched_state_func is not None:
+            obs = self.batched_state()
 
         # extend obs to see neighbors
         obs = self.add_neighborhood_obs(obs)
 
         # Reset Obstacles
         if self.use_obstacles:
-            self.set_obstacles = np.zeros(self.obstacle_num, dtype=bool)
+            # static obstacles are placed at reset and stay there for the whole episode
+            self.set_obstacles = np.full(self.obstacle_num, self.obstacle_mode == 'static')
             quads_pos = np.array([e.dynamics.pos for e in self.envs])
             quads_vel = np.array([e.dynamics.vel for e in self.envs])
-            obs = self.multi_obstacles.reset(obs=obs, quads_pos=quads_pos, quads_vel=quads_vel,
-                                             set_obstacles=self.set_obstacles, formation_size=self.quads_formation_size,
-                                             goal_central=self.goal_central)
+            if initial_states is None:
+                obs = self.multi_obstacles.reset(obs=obs, quads_pos=quads_pos, quads_vel=quads_vel,
+                                                 set_obstacles=self.set_obstacles,
+                                                 formation_size=self.quads_formation_size,
+                                                 goal_central=self.goal_central)
+            else:
+                # the layout was sampled along with the rest of the episode
+                obs = self.multi_obstacles.concat_obs(obs, quads_pos, quads_vel, self.set_obstacles)
             self.obst_quad_collisions_per_episode = 0
             self.prev_obst_quad_collisions = []
 
         self.all_collisions = {val: [0.0 for _ in range(len(self.envs))] for val in ['drone', 'ground', 'obstacle']}
 
         self.collisions_per_episode = self.collisions_after_settle = 0
-        self.prev_drone_collisions, self.curr_drone_collisions = [], []
+        self.prev_drone_collisions[:] = 0
+        self.curr_drone_collisions = np.zeros((0, 2), dtype=np.int64)
+
+        self.room_contacts = np.zeros(self.num_agents, dtype=np.uint8)
+        if self.collision_log is not None:
+            self.collision_log.new_episode()
 
         self.reset_scene = True
         self.crashes_last_episode = 0
-        return obs
+
+        if self.async_reset:
+            self.start_next_episode()
+        return self.cast_obs(obs)
 
     # noinspection PyTypeChecker
     def step(self, actions):
         obs, rewards, dones, infos = [], [], [], []
+        pos_prev = self.pos.copy() if self.collision_ccd else None
 
         for i, a in enumerate(actions):
             self.envs[i].rew_coeff = self.rew_coeff
@@ -389,34 +637,55 @@ class QuadrotorEnvMulti(gym.Env):
 
             self.pos[i, :] = self.envs[i].dynamics.pos
 
+        self.swarm_state.gather(self.envs)
+        prev_room_contacts = self.room_contacts
+        # CONTACT_* bitmask of every drone, reused by the rewards and stats
+        self.room_contacts, self.swarm_state.crashed[:] = calculate_room_contacts(
+            self.swarm_state.pos, self.swarm_state.room_box, self.swarm_state.arm)
+        if self.batched_state_func is not None:
+            obs = self.batched_state()
+
+        rew_info = np.zeros(self.num_agents, dtype=self.rew_info_dtype)
+        rewards, _ = self.batched_reward(out=rew_info)
+        # record views, writing a term through info['rewards'][key] updates rew_info
+        for i, info in enumerate(infos):
+            info['rewards'] = rew_info[i]
+
         obs = self.add_neighborhood_obs(obs)
 
         if self.use_replay_buffer and not self.activate_replay_buffer:
             self.crashes_last_episode += infos[0]["rewards"]["rew_crash"]
 
         # Calculating collisions between drones
-        drone_col_matrix, self.curr_drone_collisions, distance_matrix = calculate_collision_matrix(self.pos, self.quad_arm, self.collision_hitbox_radius)
+        drone_distances, curr_collision_bits = calculate_collision_pairs(
+            self.pos, self.quad_arm, self.collision_hitbox_radius, prev_positions=pos_prev)
+        self.curr_drone_collisions = collision_bits_to_pairs(curr_collision_bits, self.num_agents)
+        new_collisions = collision_bits_to_pairs(curr_collision_bits & ~self.prev_drone_collisions, self.num_agents)
 
-        self.last_step_unique_collisions = np.setdiff1d(self.curr_drone_collisions, self.prev_drone_collisions)
+        # ids of the drones involved in collisions that started this tick
+        self.last_step_unique_collisions = np.unique(new_collisions)
 
         # collision between 2 drones counts as a single collision
-        collisions_curr_tick = len(self.last_step_unique_collisions) // 2
+        collisions_curr_tick = len(new_collisions)
         self.collisions_per_episode += collisions_curr_tick
 
         if collisions_curr_tick > 0:
             if self.envs[0].tick >= self.collisions_grace_period_seconds * self.control_freq:
                 self.collisions_after_settle += collisions_curr_tick
 
-        self.prev_drone_collisions = self.curr_drone_collisions
+        self.prev_drone_collisions = curr_collision_bits
 
         rew_collisions_raw = np.zeros(self.num_agents)
-        if self.last_step_unique_collisions.any():
+        if len(self.last_step_unique_collisions) > 0:
             rew_collisions_raw[self.last_step_unique_collisions] = -1.0
         rew_collisions = self.rew_coeff["quadcol_bin"] * rew_collisions_raw
 
         # penalties for being too close to other drones
-        rew_proximity = -1.0 * calculate_drone_proximity_penalties(
-            distance_matrix=distance_matrix, arm=self.quad_arm, dt=self.control_dt,
+        # only the pairs within the fall-off radius are penalized
+        proximity_pairs, proximity_distances = drone_pairs_within(
+            drone_distances, (self.collision_falloff_radius or 0.0) * self.quad_arm, self.num_agents)
+        rew_proximity = -1.0 * calculate_drone_proximity_penalties_sparse(
+            pairs=proximity_pairs, pair_distances=proximity_distances, arm=self.quad_arm, dt=self.control_dt,
             penalty_fall_off=self.collision_falloff_radius,
             max_penalty=self.rew_coeff["quadcol_bin_smooth_max"],
             num_agents=self.num_agents,
@@ -424,14 +693,15 @@ class QuadrotorEnvMulti(gym.Env):
 
         # COLLISION BETWEEN QUAD AND OBSTACLE(S)
         if self.use_obstacles:
-            obst_quad_col_matrix, curr_obst_quad_collisions, curr_all_collisions, obst_quad_distance_matrix \
-                = self.multi_obstacles.collision_detection(pos_quads=self.pos, set_obstacles=self.set_obstacles)
+            curr_obst_quad_collisions, curr_all_collisions, obst_proximity_pairs, obst_proximity_distances \
+                = self.multi_obstacles.collision_detection(pos_quads=self.pos, set_obstacles=self.set_obstacles,
+                                                           pos_quads_prev=pos_prev)
             obst_quad_last_step_unique_collisions = np.setdiff1d(curr_obst_quad_collisions, self.prev_obst_quad_collisions)
             self.obst_quad_collisions_per_episode += len(obst_quad_last_step_unique_collisions)
             self.prev_obst_quad_collisions = curr_obst_quad_collisions
 
             rew_obst_quad_collisions_raw = np.zeros(self.num_agents)
-            if obst_quad_last_step_unique_collisions.any():
+            if len(obst_quad_last_step_unique_collisions) > 0:
                 # We assign penalties to the drones which collide with the obstacles
                 # And obst_quad_last_step_unique_collisions only include drones' id
                 rew_obst_quad_collisions_raw[obst_quad_last_step_unique_collisions] = -1.0
@@ -439,55 +709,84 @@ class QuadrotorEnvMulti(gym.Env):
             rew_collisions_obst_quad = self.rew_coeff["quadcol_bin_obst"] * rew_obst_quad_collisions_raw
 
             # penalties for low distance between obstacles and drones
-            obstacles_radius = np.stack([self.multi_obstacles.obstacles[i].size / 2 for i in range(self.obstacle_num)])
-            rew_obst_quad_proximity = -1.0 * calculate_obst_drone_proximity_penalties(
-                distance_matrix=obst_quad_distance_matrix, arm=self.quad_arm, dt=self.control_dt,
+            # only the pairs within the fall-off radius are penalized
+            obstacles_radius = self.multi_obstacles.size / 2
+            rew_obst_quad_proximity = -1.0 * calculate_obst_drone_proximity_penalties_sparse(
+                pairs=obst_proximity_pairs, pair_distances=obst_proximity_distances, arm=self.quad_arm,
+                dt=self.control_dt,
                 penalty_fall_off=self.obst_penalty_fall_off,
                 max_penalty=self.rew_coeff["quadcol_bin_obst_smooth_max"],
                 num_agents=self.num_agents,
                 obstacles_radius=obstacles_radius
             )
         else:
-            obst_quad_col_matrix = np.zeros((self.num_agents, self.obstacle_num))
+            curr_obst_quad_collisions = np.zeros(0, dtype=np.int64)
             curr_all_collisions = []
             rew_obst_quad_collisions_raw = np.zeros(self.num_agents)
             rew_collisions_obst_quad = np.zeros(self.num_agents)
             rew_obst_quad_proximity = np.zeros(self.num_agents)
 
         # Collisions with ground
-        ground_collisions = [1.0 if pos[2] < 0.25 else 0.0 for pos in self.pos]
+        ground_collisions = ((self.room_contacts & CONTACT_GROUND) > 0).astype(np.float64)
+
+        drone_collisions = np.bincount(self.curr_drone_collisions.ravel(), minlength=self.num_agents)
+        self.all_collisions = {'drone': drone_collisions, 'ground': ground_collisions,
+                               'obstacle': np.bincount(curr_obst_quad_collisions, minlength=self.num_agents)}
 
-        self.all_collisions = {'drone': np.sum(drone_col_matrix, axis=1), 'ground': ground_collisions,
-                               'obstacle': np.sum(obst_quad_col_matrix, axis=1)}
+        if self.collision_log is not None:
+            new_obst_collisions = np.zeros((0, 2), dtype=np.int64)
+            if self.use_obstacles and len(curr_all_collisions) > 0:
+                is_new = np.isin(curr_all_collisions[:, 0], obst_quad_last_step_unique_collisions)
+                new_obst_collisions = curr_all_collisions[is_new]
+            self.log_collisions(new_collisions, new_obst_collisions, prev_room_contacts)
 
         # Applying random forces for all collisions between drones and obstacles
         if self.apply_collision_force:
-            for val in self.curr_drone_collisions:
-                perform_collision_between_drones(self.envs[val[0]].dynamics, self.envs[val[1]].dynamics)
+            if len(self.curr_drone_collisions) > 0:
+                swarm = self.swarm_state
+                perform_collisions_between_drones_batch(
+                    pos=swarm.pos, vel=swarm.vel, omega=swarm.omega, pairs=self.curr_drone_collisions)
+                for i in np.unique(self.curr_drone_collisions):
+                    self.envs[i].dynamics.vel[:] = swarm.vel[i]
+                    self.envs[i].dynamics.omega[:] = swarm.omega[i]
             for val in curr_all_collisions:
                 perform_collision_with_obstacle(
                     drone_dyn=self.envs[val[0]].dynamics, obstacle_dyn=self.multi_obstacles.obstacles[val[1]],
                     quad_arm=self.quad_arm)
 
-        for i in range(self.num_agents):
-            rewards[i] += rew_collisions[i]
-            infos[i]["rewards"]["rew_quadcol"] = rew_collisions[i]
-            infos[i]["rewards"]["rewraw_quadcol"] = rew_collisions_raw[i]
+        rewards += rew_collisions + rew_proximity
+        rew_info['rew_quadcol'] = rew_collisions
+        rew_info['rewraw_quadcol'] = rew_collisions_raw
+        rew_info['rew_proximity'] = rew_proximity
 
-            rewards[i] += rew_proximity[i]
-            infos[i]["rewards"]["rew_proximity"] = rew_proximity[i]
-
-            if self.use_obstacles:
-                rewards[i] += rew_collisions_obst_quad[i]
-                infos[i]["rewards"]["rew_quadcol_obstacle"] = rew_collisions_obst_quad[i]
-                infos[i]["rewards"]["rewraw_quadcol_obstacle"] = rew_obst_quad_collisions_raw[i]
+        if self.use_obstacles:
+            rewards += rew_collisions_obst_quad + rew_obst_quad_proximity
+            rew_info['rew_quadcol_obstacle'] = rew_collisions_obst_quad
+            rew_info['rewraw_quadcol_obstacle'] = rew_obst_quad_collisions_raw
+            rew_info['rew_obst_quad_proximity'] = rew_obst_quad_proximity
 
-                rewards[i] += rew_obst_quad_proximity[i]
-                infos[i]["rewards"]["rew_obst_quad_proximity"] = rew_obst_quad_proximity[i]
+        rew_info['crashed'] = self.swarm_state.crashed
+        rew_info['drone_collision'] = self.all_collisions['drone'] > 0
+        rew_info['obstacle_collision'] = self.all_collisions['obstacle'] > 0
+        rew_info['ground_collision'] = ground_collisions
+        rew_info['room_contact'] = self.room_contacts
 
         # run the scenario passed to self.quads_mode
         infos, rewards = self.scenario.step(infos=infos, rewards=rewards, pos=self.pos)
 
+        if self.info_mode == 'dict':
+            # the scenario reports settle rewards only on the ticks it gives them, their raw value is > 0 then
+            settled = rew_info['rewraw_quadsettle'] != 0
+            for info, drone_rew_info, drone_settled in zip(infos, reward_info_dicts(rew_info[self.rew_info_keys]),
+                                                           settled):
+                if not drone_settled:
+                    del drone_rew_info['rew_quadsettle'], drone_rew_info['rewraw_quadsettle']
+                info['rewards'] = drone_rew_info
+        else:
+            for info in infos:
+                info['rewards_array'] = rew_info
+        rewards = list(rewards)
+
         # For obstacles
         quads_vel = np.array([e.dynamics.vel for e in self.envs])
 
@@ -498,33 +797,31 @@ class QuadrotorEnvMulti(gym.Env):
             # If there are still at least one obstacle flying in the air, we should check the function below
             # and reset the counter only if all obstacles hit the floor
             if self.set_obstacles.any():
-                for obst_i, obstacle in enumerate(self.multi_obstacles.obstacles):
-                    if not self.set_obstacles[obst_i]:
-                        continue
-
-                    if self.multi_obstacles.obstacles[obst_i].tmp_traj == "gravity":
-                        obstacle_pos = copy.deepcopy(obstacle.pos)
-                        obstacle_pos[2] = obstacle.pos[2] - obstacle.size / 2
-                        if not np.array_equal(obstacle_pos,
-                                              np.clip(obstacle_pos,
-                                                      a_min=self.obstacle_room[0],  # [-5, -5, 0]
-                                                      a_max=self.obstacle_room[1])):  # [5, 5, 10]
-                            self.set_obstacles[obst_i] = False
-                            self.quads_formation_size = self.scenario.formation_size
-                            self.goal_central = np.mean(self.scenario.goals, axis=0)
-                            obst_shape = obstacle.shape
-                            if self.obstacle_shape == 'random':
-                                obst_shape_id = np.random.randint(low=0, high=len(OBSTACLES_SHAPE_LIST))
-                                obst_shape = OBSTACLES_SHAPE_LIST[obst_shape_id]
-
-                            obstacle.reset(set_obstacle=False, formation_size=self.quads_formation_size,
-                                           goal_central=self.goal_central, shape=obst_shape, quads_pos=self.pos,
-                                           quads_vel=quads_vel)
-                    elif self.multi_obstacles.obstacles[obst_i].tmp_traj == "electron":
-                        tick = self.envs[0].tick
-                        control_step_for_sec = int(7.0 * self.control_freq)
-                        if tick % control_step_for_sec == 0 and tick > 0:
-                            self.set_obstacles[obst_i] = False
+                multi_obstacles = self.multi_obstacles
+                gravity = self.set_obstacles & ~multi_obstacles.is_electron
+                electron = self.set_obstacles & multi_obstacles.is_electron
+
+                obstacle_pos = multi_obstacles.pos.copy()
+                obstacle_pos[:, 2] -= multi_obstacles.size / 2
+                out_of_room = np.any((obstacle_pos < self.obstacle_room[0]) | (obstacle_pos > self.obstacle_room[1]),
+                                     axis=1)  # [-5, -5, 0], [5, 5, 10]
+                for obst_i in np.flatnonzero(gravity & out_of_room):
+                    self.set_obstacles[obst_i] = False
+                    self.quads_formation_size = self.scenario.formation_size
+                    self.goal_central = np.mean(self.scenario.goals, axis=0)
+                    obst_shape = multi_obstacles.obstacles[obst_i].shape
+                    if self.obstacle_shape == 'random':
+                        obst_shape_id = np.random.randint(low=0, high=len(OBSTACLES_SHAPE_LIST))
+                        obst_shape = OBSTACLES_SHAPE_LIST[obst_shape_id]
+
+                    multi_obstacles.reset_obstacle(obst_i, set_obstacle=False,
+                                                   formation_size=self.quads_formation_size,
+                                                   goal_central=self.goal_central, shape=obst_shape)
+
+                tick = self.envs[0].tick
+                control_step_for_sec = int(7.0 * self.control_freq)
+                if tick % control_step_for_sec == 0 and tick > 0:
+                    self.set_obstacles[electron] = False
 
 
             if not self.set_obstacles.all():
@@ -541,29 +838,64 @@ class QuadrotorEnvMulti(gym.Env):
                     self.reset_scene = True
 
             obs = tmp_obs
+        elif self.use_obstacles:
+            # static obstacles do not move, only their observations are updated
+            obs = self.multi_obstacles.step(obs=obs, quads_pos=self.pos, quads_vel=quads_vel,
+                                            set_obstacles=self.set_obstacles)
 
         # DONES
         if any(dones):
-            for i in range(len(infos)):
-                if self.saved_in_replay_buffer:
-                    infos[i]['episode_extra_stats'] = {
-                        'num_collisions_replay': self.collisions_per_episode,
-                    }
-                else:
-                    infos[i]['episode_extra_stats'] = {
-                        'num_collisions': self.collisions_per_episode,
-                        'num_collisions_after_settle': self.collisions_after_settle,
-                        f'num_collisions_{self.scenario.name()}': self.collisions_after_settle,
-                    }
-                    if self.use_obstacles:
-                        infos[i]['episode_extra_stats']['num_collisions_obst_quad'] = self.obst_quad_collisions_per_episode
-                        infos[i]['episode_extra_stats'][f'num_collisions_obst_{self.scenario.name()}'] = self.obst_quad_collisions_per_episode
+            # the stats are the same for all drones, build them once
+            if self.saved_in_replay_buffer:
+                episode_extra_stats = {
+                    'num_collisions_replay': self.collisions_per_episode,
+                }
+            else:
+                episode_extra_stats = {
+                    'num_collisions': self.collisions_per_episode,
+                    'num_collisions_after_settle': self.collisions_after_settle,
+                    f'num_collisions_{self.scenario.name()}': self.collisions_after_settle,
+                }
+                if self.use_obstacles:
+                    episode_extra_stats['num_collisions_obst_quad'] = self.obst_quad_collisions_per_episode
+                    episode_extra_stats[f'num_collisions_obst_{self.scenario.name()}'] = self.obst_quad_collisions_per_episode
+
+            # every drone gets its own copy, wrappers add per-drone stats to it
+            for info in infos:
+                info['episode_extra_stats'] = dict(episode_extra_stats)
 
             obs = self.reset()
             dones = [True] * len(dones)  # terminate the episode for all "sub-envs"
+        else:
+            obs = self.cast_obs(obs)
 
         return obs, rewards, dones, infos
 
+    def log_collisions(self, drone_pairs, obstacle_pairs, prev_room_contacts):
+        tick, swarm = self.envs[0].tick, self.swarm_state
+        log = self.collision_log
+
+        i, j = drone_pairs[:, 0], drone_pairs[:, 1]
+        log.log(tick, EVENT_DRONE, i, j, swarm.pos[i], swarm.pos[j], np.linalg.norm(swarm.vel[i] - swarm.vel[j], axis=1))
+
+        i, j = obstacle_pairs[:, 0], obstacle_pairs[:, 1]
+        if len(i) > 0:
+            obstacles = self.multi_obstacles
+            log.log(tick, EVENT_OBSTACLE, i, j, swarm.pos[i], obstacles.pos[j],
+                    np.linalg.norm(swarm.vel[i] - obstacles.vel[j], axis=1))
+
+        # drones that touched the floor this tick
+        i = np.flatnonzero(self.room_contacts & ~prev_room_contacts & CONTACT_FLOOR)
+        log.log(tick, EVENT_FLOOR, i, -1, swarm.pos[i], 0.0, np.linalg.norm(swarm.vel[i], axis=1))
+
+    def close(self):
+        if self.collision_log is not None:
+            self.collision_log.close()
+        if self.reset_executor is not None:
+            self.reset_executor.shutdown()
+            self.reset_executor = None
+            self.next_episode = None
+
     def render(self, mode='human', verbose=False):
         models = tuple(e.dynamics.model for e in self.envs)
 
@@ -640,6 +972,137 @@ class QuadrotorEnvMulti(gym.Env):
         if mode == "rgb_array":
             return frame
 
+    def state_fields(self):
+        """Name and shape of the fields of the flat state, in order, see get_state."""
+        n = self.num_agents
+        fields = [
+            ('pos', (n, 3)), ('vel', (n, 3)), ('rot', (n, 3, 3)), ('omega', (n, 3)), ('acc', (n, 3)),
+            ('accelerometer', (n, 3)), ('thrust_cmds_damp', (n, 4)), ('thrust_rot_damp', (n, 4)),
+            ('since_last_svd', (n,)), ('goal', (n, 3)), ('actions', (n, 2, 4)), ('crashed', (n,)),
+            ('room_contacts', (n,)), ('prev_drone_collisions', self.prev_drone_collisions.shape),
+            ('tick', ()), ('ep_len', ()), ('room_dims', (3,)), ('goal_central', (3,)), ('formation_size', ()),
+            ('collisions', (4,)), ('scenario_goals', (n, 3)), ('np_random', (n, rng_state_size(self.envs[0].np_random))),
+        ]
+        for name in sorted(self.swarm_state.history):
+            fields += [(f'history_{name}', self.swarm_state.history[name].buffer.shape), (f'history_head_{name}', ())]
+        if self.use_obstacles:
+            m = self.obstacle_num
+            fields += [
+                ('obstacle_pos', (m, 3)), ('obstacle_vel', (m, 3)), ('obstacle_size', (m,)), ('obstacle_shape', (m,)),
+                ('obstacle_is_electron', (m,)), ('obstacle_goal_central', (m, 3)), ('set_obstacles', (m,)),
+                ('prev_obst_quad_collisions', (n,)),
+            ]
+        return fields
+
+    def state_size(self):
+        return sum(int(np.prod(shape)) for _, shape in self.state_fields())
+
+    def state_views(self, state):
+        views, offset = dict(), 0
+        for name, shape in self.state_fields():
+            size = int(np.prod(shape))
+            views[name] = state[offset:offset + size].reshape(shape)
+            offset += size
+        return views
+
+    def get_state(self, out=None):
+        """
+        Snapshot of the mutable simulation state of an episode, restored by set_state. Much cheaper than a deepcopy
+        of the env, only the state that changes within an episode is copied. Noise processes are not part of it, nor
+        is the process-wide np.random, which the envs of a worker share.
+        :param out: float64 array of size state_size() to write the flat state to, allocated if None
+        :return: the flat state, and the episode state: the other scenario attributes and dynamics params by reference
+        """
+        state = np.empty(self.state_size()) if out is None else out
+        s = self.state_views(state)
+        for i, e in enumerate(self.envs):
+            d = e.dynamics
+            s['pos'][i], s['vel'][i], s['rot'][i], s['omega'][i] = d.pos, d.vel, d.rot, d.omega
+            s['acc'][i], s['accelerometer'][i] = d.acc, d.accelerometer
+            s['thrust_cmds_damp'][i], s['thrust_rot_damp'][i] = d.thrust_cmds_damp, d.thrust_rot_damp
+            s['since_last_svd'][i] = d.since_last_svd
+            s['goal'][i], s['actions'][i] = e.goal[:3], e.actions
+            get_rng_state(e.np_random, s['np_random'][i])
+
+        # QuadrotorSingle.crashed is not updated by the multi env (compute_crash=False), the swarm state holds the flags
+        s['crashed'][:] = self.swarm_state.crashed
+        s['room_contacts'][:] = self.room_contacts
+        s['prev_drone_collisions'][:] = self.prev_drone_collisions
+        s['tick'][...], s['ep_len'][...] = self.envs[0].tick, self.envs[0].ep_len
+        s['room_dims'][:], s['goal_central'][:] = self.room_dims, self.goal_central
+        s['formation_size'][...] = self.quads_formation_size
+        s['collisions'][:] = [self.collisions_per_episode, self.collisions_after_settle, self.crashes_last_episode,
+                              self.obst_quad_collisions_per_episode if self.use_obstacles else 0]
+        s['scenario_goals'][:] = self.scenario.goals
+
+        for name, hist in self.swarm_state.history.items():
+            s[f'history_{name}'][:], s[f'history_head_{name}'][...] = hist.buffer, hist.head
+
+        if self.use_obstacles:
+            obstacles = self.multi_obstacles
+            s['obstacle_pos'][:], s['obstacle_vel'][:] = obstacles.pos, obstacles.vel
+            s['obstacle_size'][:], s['obstacle_shape'][:] = obstacles.size, obstacles.shape_ids
+            s['obstacle_is_electron'][:], s['obstacle_goal_central'][:] = obstacles.is_electron, obstacles.goal_central
+            s['set_obstacles'][:] = self.set_obstacles
+            s['prev_obst_quad_collisions'][:] = 0.0
+            s['prev_obst_quad_collisions'][np.asarray(self.prev_obst_quad_collisions, dtype=np.int64)] = 1.0
+
+        episode_state = dict(scenario=self.scenario.get_state(),
+                             dynamics_params=[e.dynamics_params for e in self.envs])
+        return state, episode_state
+
+    def set_state(self, state, episode_state):
+        """Continue the episode from a snapshot taken by get_state, in place of the current one."""
+        s = self.state_views(state)
+        room_dims = tuple(s['room_dims'].tolist())
+        for i, e in enumerate(self.envs):
+            if e.dynamics_params is not episode_state['dynamics_params'][i]:
+                e.update_dynamics(dynamics_params=episode_state['dynamics_params'][i])
+            if room_dims != tuple(self.room_dims):
+                e.update_env(*room_dims)
+
+            d = e.dynamics
+            d.pos, d.vel, d.rot, d.omega = s['pos'][i].copy(), s['vel'][i].copy(), s['rot'][i].copy(), s['omega'][i].copy()
+            d.acc, d.accelerometer = s['acc'][i].copy(), s['accelerometer'][i].copy()
+            d.thrust_cmds_damp, d.thrust_rot_damp = s['thrust_cmds_damp'][i].copy(), s['thrust_rot_damp'][i].copy()
+            d.since_last_svd = float(s['since_last_svd'][i])
+            e.goal = s['goal'][i].copy()
+            e.actions = [s['actions'][i, 0].copy(), s['actions'][i, 1].copy()]
+            e.tick, e.ep_len = int(s['tick']), int(s['ep_len'])
+            set_rng_state(e.np_random, s['np_random'][i])
+        self.room_dims = room_dims
+
+        self.scenario.set_state(episode_state['scenario'], s['scenario_goals'])
+
+        swarm = self.swarm_state
+        swarm.gather(self.envs)
+        swarm.crashed[:] = s['crashed']
+        for name, hist in swarm.history.items():
+            hist.buffer[:], hist.head = s[f'history_{name}'], int(s[f'history_head_{name}'])
+        self.pos[:] = swarm.pos
+
+        self.room_contacts = s['room_contacts'].astype(np.uint8)
+        self.prev_drone_collisions = s['prev_drone_collisions'].astype(np.uint8)
+        self.curr_drone_collisions = collision_bits_to_pairs(self.prev_drone_collisions, self.num_agents)
+        self.last_step_unique_collisions = np.zeros(0, dtype=np.int64)
+        self.goal_central = s['goal_central'].copy()
+        self.quads_formation_size = float(s['formation_size'])
+        collisions = s['collisions']
+        self.collisions_per_episode, self.collisions_after_settle = int(collisions[0]), int(collisions[1])
+        self.crashes_last_episode = float(collisions[2])
+
+        if self.use_obstacles:
+            obstacles = self.multi_obstacles
+            obstacles.pos[:], obstacles.vel[:] = s['obstacle_pos'], s['obstacle_vel']
+            obstacles.size[:], obstacles.shape_ids[:] = s['obstacle_size'], s['obstacle_shape']
+            obstacles.is_electron[:], obstacles.goal_central[:] = s['obstacle_is_electron'], s['obstacle_goal_central']
+            self.set_obstacles = s['set_obstacles'].astype(bool)
+            obstacles.restore_layout(self.set_obstacles)
+            self.obst_quad_collisions_per_episode = int(collisions[3])
+            self.prev_obst_quad_collisions = np.flatnonzero(s['prev_obst_quad_collisions'])
+
+        self.reset_scene = True
+
     def __deepcopy__(self, memo):
         """OpenGL scene can't be copied naively."""
 
@@ -649,6 +1112,8 @@ class QuadrotorEnvMulti(gym.Env):
 
         # this will actually break the reward shaping functionality in PBT, but we need to fix it in SampleFactory, not here
         skip_copying = {"scene", "reward_shaping_interface"}
+        # the copy prepares its next episode in its own thread, the prepared one may still be in the making
+        skip_copying |= {"reset_executor", "next_episode", "next_scenario", "next_multi_obstacles", "reset_rng"}
 
         for k, v in self.__dict__.items():
             if k not in skip_copying:
@@ -657,5 +1122,7 @@ class QuadrotorEnvMulti(gym.Env):
         # warning! deep-copied env has its scene uninitialized! We gotta reuse one from the existing env
         # to avoid creating tons of windows
         copied_env.scene = None
+        copied_env.reset_executor = copied_env.next_episode = None
+        copied_env.next_scenario = copied_env.next_multi_obstacles = copied_env.reset_rng = None
 
         return copied_env
@@ -1,7 +1,8 @@
 import numpy as np
-from scipy import spatial
 
-from gym_art.quadrotor_multi.quadrotor_single_obstacle import SingleObstacle
+from gym_art.quadrotor_multi.quad_utils import segment_point_distance, segment_box_distance, rand_int
+from gym_art.quadrotor_multi.quad_obstacle_grid import ObstacleGrid
+from gym_art.quadrotor_multi.quadrotor_single_obstacle import SingleObstacle, GRAV
 from gym_art.quadrotor_multi.quad_obstacle_utils import OBSTACLES_SHAPE_LIST
 
 EPS = 1e-6
@@ -9,75 +10,231 @@ EPS = 1e-6
 
 class MultiObstacles:
     def __init__(self, mode='no_obstacles', num_obstacles=0, max_init_vel=1., init_box=2.0,
-                 dt=0.005, quad_size=0.046, shape='sphere', size=0.0, traj='gravity', obs_mode='relative'):
+                 dt=0.005, quad_size=0.046, shape='sphere', size=0.0, traj='gravity', obs_mode='relative',
+                 obs_top_k=-1, use_grid=False, proximity_radius=0.0):
         self.num_obstacles = num_obstacles
+        # -1: every drone observes all obstacles, k > 0: only the k nearest ones, followed by a validity mask
+        assert obs_top_k == -1 or 0 < obs_top_k <= num_obstacles, f'Invalid value ({obs_top_k}) passed to obs_top_k'
+        self.obs_top_k = obs_top_k
         self.obstacles = []
         self.shape = shape
         self.shape_list = OBSTACLES_SHAPE_LIST
+        self.dt = dt
+        self.quad_size = quad_size
+        self.obs_mode = obs_mode
+        self.mode = mode
+        # collision_detection lists the drone-obstacle pairs closer than proximity_radius + size / 2 (center distance),
+        # the only ones with a proximity penalty
+        self.proximity_radius = proximity_radius
+
+        # Collisions and proximity pairs of static layouts can come from an ObstacleGrid, baked once per layout
+        assert not use_grid or mode == 'static', 'The obstacle grid is only supported for static obstacles'
+        self.grid = ObstacleGrid() if use_grid else None
+
+        # State of all obstacles as (num_obstacles, ...) arrays, stepped and observed in batch. The pos and vel of
+        # SingleObstacle objects (used to sample initial states and by the visualization) are views into them
+        self.pos = np.zeros((num_obstacles, 3))
+        self.vel = np.zeros((num_obstacles, 3))
+        self.size = np.zeros(num_obstacles)
+        self.shape_ids = np.zeros(num_obstacles, dtype=np.int64)
+        self.is_electron = np.zeros(num_obstacles, dtype=bool)
+        self.goal_central = np.zeros((num_obstacles, 3))
 
         for _ in range(num_obstacles):
             obstacle = SingleObstacle(max_init_vel=max_init_vel, init_box=init_box, mode=mode, shape=shape, size=size,
                                       quad_size=quad_size, dt=dt, traj=traj, obs_mode=obs_mode)
             self.obstacles.append(obstacle)
+        self.bind_obstacles()
+
+    def __setstate__(self, state):
+        # copies (e.g. deepcopy in the replay buffer) do not preserve views, bind them again
+        self.__dict__.update(state)
+        self.bind_obstacles()
+
+    def bind_obstacles(self):
+        for i, obstacle in enumerate(self.obstacles):
+            obstacle.pos, obstacle.vel = self.pos[i], self.vel[i]
+
+    def reset_obstacle(self, i, set_obstacle=None, formation_size=0.0, goal_central=np.array([0., 0., 2.]),
+                       shape='sphere', rng=np.random):
+        obstacle = self.obstacles[i]
+        obstacle.sample(set_obstacle=set_obstacle, formation_size=formation_size, goal_central=goal_central,
+                        shape=shape, rng=rng)
+
+        self.pos[i], self.vel[i] = obstacle.pos, obstacle.vel
+        obstacle.pos, obstacle.vel = self.pos[i], self.vel[i]
+        self.size[i] = obstacle.size
+        self.shape_ids[i] = self.shape_list.index(obstacle.shape)
+        self.is_electron[i] = obstacle.tmp_traj == 'electron'
+        self.goal_central[i] = obstacle.goal_central
 
     def reset(self, obs=None, quads_pos=None, quads_vel=None, set_obstacles=None, formation_size=0.0, goal_central=np.array([0., 0., 2.])):
         if self.num_obstacles <= 0:
             return obs
+
+        self.reset_layout(set_obstacles=set_obstacles, formation_size=formation_size, goal_central=goal_central)
+        return self.concat_obs(obs, quads_pos, quads_vel, set_obstacles)
+
+    def reset_layout(self, set_obstacles=None, formation_size=0.0, goal_central=np.array([0., 0., 2.]), rng=np.random):
+        """Sample the obstacles of a new episode, reset() without the observations."""
         if set_obstacles is None:
             raise ValueError('set_obstacles is None')
 
         if self.shape == 'random':
-            shape_list = self.get_shape_list()
+            shape_list = self.get_shape_list(rng)
         else:
             shape_list = [self.shape for _ in range(self.num_obstacles)]
             shape_list = np.array(shape_list)
 
-        for i, obstacle in enumerate(self.obstacles):
-            obst_obs = obstacle.reset(set_obstacle=set_obstacles[i], formation_size=formation_size,
-                                      goal_central=goal_central, shape=shape_list[i], quads_pos=quads_pos,
-                                      quads_vel=quads_vel)
+        for i in range(self.num_obstacles):
+            self.reset_obstacle(i, set_obstacle=set_obstacles[i], formation_size=formation_size,
+                                goal_central=goal_central, shape=shape_list[i], rng=rng)
 
-            obs = np.concatenate((obs, obst_obs), axis=1)
+        if self.grid is not None:
+            self.bake_grid(set_obstacles)
 
-        return obs
+    def restore_layout(self, set_obstacles):
+        """Bring the SingleObstacle objects and the grid in line with the state arrays, after these were overwritten."""
+        for i, obstacle in enumerate(self.obstacles):
+            obstacle.shape = self.shape_list[self.shape_ids[i]]
+            obstacle.size = self.size[i]
+            obstacle.tmp_traj = 'electron' if self.is_electron[i] else 'gravity'
+            obstacle.goal_central = self.goal_central[i].copy()
+
+        if self.grid is not None:
+            self.bake_grid(set_obstacles)
 
     def step(self, obs=None, quads_pos=None, quads_vel=None, set_obstacles=None):
         if set_obstacles is None:
             raise ValueError('set_obstacles is None')
 
-        for i, obstacle in enumerate(self.obstacles):
-            obst_obs = obstacle.step(quads_pos=quads_pos, quads_vel=quads_vel, set_obstacle=set_obstacles[i])
-            obs = np.concatenate((obs, obst_obs), axis=1)
-
-        return obs
-
-    def collision_detection(self, pos_quads=None, set_obstacles=None):
+        moving = np.asarray(set_obstacles, dtype=bool) & (self.mode != 'static')
+        acc = np.zeros((self.num_obstacles, 3))
+        acc[:, 2] = -GRAV
+
+        # electron: mimic force between electrons, see SingleObstacle.step_electron
+        electron = moving & self.is_electron
+        if electron.any():
+            goal_central, pos = self.goal_central[electron], self.pos[electron]
+            force_pos = 2 * goal_central - pos
+            rel_force_goal = force_pos - goal_central
+            force_noise = np.random.uniform(low=-0.5 * rel_force_goal, high=0.5 * rel_force_goal)
+            acc[electron] = force_pos + force_noise - pos
+
+        self.vel[moving] += self.dt * acc[moving]
+        self.pos[moving] += self.dt * self.vel[moving]
+
+        return self.concat_obs(obs, quads_pos, quads_vel, set_obstacles)
+
+    def bake_grid(self, set_obstacles):
+        # Reach of the collisions (sphere or cube around its center, see collision_detection) and of the proximity
+        # pairs. Obstacles that are not set are left out
+        ids = np.flatnonzero(np.asarray(set_obstacles, dtype=bool))
+        reach = max(self.quad_size, self.proximity_radius) + 0.5 * np.sqrt(3) * self.size[ids] + EPS
+        self.grid.bake(ids, self.pos[ids], reach)
+
+    def get_obs(self, quads_pos, quads_vel, set_obstacles):
+        """
+        Observations of all obstacles by all drones, same as SingleObstacle.update_obs.
+        :return: (num_agents, num_obstacles, 10) rel_pos, rel_vel, size, shape
+        """
+        num_agents = len(quads_pos)
+        rel_pos = self.pos[None] - quads_pos[:, None]
+        rel_vel = self.vel[None] - quads_vel[:, None]
+        # obst_size: in xyz axis: radius for sphere, half edge length for cube
+        obst_size = np.broadcast_to((self.size / 2)[None, :, None], (num_agents, self.num_obstacles, 3)).copy()
+        obst_shape = np.broadcast_to(self.shape_ids[None, :, None], (num_agents, self.num_obstacles, 1)).astype(np.float64)
+
+        unset = ~np.asarray(set_obstacles, dtype=bool)
+        if self.obs_mode in ['absolute', 'half_relative'] and unset.any():
+            rel_pos[:, unset] = self.pos[unset]
+            rel_vel[:, unset] = self.vel[unset]
+            if self.obs_mode == 'absolute':
+                obst_size[:, unset] = 0.0
+                obst_shape[:, unset] = 0.0
+
+        return np.concatenate((rel_pos, rel_vel, obst_size, obst_shape), axis=2)
+
+    def concat_obs(self, obs, quads_pos, quads_vel, set_obstacles):
+        all_obst_obs = self.get_obs(quads_pos, quads_vel, set_obstacles)
+        if self.obs_top_k == -1:
+            return np.concatenate((obs, all_obst_obs.reshape(len(quads_pos), -1)), axis=1)
+
+        nearest_obs, mask = self.get_nearest_obs(all_obst_obs, quads_pos, set_obstacles)
+        nearest_obs = nearest_obs.reshape(len(quads_pos), -1)
+        return np.concatenate((obs, nearest_obs, mask), axis=1)
+
+    def get_nearest_obs(self, all_obst_obs, quads_pos, set_obstacles):
+        # all_obst_obs: (num_agents, num_obstacles, obst_obs_dim)
+        # Obstacles that are not set are not observed, their slots are zero-padded and masked out
+        dist = np.linalg.norm(quads_pos[:, None, :] - self.pos[None, :, :], axis=2)
+        dist[:, ~np.asarray(set_obstacles, dtype=bool)] = np.inf
+
+        k = self.obs_top_k
+        if k < self.num_obstacles:
+            nearest_ids = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        else:
+            nearest_ids = np.tile(np.arange(self.num_obstacles), (len(quads_pos), 1))
+        nearest_dist = np.take_along_axis(dist, nearest_ids, axis=1)
+        order = np.argsort(nearest_dist, axis=1, kind='stable')
+        nearest_ids = np.take_along_axis(nearest_ids, order, axis=1)
+        nearest_dist = np.take_along_axis(nearest_dist, order, axis=1)
+
+        nearest_obs = np.take_along_axis(all_obst_obs, nearest_ids[:, :, None], axis=1)
+        mask = np.isfinite(nearest_dist)
+        nearest_obs[~mask] = 0.0
+
+        return nearest_obs, mask.astype(nearest_obs.dtype)
+
+    def collision_detection(self, pos_quads=None, set_obstacles=None, pos_quads_prev=None):
+        """
+        :return: drone id of each collision, (K, 2) drone and obstacle ids of the collisions, (P, 2) drone and obstacle
+        ids of the pairs within proximity_radius of the obstacle surface and (P,) their center distances
+        """
         if set_obstacles is None:
             raise ValueError('set_obstacles is None')
 
-        # Shape: (num_agents, num_obstacles)
-        collision_matrix = np.zeros((len(pos_quads), self.num_obstacles))
+        num_agents = len(pos_quads)
+        if self.grid is not None and pos_quads_prev is None:
+            # only the obstacles within reach of each drone, a swept sphere can leave its cell
+            drone_ids, obst_ids = self.grid.candidates(pos_quads)
+        else:
+            drone_ids, obst_ids = np.divmod(np.arange(num_agents * self.num_obstacles), self.num_obstacles)
+
+        # Shape: (num_pairs,)
+        distances = np.linalg.norm(pos_quads[drone_ids] - self.pos[obst_ids], axis=1)
+        box_min = self.pos - 0.5 * self.size[:, None]
+        box_max = self.pos + 0.5 * self.size[:, None]
+        is_cube = self.shape_ids[obst_ids] == self.shape_list.index('cube')
+
+        # Sphere vs. sphere and sphere vs. AABB, see SingleObstacle.collision_detection
+        if pos_quads_prev is None:
+            sphere_dist = distances
+            if is_cube.any():
+                p, o = pos_quads[drone_ids[is_cube]], obst_ids[is_cube]
+                cube_dist = np.linalg.norm(np.clip(p, box_min[o], box_max[o]) - p, axis=1)
+        else:
+            sphere_dist = segment_point_distance(pos_quads_prev[drone_ids], pos_quads[drone_ids], self.pos[obst_ids])
+            if is_cube.any():
+                d, o = drone_ids[is_cube], obst_ids[is_cube]
+                cube_dist = segment_box_distance(pos_quads_prev[d], pos_quads[d], box_min[o], box_max[o])
 
-        for i, obstacle in enumerate(self.obstacles):
-            if set_obstacles[i]:
-                col_arr = obstacle.collision_detection(pos_quads=pos_quads)
-                collision_matrix[:, i] = col_arr
+        collisions = sphere_dist < (self.quad_size + 0.5 * self.size[obst_ids])
+        if is_cube.any():
+            collisions[is_cube] = cube_dist < self.quad_size
+        collisions &= np.asarray(set_obstacles, dtype=bool)[obst_ids]
 
         # check which drone collide with obstacle(s)
-        drone_collisions = []
-        all_collisions = []
-        col_w1 = np.where(collision_matrix >= 1)
-        for i, val in enumerate(col_w1[0]):
-            drone_collisions.append(col_w1[0][i])
-            all_collisions.append((col_w1[0][i], col_w1[1][i]))
+        drone_collisions = drone_ids[collisions]
+        all_collisions = np.stack([drone_ids[collisions], obst_ids[collisions]], axis=1)
 
-        obst_positions = np.stack([self.obstacles[i].pos for i in range(self.num_obstacles)])
-        distance_matrix = spatial.distance_matrix(x=pos_quads, y=obst_positions)
+        near = distances < self.proximity_radius + 0.5 * self.size[obst_ids]
+        proximity_pairs = np.stack([drone_ids[near], obst_ids[near]], axis=1)
 
-        return collision_matrix, drone_collisions, all_collisions, distance_matrix
+        return drone_collisions, all_collisions, proximity_pairs, distances[near]
 
-    def get_shape_list(self):
+    def get_shape_list(self, rng=np.random):
         all_shapes = np.array(self.shape_list)
-        shape_id_list = np.random.randint(low=0, high=len(all_shapes), size=self.num_obstacles)
+        shape_id_list = rand_int(low=0, high=len(all_shapes), size=self.num_obstacles, rng=rng)
         shape_list = all_shapes[shape_id_list]
         return shape_list
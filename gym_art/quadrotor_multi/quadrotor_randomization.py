@@ -72,7 +72,7 @@ def get_dyn_randomization_params(quad_params, noise_ratio=0., noise_ratio_params
     return noise_params
 
 
-def perturb_dyn_parameters(params, noise_params, sampler="normal"):
+def perturb_dyn_parameters(params, noise_params, sampler="normal", rng=np.random):
     """
     The function samples around nominal parameters provided noise parameters
     Args:
@@ -85,12 +85,12 @@ def perturb_dyn_parameters(params, noise_params, sampler="normal"):
     ## Sampling parameters
     def sample_normal(key, param_val, ratio):
         #2*ratio since 2std contain 98% of all samples
-        param_val_sample = np.random.normal(loc=param_val, scale=np.abs((ratio/2)*np.array(param_val)))
+        param_val_sample = rng.normal(loc=param_val, scale=np.abs((ratio/2)*np.array(param_val)))
         return param_val_sample, ratio
     
     def sample_uniform(key, param_val, ratio):
         param_val = np.array(param_val)
-        return np.random.uniform(low=param_val - param_val*ratio, high=param_val + param_val*ratio), ratio
+        return rng.uniform(low=param_val - param_val*ratio, high=param_val + param_val*ratio), ratio
 
     sample_param = locals()["sample_" + sampler]
 
@@ -103,7 +103,7 @@ def perturb_dyn_parameters(params, noise_params, sampler="normal"):
 
     return params_new
 
-def resample_dyn_parameters(params, noise_params, sampler="uniform"):
+def resample_dyn_parameters(params, noise_params, sampler="uniform", rng=np.random):
     """
     The function resamples dynamics parameters
     Args:
@@ -118,12 +118,12 @@ def resample_dyn_parameters(params, noise_params, sampler="uniform"):
         #2*ratio since 2std contain 98% of all samples
         mean = (min_max.min + min_max.max) / 2
         std = (min_max.max - min_max.min) / 4 # i.e. 2 * stds contain 98% of samples
-        return np.random.normal(
+        return rng.normal(
                 loc=mean, scale=std
             )
     
     def sample_uniform(key, param_val, min_max):
-        return np.random.uniform(
+        return rng.uniform(
             low=min_max.min * np.ones_like(param_val), 
             high=min_max.max * np.ones_like(param_val)
         )
@@ -139,7 +139,7 @@ def resample_dyn_parameters(params, noise_params, sampler="uniform"):
     return params_new
 
 
-def randomquad_parameters():
+def randomquad_parameters(rng=np.random):
     """
     The function samples parameters for all possible quadrotors
     Args:
@@ -152,7 +152,7 @@ def randomquad_parameters():
     # Crazyflie estimated body / payload / arms / motors / props density: 1388.9 / 1785.7 / 1777.8 / 1948.8 / 246.6 kg/m^3
     # Hummingbird estimated body / payload / arms / motors/ props density: 588.2 / 173.6 / 1111.1 / 509.3 / 246.6 kg/m^3
     geom_params = {}
-    dens_val = np.random.uniform(
+    dens_val = rng.uniform(
         low=[500., 200., 500., 500., 200.], 
         high=[2000., 2000., 2000., 4500., 300.])
     
@@ -165,39 +165,39 @@ def randomquad_parameters():
     ###################################################################
     ## GEOMETRIES
     # MOTORS (and overal size)
-    total_w = np.random.uniform(low=0.05, high=0.2)
-    total_l = np.clip(np.random.normal(loc=1., scale=0.1), a_min=1.0, a_max=None) * total_w
-    motor_z = np.random.normal(loc=0., scale=total_w / 8.)
+    total_w = rng.uniform(low=0.05, high=0.2)
+    total_l = np.clip(rng.normal(loc=1., scale=0.1), a_min=1.0, a_max=None) * total_w
+    motor_z = rng.normal(loc=0., scale=total_w / 8.)
     geom_params["motor_pos"] = {"xyz": [total_w / 2., total_l / 2., motor_z]}
-    geom_params["motors"]["r"] = total_w * np.random.normal(loc=0.1, scale=0.01)
-    geom_params["motors"]["h"] = geom_params["motors"]["r"] * np.random.normal(loc=1.0, scale=0.05)
+    geom_params["motors"]["r"] = total_w * rng.normal(loc=0.1, scale=0.01)
+    geom_params["motors"]["h"] = geom_params["motors"]["r"] * rng.normal(loc=1.0, scale=0.05)
     
     # BODY
     w_low, w_high = 0.25, 0.5
-    w_coeff = np.random.uniform(low=w_low, high=w_high)
+    w_coeff = rng.uniform(low=w_low, high=w_high)
     geom_params["body"]["w"] = w_coeff * total_w
     ## Promotes more elangeted bodies when they are more narrow
     l_scale = (1. - (w_coeff - w_low) / (w_high - w_low))
-    geom_params["body"]["l"] =  np.clip(np.random.normal(loc=1., scale=l_scale), a_min=1.0, a_max=None) * geom_params["body"]["w"]
-    geom_params["body"]["h"] =  np.random.uniform(low=0.1, high=1.5) * geom_params["body"]["w"]
+    geom_params["body"]["l"] =  np.clip(rng.normal(loc=1., scale=l_scale), a_min=1.0, a_max=None) * geom_params["body"]["w"]
+    geom_params["body"]["h"] =  rng.uniform(low=0.1, high=1.5) * geom_params["body"]["w"]
 
     # PAYLOAD
-    pl_scl = np.random.uniform(low=0.25, high=1.0, size=3)
+    pl_scl = rng.uniform(low=0.25, high=1.0, size=3)
     geom_params["payload"]["w"] =  pl_scl[0] * geom_params["body"]["w"]
     geom_params["payload"]["l"] =  pl_scl[1] * geom_params["body"]["l"]
     geom_params["payload"]["h"] =  pl_scl[2] * geom_params["body"]["h"]
     geom_params["payload_pos"] = {
-            "xy": np.random.normal(loc=0., scale=geom_params["body"]["w"] / 10., size=2), 
-            "z_sign": np.sign(np.random.uniform(low=-1, high=1))}
+            "xy": rng.normal(loc=0., scale=geom_params["body"]["w"] / 10., size=2), 
+            "z_sign": np.sign(rng.uniform(low=-1, high=1))}
     # z_sing corresponds to location (+1 - on top of the body, -1 - on the bottom of the body)
 
     # ARMS
-    geom_params["arms"]["w"] = total_w * np.random.normal(loc=0.05, scale=0.005)
-    geom_params["arms"]["h"] = total_w * np.random.normal(loc=0.05, scale=0.005)
-    geom_params["arms_pos"] = {"angle": np.random.normal(loc=45., scale=10.), "z": motor_z - geom_params["motors"]["h"]/2.}
+    geom_params["arms"]["w"] = total_w * rng.normal(loc=0.05, scale=0.005)
+    geom_params["arms"]["h"] = total_w * rng.normal(loc=0.05, scale=0.005)
+    geom_params["arms_pos"] = {"angle": rng.normal(loc=45., scale=10.), "z": motor_z - geom_params["motors"]["h"]/2.}
     
     # PROPS
-    thrust_to_weight = np.random.uniform(low=1.5, high=3.5)
+    thrust_to_weight = rng.uniform(low=1.5, high=3.5)
     # thrust_to_weight = np.random.uniform(low=1.8, high=2.5)
     geom_params["propellers"]["h"] = 0.01
     geom_params["propellers"]["r"] = (0.3) * total_w * (thrust_to_weight / 2.0)**0.5
@@ -214,14 +214,14 @@ def randomquad_parameters():
 
     ## Noise parameters
     noise_params = {}
-    noise_params["thrust_noise_ratio"] = np.random.uniform(low=0.01, high=0.05) #0.01
+    noise_params["thrust_noise_ratio"] = rng.uniform(low=0.01, high=0.05) #0.01
     
     ## Motor parameters
-    damp_time_up = np.random.uniform(low=0.15, high=0.2)
-    damp_time_down_scale = np.random.uniform(low=1.0, high=1.0)
+    damp_time_up = rng.uniform(low=0.15, high=0.2)
+    damp_time_down_scale = rng.uniform(low=1.0, high=1.0)
     motor_params = {"thrust_to_weight" : thrust_to_weight,
-                    "torque_to_thrust": np.random.uniform(low=0.005, high=0.025), #0.05 originally
-                    "assymetry": np.random.uniform(low=0.9, high=1.1, size=4),
+                    "torque_to_thrust": rng.uniform(low=0.005, high=0.025), #0.05 originally
+                    "assymetry": rng.uniform(low=0.9, high=1.1, size=4),
                     "linearity": 1.0,
                     "C_drag": 0.,
                     "C_roll": 0.,
@@ -327,20 +327,20 @@ def sample_simplified_random_dyn():
 
 
 class Crazyflie(object):
-    def sample(self, params=None):
+    def sample(self, params=None, rng=np.random):
         return crazyflie_params()
 
 class DefaultQuad(object):
-    def sample(self, params=None):
+    def sample(self, params=None, rng=np.random):
         return defaultquad_params()
 
 class MediumQuad(object):
-    def sample(self, params=None):
+    def sample(self, params=None, rng=np.random):
         return mediumquad_params()
 
 class RandomQuad(object):
-    def sample(self, params=None):
-        return randomquad_parameters()
+    def sample(self, params=None, rng=np.random):
+        return randomquad_parameters(rng)
 
 class RelativeSampler(object):
     def __init__(self, params, noise_ratio=0., noise_ratio_custom=None, sampler="normal"):
@@ -349,11 +349,12 @@ class RelativeSampler(object):
                         noise_ratio=noise_ratio, 
                         noise_ratio_params=noise_ratio_custom)
         self.sampler = sampler
-    def sample(self, params):
+    def sample(self, params, rng=np.random):
         return perturb_dyn_parameters(
             params=params, 
             noise_params=self.noise_params, 
-            sampler=self.sampler
+            sampler=self.sampler,
+            rng=rng
         )
 
 class AbsoluteSampler(object):
@@ -361,18 +362,19 @@ class AbsoluteSampler(object):
         self.noise_params = copy.deepcopy(noise_params)
         self.sampler = sampler
         
-    def sample(self, params):
+    def sample(self, params, rng=np.random):
         return resample_dyn_parameters(
             params=params, 
             noise_params=self.noise_params, 
-            sampler=self.sampler
+            sampler=self.sampler,
+            rng=rng
         )
 
 class ConstValueSampler(object):
     def __init__(self, params, params_change):
         self.params_change = copy.deepcopy(params_change)
         
-    def sample(self, params):
+    def sample(self, params, rng=np.random):
         dict_update_existing(params, dic_upd=self.params_change)
         return params
 
@@ -692,6 +692,97 @@ def compute_reward_weighted(dynamics, goal, action, dt, crashed, time_remain, re
     return reward, rew_info
 
 
+# keys of rew_info, in the order compute_reward_weighted reports them
+REWARD_INFO_KEYS = [
+    'rew_main', 'rew_pos', 'rew_action', 'rew_crash', 'rew_orient', 'rew_yaw', 'rew_rot', 'rew_attitude', 'rew_spin',
+    'rew_act_change', 'rew_vel',
+    'rewraw_main', 'rewraw_pos', 'rewraw_action', 'rewraw_crash', 'rewraw_orient', 'rewraw_yaw', 'rewraw_rot',
+    'rewraw_attitude', 'rewraw_spin', 'rewraw_act_change', 'rewraw_vel',
+]
+REWARD_INFO_DTYPE = np.dtype([(key, np.float64) for key in REWARD_INFO_KEYS])
+
+
+def compute_reward_weighted_batch(pos, vel, rot, omega, goal, action, action_prev, dt, crashed, rew_coeff,
+                                  quads_settle=False, quads_settle_range_meters=1.0, quads_vel_reward_out_range=0.8,
+                                  out=None):
+    """
+    Same as compute_reward_weighted, but for all drones at once from (num_agents, ...) arrays.
+    :param out: optional structured array (num_agents,) to write the reward terms into, its dtype must contain
+    the fields of REWARD_INFO_DTYPE
+    :return: rewards (num_agents,) and a structured array (num_agents,) of REWARD_INFO_DTYPE with every reward term
+    """
+    dist = np.linalg.norm(goal - pos, axis=1)
+    cost_pos_raw = dist
+    cost_pos = rew_coeff["pos"] * cost_pos_raw
+
+    # sphere of equal reward if drones are close to the goal position
+    vel_coeff = np.full(len(pos), rew_coeff["vel"])
+    if quads_settle:
+        settled = dist <= quads_settle_range_meters
+        cost_pos = np.where(settled, 0.0, cost_pos)
+        vel_coeff = np.where(settled, quads_vel_reward_out_range, vel_coeff)
+
+    cost_effort_raw = np.linalg.norm(action, axis=1)
+    cost_effort = rew_coeff["effort"] * cost_effort_raw
+
+    cost_act_change_raw = np.linalg.norm(action - action_prev, axis=1)
+    cost_act_change = rew_coeff["action_change"] * cost_act_change_raw
+
+    cost_vel_raw = np.linalg.norm(vel, axis=1)
+    cost_vel = vel_coeff * cost_vel_raw
+
+    cost_orient_raw = -rot[:, 2, 2]
+    cost_orient = rew_coeff["orient"] * cost_orient_raw
+
+    cost_yaw_raw = -rot[:, 0, 0]
+    cost_yaw = rew_coeff["yaw"] * cost_yaw_raw
+
+    rot_cos = (np.trace(rot, axis1=1, axis2=2) - 1.) / 2.
+    cost_rotation_raw = np.arccos(np.clip(rot_cos, -1., 1.))
+    cost_rotation = rew_coeff["rot"] * cost_rotation_raw
+
+    cost_attitude_raw = np.arccos(np.clip(rot[:, 2, 2], -1., 1.))
+    cost_attitude = rew_coeff["attitude"] * cost_attitude_raw
+
+    cost_spin_raw = np.linalg.norm(omega, axis=1)
+    cost_spin = rew_coeff["spin"] * cost_spin_raw
+
+    cost_crash_raw = np.asarray(crashed, dtype=np.float64)
+    cost_crash = rew_coeff["crash"] * cost_crash_raw
+
+    reward = -dt * (cost_pos + cost_effort + cost_crash + cost_orient + cost_yaw + cost_rotation + cost_attitude +
+                    cost_spin + cost_act_change + cost_vel)
+
+    rew_info = np.empty(len(pos), dtype=REWARD_INFO_DTYPE) if out is None else out
+    for name, cost, cost_raw in [
+        ('main', cost_pos, cost_pos_raw), ('pos', cost_pos, cost_pos_raw), ('action', cost_effort, cost_effort_raw),
+        ('crash', cost_crash, cost_crash_raw), ('orient', cost_orient, cost_orient_raw),
+        ('yaw', cost_yaw, cost_yaw_raw), ('rot', cost_rotation, cost_rotation_raw),
+        ('attitude', cost_attitude, cost_attitude_raw), ('spin', cost_spin, cost_spin_raw),
+        ('act_change', cost_act_change, cost_act_change_raw), ('vel', cost_vel, cost_vel_raw),
+    ]:
+        # report rewards in the same format as they are added to the actual agent's reward
+        rew_info['rew_' + name] = -dt * cost
+        rew_info['rewraw_' + name] = -dt * cost_raw
+
+    if not np.all(np.isfinite(reward)):
+        bad_ids = np.where(~np.isfinite(reward))[0]
+        for i in bad_ids:
+            print(f'drone {i}: pos {pos[i]}, vel {vel[i]}, rot {rot[i]}, omega {omega[i]}, action {action[i]} \n')
+        raise ValueError('QuadEnv: reward is Nan')
+
+    return reward, rew_info
+
+
+def reward_info_dicts(rew_info):
+    """
+    Per-drone rew_info dicts from a structured reward array, e.g. the one returned by compute_reward_weighted_batch
+    or info['rewards_array'] of QuadrotorEnvMulti with info_mode='array'.
+    """
+    names = rew_info.dtype.names
+    return [dict(zip(names, row)) for row in rew_info.tolist()]
+
+
 ####################################################################################################################################################################
 ## ENV
 # Gym environment for quadrotor seeking the origin with no obstacles and full state observations.
@@ -712,7 +803,8 @@ class QuadrotorSingle:
                  rew_coeff=None, sense_noise=None, verbose=False, gravity=GRAV,
                  t2w_std=0.005, t2t_std=0.0005, excite=False, dynamics_simplification=False, use_numba=False, swarm_obs='none', num_agents=1,quads_settle=False,
                  quads_settle_range_meters=1.0, quads_vel_reward_out_range=0.8,
-                 view_mode='local', obstacle_mode='no_obstacles', obstacle_num=0, num_use_neighbor_obs=0):
+                 view_mode='local', obstacle_mode='no_obstacles', obstacle_num=0, num_use_neighbor_obs=0,
+                 obstacle_obs_num=-1):
         np.seterr(under='ignore')
         """
         Args:
@@ -787,6 +879,10 @@ class QuadrotorSingle:
         self.room_box = np.array(
             [[-self.room_length/2, -self.room_width/2, 0], [self.room_length/2, self.room_width/2, self.room_height]]) # diagonal coordinates of box (?)
         self.state_vector = self.state_vector = getattr(get_state, "state_" + self.obs_repr)
+        # QuadrotorEnvMulti turns these off when it computes the states/rewards of all drones in one batched call
+        self.compute_state = True
+        self.compute_reward = True
+        self.compute_crash = True
 
         ## WARN: If you
         # size of the box from which initial position will be randomly sampled
@@ -805,6 +901,8 @@ class QuadrotorSingle:
         ## Obstacle Mode
         self.obstacle_mode = obstacle_mode
         self.obstacle_num = obstacle_num
+        # -1: observe all obstacles, k > 0: observe the k nearest obstacles plus a validity mask
+        self.obstacle_obs_num = obstacle_obs_num
 
         ###############################################################################
         ## DYNAMICS (and randomization)
@@ -983,6 +1081,7 @@ class QuadrotorSingle:
             "rovxyz": [-20.0 * np.ones(3), 20.0 * np.ones(3)], # rovxyz stands for relative velocity between quadrotor and obstacle
             "osize": [np.zeros(3), 20.0 * np.ones(3)],  # obstacle size, [[0., 0., 0.], [20., 20., 20.]]
             "otype": [np.zeros(1), 20.0 * np.ones(1)],  # obstacle type, [[0.], [20.]], which means we can support 21 types of obstacles
+            "omask": [np.zeros(1), np.ones(1)],  # whether the observed obstacle slot is valid
             "goal": [-room_range, room_range],
             "nbr_dist": [np.zeros(1), room_max_dist],
             "nbr_goal_dist": [np.zeros(1), room_max_dist],
@@ -999,7 +1098,11 @@ class QuadrotorSingle:
         elif self.swarm_obs == 'pos_vel_goals_ndist_gdist' and self.num_agents > 1:
             obs_comps = obs_comps + (['rxyz'] + ['rvxyz'] + ['goal'] + ['nbr_dist'] + ['nbr_goal_dist']) * self.num_use_neighbor_obs
         if self.obstacle_mode != 'no_obstacles' and self.obstacle_num > 0:
-            obs_comps = obs_comps + (['roxyz'] + ['rovxyz'] + ['osize'] + ['otype']) * self.obstacle_num
+            if self.obstacle_obs_num > 0:
+                obs_comps = obs_comps + (['roxyz'] + ['rovxyz'] + ['osize'] + ['otype']) * self.obstacle_obs_num
+                obs_comps = obs_comps + ['omask'] * self.obstacle_obs_num
+            else:
+                obs_comps = obs_comps + (['roxyz'] + ['rovxyz'] + ['osize'] + ['otype']) * self.obstacle_num
 
         print("Observation components:", obs_comps)
         obs_low, obs_high = [], []
@@ -1018,6 +1121,7 @@ class QuadrotorSingle:
             self.obs_comp_end.append(end_indx)
 
         self.observation_space = spaces.Box(obs_low, obs_high, dtype=np.float32)
+
         return self.observation_space
 
     def _seed(self, seed=None):
@@ -1042,28 +1146,30 @@ class QuadrotorSingle:
 
         if self.obstacles is not None:
             self.crashed = self.obstacles.detect_collision(self.dynamics)
-        else:
+        elif self.compute_crash:
             self.crashed = self.dynamics.pos[2] <= self.dynamics.arm
-        self.crashed = self.crashed or not np.array_equal(self.dynamics.pos,
-                                                          np.clip(self.dynamics.pos,
-                                                                  a_min=self.room_box[0],
-                                                                  a_max=self.room_box[1]))
+        if self.compute_crash:
+            self.crashed = self.crashed or not np.array_equal(self.dynamics.pos,
+                                                              np.clip(self.dynamics.pos,
+                                                                      a_min=self.room_box[0],
+                                                                      a_max=self.room_box[1]))
 
         self.time_remain = self.ep_len - self.tick
-        reward, rew_info = compute_reward_weighted(self.dynamics, self.goal, action, self.dt, self.crashed,
-                                                   self.time_remain,
-                                                   rew_coeff=self.rew_coeff, action_prev=self.actions[1], quads_settle=self.quads_settle,
-                                                   quads_settle_range_meters=self.quads_settle_range_meters,
-                                                   quads_vel_reward_out_range=self.quads_vel_reward_out_range
-        )
+        if self.compute_reward:
+            reward, rew_info = compute_reward_weighted(self.dynamics, self.goal, action, self.dt, self.crashed,
+                                                       self.time_remain,
+                                                       rew_coeff=self.rew_coeff, action_prev=self.actions[1], quads_settle=self.quads_settle,
+                                                       quads_settle_range_meters=self.quads_settle_range_meters,
+                                                       quads_vel_reward_out_range=self.quads_vel_reward_out_range
+            )
+        else:
+            reward, rew_info = None, None
         self.tick += 1
         done = self.tick > self.ep_len  # or self.crashed
-        sv = self.state_vector(self)
+        sv = self.state_vector(self) if self.compute_state else None
 
         self.traj_count += int(done)
 
-        ## TODO: OPTIMIZATION: sv_comp should be a dictionary formed when state() function is called
-        sv_comp = np.split(sv, self.obs_comp_end[:-1], axis=0)
         obs_comp = {
             "xyz": [self.dynamics.pos],
             "vxyz": [self.dynamics.vel],
@@ -1108,40 +1214,63 @@ class QuadrotorSingle:
             - Randomization dyring an episode is not supported
             - MUST call reset() after this function
         """
+        self.dynamics_params = self.sample_dynamics_params()
+
+        ## Updating params
+        self.update_dynamics(dynamics_params=self.dynamics_params)
+
+    def sample_dynamics_params(self, rng=np.random):
+        """Draw new dynamics params from np.random or a np.random.Generator, without applying them."""
         ## Getting base parameters (could also be random parameters)
-        self.dynamics_params = self.dyn_base_sampler.sample()
+        dynamics_params = self.dyn_base_sampler.sample(rng=rng)
 
         ## Now, updating if we are providing modifications
         if self.dynamics_change is not None:
-            dict_update_existing(self.dynamics_params, self.dynamics_change)
+            dict_update_existing(dynamics_params, self.dynamics_change)
 
         ## Applying sampler 1
         if self.dyn_sampler_1 is not None:
-            self.dynamics_params = self.dyn_sampler_1.sample(self.dynamics_params)
+            dynamics_params = self.dyn_sampler_1.sample(dynamics_params, rng=rng)
 
         ## Applying sampler 2
         if self.dyn_sampler_2 is not None:
-            self.dynamics_params = self.dyn_sampler_2.sample(self.dynamics_params)
+            dynamics_params = self.dyn_sampler_2.sample(dynamics_params, rng=rng)
 
         ## Checking that quad params make sense
-        quad_rand.check_quad_param_limits(self.dynamics_params)
-
-        ## Updating params
-        self.update_dynamics(dynamics_params=self.dynamics_params)
+        quad_rand.check_quad_param_limits(dynamics_params)
+        return dynamics_params
 
+    def dynamics_randomization_due(self, episodes_ahead=0):
+        """:param episodes_ahead: 0 for the episode started by the next reset, 1 for the one after it"""
+        return self.dynamics_randomize_every is not None and \
+            (self.traj_count + 1 + episodes_ahead) % (self.dynamics_randomize_every) == 0
 
-    def _reset(self):
+    def prepare_reset(self, dynamics_params=None):
+        """
+        :param dynamics_params: dynamics sampled ahead of time (see sample_dynamics_params) to use if the dynamics are
+        randomized this episode
+        """
         ## I have to update state vector 
         ##############################################################
         ## DYNAMICS RANDOMIZATION AND UPDATE       
-        if self.dynamics_randomize_every is not None and \
-                (self.traj_count + 1) % (self.dynamics_randomize_every) == 0:
-            self.resample_dynamics()
+        if self.dynamics_randomization_due():
+            if dynamics_params is None:
+                self.resample_dynamics()
+            else:
+                self.dynamics_params = dynamics_params
+                self.update_dynamics(dynamics_params=self.dynamics_params)
+
+        self.box = self.next_box()
 
+    def next_box(self):
         ## CURRICULUM (NOT REALLY NEEDED ANYMORE)
         # from 0.5 to 10 after 100k episodes (a form of curriculum)
         if self.box < 10:
-            self.box = self.box * self.box_scale
+            return self.box * self.box_scale
+        return self.box
+
+    def _reset(self):
+        self.prepare_reset()
         x, y, z = self.np_random.uniform(-self.box, self.box, size=(3,)) + self.goal
 
         if self.dim_mode == '1D':
@@ -1183,6 +1312,10 @@ class QuadrotorSingle:
                 while np.dot(rotation[:, 0], to_xyhat(-pos)) < 0.5:
                     rotation = randyaw()
 
+        return self.reset_state(pos, vel, rotation, omega)
+
+    def reset_state(self, pos, vel, rotation, omega):
+        """Start the episode from the given state, sampled by _reset or for all drones at once by the multi env."""
         # Setting the generated state
         # print("QuadEnv: init: pos/vel/rot/omega:", pos, vel, rotation, omega)
         self.init_state = [pos, vel, rotation, omega]
@@ -1194,7 +1327,7 @@ class QuadrotorSingle:
         self.tick = 0
         self.actions = [np.zeros([4, ]), np.zeros([4, ])]
 
-        state = self.state_vector(self)
+        state = self.state_vector(self) if self.compute_state else None
         return state
 
     def reset(self):
@@ -1,10 +1,12 @@
 import numpy as np
 
 from gym_art.quadrotor_multi.quad_obstacle_utils import OBSTACLES_SHAPE_LIST
+from gym_art.quadrotor_multi.quad_utils import segment_point_distance, segment_box_distance
 
 EPS = 1e-6
 GRAV = 9.81  # default gravitational constant
 TRAJ_LIST = ['gravity', 'electron']
+SIZE_RANGE = (0.15, 0.5)  # sphere: diameter, cube: edge length
 
 class SingleObstacle:
     def __init__(self, max_init_vel=1., init_box=2.0, mode='no_obstacles', shape='sphere', size=0.0, quad_size=0.04,
@@ -26,6 +28,13 @@ class SingleObstacle:
         self.obs_mode = obs_mode
 
     def reset(self, set_obstacle=None, formation_size=0.0, goal_central=np.array([0., 0., 2.]), shape='sphere', quads_pos=None, quads_vel=None):
+        self.sample(set_obstacle=set_obstacle, formation_size=formation_size, goal_central=goal_central, shape=shape)
+        obs = self.update_obs(quads_pos=quads_pos, quads_vel=quads_vel, set_obstacle=set_obstacle)
+        return obs
+
+    def sample(self, set_obstacle=None, formation_size=0.0, goal_central=np.array([0., 0., 2.]), shape='sphere',
+               rng=np.random):
+        # Draw the shape, size, trajectory and initial pos, vel of the obstacle, from np.random or a np.random.Generator
         if set_obstacle is None:
             raise ValueError('set_obstacle is None')
 
@@ -34,12 +43,13 @@ class SingleObstacle:
 
         # Reset shape and size
         self.shape = shape
-        self.size = np.random.uniform(low=0.15, high=0.5)
+        self.size = rng.uniform(low=SIZE_RANGE[0], high=SIZE_RANGE[1])
 
         if set_obstacle:
             if self.mode == 'static':
-                self.static_obstacle()
+                self.static_obstacle(rng)
             elif self.mode == 'dynamic':
+                # prepared episodes leave dynamic obstacles unset, these are only set on the main thread, from np.random
                 if self.traj == "mix":
                     traj_id = np.random.randint(low=0, high=len(TRAJ_LIST))
                     self.tmp_traj = TRAJ_LIST[traj_id]
@@ -64,11 +74,10 @@ class SingleObstacle:
             self.pos = np.array([5., 5., -5.])
             self.vel = np.array([0., 0., 0.])
 
-        obs = self.update_obs(quads_pos=quads_pos, quads_vel=quads_vel, set_obstacle=set_obstacle)
-        return obs
-
-    def static_obstacle(self):
-        pass
+    def static_obstacle(self, rng=np.random):
+        # Same placement as the electron obstacles, out of the space of goals, but at rest
+        self.dynamic_obstacle_electron(rng)
+        self.vel = np.zeros(3)
 
     def dynamic_obstacle_grav(self):
         # Init position for an obstacle
@@ -98,10 +107,10 @@ class SingleObstacle:
         # obstacle_vel = np.random.uniform(low=-self.max_init_vel, high=self.max_init_vel, size=(3,))
         self.vel = self.get_grav_init_vel()
 
-    def dynamic_obstacle_electron(self):
+    def dynamic_obstacle_electron(self, rng=np.random):
         # Init position for an obstacle
-        x, y = np.random.uniform(-self.init_box, self.init_box, size=(2,))
-        z = np.random.uniform(low=-0.5 * self.init_box, high=0.5 * self.init_box) + self.goal_central[2]
+        x, y = rng.uniform(-self.init_box, self.init_box, size=(2,))
+        z = rng.uniform(low=-0.5 * self.init_box, high=0.5 * self.init_box) + self.goal_central[2]
         z = max(self.size / 2 + 0.5, z)
 
         # Make the position of obstacles out of the space of goals
@@ -109,15 +118,15 @@ class SingleObstacle:
         rel_x = abs(x) - formation_range
         rel_y = abs(y) - formation_range
         if rel_x <= 0:
-            x += np.sign(x) * np.random.uniform(low=abs(rel_x) + 0.5,
-                                                high=abs(rel_x) + 1.0)
+            x += np.sign(x) * rng.uniform(low=abs(rel_x) + 0.5,
+                                          high=abs(rel_x) + 1.0)
         if rel_y <= 0:
-            y += np.sign(y) * np.random.uniform(low=abs(rel_y) + 0.5,
-                                                high=abs(rel_y) + 1.0)
+            y += np.sign(y) * rng.uniform(low=abs(rel_y) + 0.5,
+                                          high=abs(rel_y) + 1.0)
         self.pos = np.array([x, y, z])
 
         # Init velocity for an obstacle
-        self.vel = self.get_electron_init_vel()
+        self.vel = self.get_electron_init_vel(rng)
 
     def get_grav_init_vel(self):
         # Calculate the initial position of the obstacle, which can make it finally fly through the center of the
@@ -155,11 +164,11 @@ class SingleObstacle:
         vel = np.array([vx, vy, vz])
         return vel
 
-    def get_electron_init_vel(self):
+    def get_electron_init_vel(self, rng=np.random):
         vel_direct = self.goal_central - self.pos
-        vel_direct_noise = np.random.uniform(low=-0.1, high=0.1, size=(3,))
+        vel_direct_noise = rng.uniform(low=-0.1, high=0.1, size=(3,))
         vel_direct += vel_direct_noise
-        vel_magn = np.random.uniform(low=0., high=self.max_init_vel)
+        vel_magn = rng.uniform(low=0., high=self.max_init_vel)
         vel = vel_magn * vel_direct / (np.linalg.norm(vel_direct) + EPS)
         return vel
 
@@ -248,7 +257,10 @@ class SingleObstacle:
         collision_arr = (dist < (self.quad_size + 0.5 * self.size)).astype(np.float32)
         return collision_arr
 
-    def collision_detection(self, pos_quads=None):
+    def collision_detection(self, pos_quads=None, pos_quads_prev=None):
+        if pos_quads_prev is not None:
+            return self.swept_detection(pos_quads_prev, pos_quads)
+
         if self.shape == 'cube':
             collision_arr = self.cube_detection(pos_quads)
         elif self.shape == 'sphere':
@@ -257,3 +269,17 @@ class SingleObstacle:
             raise NotImplementedError()
 
         return collision_arr
+
+    def swept_detection(self, pos_quads_prev, pos_quads):
+        # Drones move along the segment pos_quads_prev -> pos_quads during the control interval, the obstacle is
+        # considered static over it. Sphere vs. swept sphere / AABB vs. swept sphere
+        if self.shape == 'cube':
+            dist = segment_box_distance(pos_quads_prev, pos_quads, self.pos - 0.5 * self.size, self.pos + 0.5 * self.size)
+            collision_arr = (dist < self.quad_size).astype(np.float32)
+        elif self.shape == 'sphere':
+            dist = segment_point_distance(pos_quads_prev, pos_quads, self.pos)
+            collision_arr = (dist < (self.quad_size + 0.5 * self.size)).astype(np.float32)
+        else:
+            raise NotImplementedError()
+
+        return collision_arr
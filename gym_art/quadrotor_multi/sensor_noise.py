@@ -232,6 +232,89 @@ class SensorNoise:
                                                                        3)  # + self.gyro_turn_on_bias_sigma * normal(0, 1, 3)
 
 
+    def params(self):
+        """Noise parameters, i.e. everything but the gyro bias."""
+        return {key: value for key, value in vars(self).items() if key != 'gyro_bias'}
+
+    def add_noise_to_omega_batch(self, omega, gyro_bias, dt):
+        """add_noise_to_omega() for all drones, gyro_bias: (num_agents, 3). Returns the noisy omega and the new bias."""
+        sigma_g_d = self.gyro_noise_density / (dt ** 0.5)
+        sigma_b_g_d = (-(sigma_g_d ** 2) * (self.gyro_bias_correlation_time / 2) * (
+                    exp(-2 * dt / self.gyro_bias_correlation_time) - 1)) ** 0.5
+        pi_g_d = exp(-dt / self.gyro_bias_correlation_time)
+
+        gyro_bias = pi_g_d * gyro_bias + sigma_b_g_d * normal(0, 1, omega.shape)
+        return omega + gyro_bias + self.gyro_random_walk * normal(0, 1, omega.shape), gyro_bias
+
+
+def add_noise_batch(sense_noises, pos, vel, rot, omega, acc, dt):
+    """
+    Same as SensorNoise.add_noise(), but for the whole swarm at once. Draws from np.random, also for drones that use
+    add_noise_numba() otherwise: same distribution, another random stream.
+    sense_noises: noise of each drone, all with the same params(). Each one keeps its own gyro bias.
+    pos, vel, omega, acc: (num_agents, 3), rot: (num_agents, 3, 3) rotation matrices
+    """
+    noise = sense_noises[0]
+    if noise.bypass:
+        return pos, vel, rot, omega, acc
+
+    num_agents = len(pos)
+    size = (num_agents, 3)
+
+    noisy_pos = pos + \
+                normal(loc=0., scale=noise.pos_norm_std, size=size) + \
+                uniform(low=-noise.pos_unif_range, high=noise.pos_unif_range, size=size)
+
+    noisy_vel = vel + \
+                normal(loc=0., scale=noise.vel_norm_std, size=size) + \
+                uniform(low=-noise.vel_unif_range, high=noise.vel_unif_range, size=size)
+
+    if noise.gyro_norm_std != 0.:
+        gyro_bias = np.stack([n.gyro_bias for n in sense_noises])
+        noisy_omega, gyro_bias = noise.add_noise_to_omega_batch(omega, gyro_bias, dt)
+        for n, bias in zip(sense_noises, gyro_bias):
+            n.gyro_bias = bias
+    else:
+        noisy_omega = omega + normal(loc=0., scale=noise.gyro_noise_density, size=size)
+
+    if noise.quat_norm_std != 0. or noise.quat_unif_range != 0.:
+        theta = normal(0, noise.quat_norm_std, size=size) + \
+                uniform(-noise.quat_unif_range, noise.quat_unif_range, size=size)
+        # with the quatXquat() convention, quatXquat(quat, quat_theta) is the rotation R(quat_theta) @ rot
+        noisy_rot = np.matmul(quat_to_rot_batch(quat_from_small_angle_batch(theta)), rot)
+    else:
+        noisy_rot = rot
+
+    noisy_acc = acc + normal(loc=0., scale=noise.acc_static_noise_std, size=size) + \
+                acc * normal(loc=0., scale=noise.acc_dynamic_noise_ratio, size=size)
+
+    return noisy_pos, noisy_vel, noisy_rot, noisy_omega, noisy_acc
+
+
+def quat_from_small_angle_batch(theta):
+    q_squared = np.sum(theta ** 2, axis=1) / 4.0
+    small = q_squared < 1
+    w = np.where(small, np.sqrt(np.maximum(1 - q_squared, 0.0)), 1.0 / np.sqrt(1 + q_squared))
+    f = np.where(small, 0.5, 0.5 * w)
+    q_theta = np.concatenate((w[:, None], theta * f[:, None]), axis=1)
+    return q_theta / np.linalg.norm(q_theta, axis=1, keepdims=True)
+
+
+def quat_to_rot_batch(quat):
+    qw, qx, qy, qz = quat[:, 0], quat[:, 1], quat[:, 2], quat[:, 3]
+    rot = np.empty((len(quat), 3, 3))
+    rot[:, 0, 0] = 1.0 - 2 * qy ** 2 - 2 * qz ** 2
+    rot[:, 0, 1] = 2 * qx * qy - 2 * qz * qw
+    rot[:, 0, 2] = 2 * qx * qz + 2 * qy * qw
+    rot[:, 1, 0] = 2 * qx * qy + 2 * qz * qw
+    rot[:, 1, 1] = 1.0 - 2 * qx ** 2 - 2 * qz ** 2
+    rot[:, 1, 2] = 2 * qy * qz - 2 * qx * qw
+    rot[:, 2, 0] = 2 * qx * qz - 2 * qy * qw
+    rot[:, 2, 1] = 2 * qy * qz + 2 * qx * qw
+    rot[:, 2, 2] = 1.0 - 2 * qx ** 2 - 2 * qy ** 2
+    return rot
+
+
 @njit
 def add_noise_to_vel_acc_pos_omega_rot(
         pos, vel, omega, acc, pos_rand_var, vel_rand_var, omega_rand_var,
@@ -0,0 +1,180 @@
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+import numpy as np
+
+from gym_art.quadrotor_multi.quad_collision_log import CollisionEventLog, read_collision_log, EVENT_DRONE, \
+    EVENT_FLOOR
+from gym_art.quadrotor_multi.quad_utils import calculate_collision_matrix, calculate_collision_pairs, \
+    collision_bits_to_pairs, perform_collisions_between_drones_batch, drone_pairs_within, \
+    calculate_drone_proximity_penalties, calculate_drone_proximity_penalties_sparse, \
+    calculate_obst_drone_proximity_penalties, calculate_obst_drone_proximity_penalties_sparse, segment_box_distance, \
+    calculate_room_contacts, CONTACT_FLOOR, CONTACT_CEILING, CONTACT_WALL, CONTACT_GROUND
+from gym_art.quadrotor_multi.quadrotor_single_obstacle import SingleObstacle
+
+
+class TestCollisionPairs(TestCase):
+    arm, hitbox_radius = 0.046, 2.0
+
+    def test_matches_collision_matrix(self):
+        for num_agents in [1, 2, 7, 64]:
+            pos = np.random.uniform(-0.3, 0.3, size=(num_agents, 3))
+            _, pairs_ref, dist_ref = calculate_collision_matrix(pos, self.arm, self.hitbox_radius)
+
+            dist, bits = calculate_collision_pairs(pos, self.arm, self.hitbox_radius)
+            pairs = collision_bits_to_pairs(bits, num_agents)
+            self.assertEqual([tuple(p) for p in pairs], [tuple(p) for p in pairs_ref])
+
+            i, j = np.triu_indices(num_agents, k=1)
+            self.assertTrue(np.allclose(dist, dist_ref[i, j]))
+
+    def test_sparse_proximity_penalties(self):
+        arm, dt, fall_off, max_penalty = self.arm, 0.01, 4.0, 10.0
+        for num_agents in [2, 7, 64]:
+            pos = np.random.uniform(-0.5, 0.5, size=(num_agents, 3))
+            _, _, dist_ref = calculate_collision_matrix(pos, arm, self.hitbox_radius)
+            dist, _ = calculate_collision_pairs(pos, arm, self.hitbox_radius)
+
+            pairs, pair_dist = drone_pairs_within(dist, fall_off * arm, num_agents)
+            penalties = calculate_drone_proximity_penalties_sparse(
+                pairs, pair_dist, arm, dt, fall_off, max_penalty, num_agents)
+            penalties_ref = calculate_drone_proximity_penalties(dist_ref, arm, dt, fall_off, max_penalty, num_agents)
+            self.assertTrue(np.allclose(penalties, penalties_ref))
+
+            obst_dist = np.random.uniform(0.0, 1.0, size=(num_agents, 5))
+            obst_radius = np.random.uniform(0.1, 0.25, size=5)
+            obst_pairs = np.argwhere(obst_dist < fall_off * arm + obst_radius)
+            penalties = calculate_obst_drone_proximity_penalties_sparse(
+                obst_pairs, obst_dist[obst_pairs[:, 0], obst_pairs[:, 1]], arm, dt, fall_off, max_penalty, num_agents,
+                obst_radius)
+            penalties_ref = calculate_obst_drone_proximity_penalties(
+                obst_dist, arm, dt, fall_off, max_penalty, num_agents, obst_radius)
+            self.assertTrue(np.allclose(penalties, penalties_ref))
+
+    def test_new_and_ongoing(self):
+        pos = np.array([[0.0, 0.0, 1.0], [0.05, 0.0, 1.0], [1.0, 0.0, 1.0], [3.0, 0.0, 1.0]])
+        _, prev = calculate_collision_pairs(pos, self.arm, self.hitbox_radius)
+
+        pos[2] = [0.0, 0.05, 1.0]
+        _, curr = calculate_collision_pairs(pos, self.arm, self.hitbox_radius)
+
+        self.assertEqual(collision_bits_to_pairs(curr & prev, 4).tolist(), [[0, 1]])
+        self.assertEqual(collision_bits_to_pairs(curr & ~prev, 4).tolist(), [[0, 2], [1, 2]])
+
+    def test_swept_collisions(self):
+        # the drones swap places within one control step, they are far apart at both ends of it
+        prev_pos = np.array([[0.0, 0.0, 1.0], [1.0, 0.0, 1.0], [0.0, 3.0, 1.0]])
+        pos = np.array([[1.0, 0.0, 1.0], [0.0, 0.0, 1.0], [0.0, 3.5, 1.0]])
+        _, bits = calculate_collision_pairs(pos, self.arm, self.hitbox_radius)
+        self.assertEqual(len(collision_bits_to_pairs(bits, 3)), 0)
+        dist, bits = calculate_collision_pairs(pos, self.arm, self.hitbox_radius, prev_positions=prev_pos)
+        self.assertEqual(collision_bits_to_pairs(bits, 3).tolist(), [[0, 1]])
+        self.assertAlmostEqual(dist[0], 1.0)
+
+        prev_pos = np.array([[-1.0, 0.0, 0.0], [-1.0, 1.0, 0.0]])
+        pos = np.array([[1.0, 0.0, 0.0], [1.0, 1.0, 0.0]])
+        for shape in ['sphere', 'cube']:
+            obstacle = SingleObstacle(shape=shape, size=0.2, quad_size=0.046)
+            obstacle.pos = np.zeros(3)
+            self.assertEqual(obstacle.collision_detection(pos).tolist(), [0.0, 0.0])
+            self.assertEqual(obstacle.collision_detection(pos, pos_quads_prev=prev_pos).tolist(), [1.0, 0.0], shape)
+
+        start, end = np.random.uniform(-1, 1, (100, 3)), np.random.uniform(-1, 1, (100, 3))
+        box_min, box_max = np.array([-0.2, -0.1, 0.0]), np.array([0.3, 0.1, 0.4])
+        t = np.linspace(0, 1, 2001)[None, :, None]
+        p = start[:, None] + t * (end - start)[:, None]
+        dist_ref = np.min(np.linalg.norm(p - np.clip(p, box_min, box_max), axis=2), axis=1)
+        self.assertTrue(np.allclose(segment_box_distance(start, end, box_min, box_max), dist_ref, atol=1e-3))
+
+    def test_room_contacts(self):
+        room_box = np.array([[-5., -5., 0.], [5., 5., 10.]])
+        pos = np.array([[0., 0., 2.], [0., 0., 0.01], [0., 0., 0.1], [5., 0., 2.], [0., 0., 10.], [0., 0., 10.5]])
+        contacts, crashed = calculate_room_contacts(pos, room_box, arm=0.046)
+        self.assertEqual(contacts.tolist(), [0, CONTACT_FLOOR | CONTACT_GROUND, CONTACT_GROUND, CONTACT_WALL,
+                                             CONTACT_CEILING, CONTACT_CEILING])
+        self.assertEqual(crashed.tolist(), [False, True, False, False, False, True])
+
+    def test_collision_response_batch(self):
+        pos = np.array([[0.0, 0.0, 1.0], [0.05, 0.0, 1.0], [0.1, 0.0, 1.0], [2.0, 0.0, 1.0]])
+        vel = np.zeros((4, 3))
+        omega = np.zeros((4, 3))
+        # drone 1 takes part in two collisions
+        pairs = np.array([[0, 1], [1, 2]])
+        perform_collisions_between_drones_batch(pos, vel, omega, pairs)
+
+        self.assertTrue(np.all(vel[3] == 0) and np.all(omega[3] == 0))
+        # omega disturbances cancel out within each pair, drone 1 gets both
+        self.assertTrue(np.allclose(omega.sum(axis=0), 0.0))
+        omega_max = 20 * np.pi
+        for drone in [0, 2]:
+            self.assertTrue(omega_max / 2 - 1e-3 <= np.linalg.norm(omega[drone]) <= omega_max)
+        self.assertTrue(np.allclose(omega[1], -omega[0] - omega[2]))
+
+    def test_collision_log(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            path = os.path.join(log_dir, 'collisions.bin')
+            log = CollisionEventLog(path, capacity=4)
+            log.new_episode()
+            pos = np.random.uniform(-1, 1, size=(6, 3))
+            log.log(3, EVENT_DRONE, np.array([0, 1]), np.array([2, 3]), pos[:2], pos[2:4], np.array([1.0, 2.0]))
+            log.new_episode()
+            # past the initial capacity
+            log.log(7, EVENT_FLOOR, np.arange(4), -1, pos[:4], 0.0, np.ones(4))
+            log.log(8, EVENT_FLOOR, np.zeros(0, dtype=np.int64), -1, np.zeros((0, 3)), 0.0, np.zeros(0))
+            log.close()
+
+            events = read_collision_log(path)
+            self.assertEqual(len(events), 6)
+            self.assertEqual(events['episode'].tolist(), [1, 1, 2, 2, 2, 2])
+            self.assertEqual(events['kind'].tolist(), [EVENT_DRONE] * 2 + [EVENT_FLOOR] * 4)
+            self.assertEqual(events['id2'].tolist(), [2, 3, -1, -1, -1, -1])
+            self.assertTrue(np.allclose(events['pos1'][2:], pos[:4]))
+            self.assertTrue(np.allclose(events['rel_speed'], [1.0, 2.0, 1.0, 1.0, 1.0, 1.0]))
+
+    def test_large_swarms(self):
+        rng = np.random.default_rng(0)
+        for num_agents in [256, 1024]:
+            # denser than in benchmark_collision_pairs, so that some pairs collide
+            pos = 0.2 * spread_positions(num_agents, rng)
+            _, pairs_ref, _ = calculate_collision_matrix(pos, self.arm, self.hitbox_radius)
+            _, bits = calculate_collision_pairs(pos, self.arm, self.hitbox_radius)
+            self.assertGreater(len(pairs_ref), 0)
+            self.assertEqual([tuple(p) for p in collision_bits_to_pairs(bits, num_agents)],
+                             [tuple(p) for p in pairs_ref])
+
+
+def spread_positions(num_agents, rng=np.random):
+    return rng.uniform(-num_agents ** (1 / 3), num_agents ** (1 / 3), size=(num_agents, 3))
+
+
+def benchmark_collision_pairs(arm=0.046, hitbox_radius=2.0):
+    """
+    Time per tick of calculate_collision_matrix and of calculate_collision_pairs with the tracking of new collisions.
+    Not part of the tests, run: python -m gym_art.quadrotor_multi.tests.test_collisions
+    """
+    calculate_collision_pairs(np.zeros((2, 3)), arm, hitbox_radius)  # compile
+
+    for num_agents in [8, 64, 256, 1024]:
+        pos = spread_positions(num_agents)
+        steps = max(10, 20000 // num_agents)
+
+        start = time.time()
+        for _ in range(steps):
+            calculate_collision_matrix(pos, arm, hitbox_radius)
+        elapsed_matrix = (time.time() - start) / steps
+
+        prev = np.zeros((num_agents * (num_agents - 1) // 2 + 7) // 8, dtype=np.uint8)
+        start = time.time()
+        for _ in range(steps):
+            _, curr = calculate_collision_pairs(pos, arm, hitbox_radius)
+            collision_bits_to_pairs(curr & ~prev, num_agents)
+            prev = curr
+        elapsed_pairs = (time.time() - start) / steps
+
+        print(f'N={num_agents}: matrix {elapsed_matrix * 1e3:.3f} ms, pairs {elapsed_pairs * 1e3:.3f} ms')
+
+
+if __name__ == '__main__':
+    benchmark_collision_pairs()
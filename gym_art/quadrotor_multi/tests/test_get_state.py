@@ -0,0 +1,71 @@
+from unittest import TestCase
+import numpy as np
+
+import gym_art.quadrotor_multi.get_state as get_state
+from gym_art.quadrotor_multi.get_state import StateHistory
+from gym_art.quadrotor_multi.sensor_noise import SensorNoise
+from gym_art.quadrotor_multi.tests.test_multi_env import create_env
+
+
+class TestBatchedState(TestCase):
+    def test_batched_matches_single(self):
+        num_agents = 4
+        env = create_env(num_agents, use_numba=False)
+        self.assertIsNotNone(env.batched_state_func)
+
+        env.reset()
+        for _ in range(10):
+            env.step([env.action_space.sample() for _ in range(num_agents)])
+
+        for e in env.envs:
+            e.sense_noise.bypass = True
+
+        for obs_repr in ['xyz_vxyz_R_omega', 'xyz_vxyz_R_omega_wall', 'xyzr_vxyzr_R_omega', 'xyz_vxyz_R_omega_act']:
+            env.batched_state_func = get_state.get_batched_state_func(obs_repr)
+            batched = env.batched_state()
+            single = np.stack([getattr(get_state, 'state_' + obs_repr)(e) for e in env.envs])
+            self.assertTrue(np.allclose(batched, single), obs_repr)
+
+        env.close()
+
+    def test_batched_noise(self):
+        num_agents = 4
+        env = create_env(num_agents, use_numba=False)
+        env.reset()
+        env.step([env.action_space.sample() for _ in range(num_agents)])
+
+        # the default noise has the same distribution as the per-drone noise
+        swarm, noise = env.swarm_state, env.envs[0].sense_noise
+        pos_noise = np.stack([env.batched_state()[:, :3] + swarm.goal - swarm.pos for _ in range(500)])
+        self.assertAlmostEqual(np.mean(pos_noise), 0.0, delta=0.1 * noise.pos_norm_std)
+        self.assertAlmostEqual(np.std(pos_noise), noise.pos_norm_std, delta=0.1 * noise.pos_norm_std)
+
+        # the gyro bias decays without random terms, so both paths are deterministic and each drone keeps its own bias
+        for i, e in enumerate(env.envs):
+            e.sense_noise = SensorNoise(pos_norm_std=0., vel_norm_std=0., gyro_norm_std=1., gyro_noise_density=0.,
+                                        gyro_random_walk=0., acc_static_noise_std=0., acc_dynamic_noise_ratio=0.)
+            e.sense_noise.gyro_bias = np.full(3, i + 1.0)
+        biases = [e.sense_noise.gyro_bias for e in env.envs]
+
+        batched = env.batched_state()
+        batched_biases = [e.sense_noise.gyro_bias for e in env.envs]
+        for e, bias in zip(env.envs, biases):
+            e.sense_noise.gyro_bias = bias
+        single = np.stack([get_state.state_xyz_vxyz_R_omega(e) for e in env.envs])
+
+        self.assertTrue(np.allclose(batched, single))
+        for e, bias in zip(env.envs, batched_biases):
+            self.assertTrue(np.allclose(bias, e.sense_noise.gyro_bias))
+        self.assertEqual(len(np.unique(np.stack(batched_biases)[:, 0])), num_agents)
+
+        env.close()
+
+    def test_state_history(self):
+        hist = StateHistory(length=3, num_agents=2, dim=1)
+        hist.reset(np.array([[1.], [10.]]))
+        self.assertTrue(np.array_equal(hist.get(), [[1., 0., 0.], [10., 0., 0.]]))
+
+        for value in [2., 3., 4.]:
+            hist.push(np.array([[value], [10. * value]]))
+        # newest value first, the oldest ones are overwritten
+        self.assertTrue(np.array_equal(hist.get(), [[4., 3., 2.], [40., 30., 20.]]))
@@ -1,14 +1,22 @@
+import copy
 import time
+from types import SimpleNamespace
 from unittest import TestCase
 import numpy as np
 
-from gym_art.quadrotor_multi.quad_experience_replay import ExperienceReplayWrapper
+from gym_art.quadrotor_multi.quad_experience_replay import ExperienceReplayWrapper, ReplayBuffer, SnapshotArray
+from gym_art.quadrotor_multi.quad_obs_layout import obs_component_view, obs_layout_size
+from gym_art.quadrotor_multi.quad_utils import RunningStats, rand_uniform_rot3d_batch, rng_state_size, get_rng_state, \
+    set_rng_state
 from gym_art.quadrotor_multi.quadrotor_multi import QuadrotorEnvMulti
+from gym_art.quadrotor_multi.quadrotor_single import compute_reward_weighted, compute_reward_weighted_batch
 
 
-def create_env(num_agents, use_numba=False, use_replay_buffer=False, episode_duration=7, local_obs=-1):
+def create_env(num_agents, use_numba=False, use_replay_buffer=False, episode_duration=7, local_obs=-1,
+               obs_dtype='float32', info_mode='dict', async_reset=False, stagger_resets=False,
+               dyn_randomize_every=None):
     quad = 'Crazyflie'
-    dyn_randomize_every = dyn_randomization_ratio = None
+    dyn_randomization_ratio = None
 
     episode_duration = episode_duration  # seconds
 
@@ -29,7 +37,8 @@ def create_env(num_agents, use_numba=False, use_replay_buffer=False, episode_dur
         sense_noise=sense_noise, init_random_state=True, ep_time=episode_duration, quads_use_numba=use_numba,
         use_replay_buffer=use_replay_buffer,
         swarm_obs="pos_vel_goals_ndist_gdist",
-        local_obs=local_obs,
+        local_obs=local_obs, obs_dtype=obs_dtype, info_mode=info_mode, async_reset=async_reset,
+        stagger_resets=stagger_resets,
     )
     return env
 
@@ -95,6 +104,338 @@ class TestMultiEnv(TestCase):
 
         env.close()
 
+    def test_half_precision_obs(self):
+        num_agents = 4
+        env = create_env(num_agents, use_numba=False, obs_dtype='float16')
+        self.assertEqual(env.observation_space.dtype, np.float16)
+
+        obs = env.reset()
+        self.assertEqual(obs.dtype, np.float16)
+        for _ in range(10):
+            obs, _, _, _ = env.step([env.action_space.sample() for _ in range(num_agents)])
+            self.assertEqual(obs.dtype, np.float16)
+            self.assertEqual(obs.shape[1], env.observation_space.shape[0])
+        env.close()
+
+        # quantization error must stay below the sensor noise we already inject into pos and vel
+        env = create_env(num_agents, use_numba=False)
+        sense_noise = env.envs[0].sense_noise
+        obs = env.reset()
+        for _ in range(100):
+            obs, _, _, _ = env.step([env.action_space.sample() for _ in range(num_agents)])
+            obs = np.asarray(obs, dtype=np.float32)
+            err = np.abs(obs.astype(np.float16).astype(np.float32) - obs)
+            self.assertLess(err[:, 0:3].max(), sense_noise.pos_norm_std)
+            self.assertLess(err[:, 3:6].max(), sense_noise.vel_norm_std)
+        env.close()
+
+    def test_obs_layout(self):
+        num_agents = 4
+        env = create_env(num_agents, use_numba=False, local_obs=2)
+        layout = env.obs_layout
+        self.assertEqual(list(layout.keys()), ['self', 'neighbors'])
+        self.assertEqual(layout['neighbors'].shape, (2, env.neighbor_obs_size))
+        self.assertEqual(obs_layout_size(layout), env.observation_space.shape[0])
+
+        obs = env.reset()
+        obs_self = obs_component_view(obs, layout['self'])
+        obs_neighbors = obs_component_view(obs, layout['neighbors'])
+        self.assertTrue(np.shares_memory(obs_neighbors, obs))
+
+        neighbors_start = layout['neighbors'].offset
+        self.assertTrue(np.array_equal(obs_self, obs[:, :neighbors_start]))
+        self.assertTrue(np.array_equal(
+            obs_neighbors, obs[:, neighbors_start:].reshape(num_agents, 2, env.neighbor_obs_size)
+        ))
+        env.close()
+
+    def test_nearest_obstacles_obs(self):
+        num_agents, num_obstacles, obstacle_obs_num = 4, 6, 2
+        env = QuadrotorEnvMulti(
+            num_agents=num_agents, dynamics_params='Crazyflie', sense_noise='default', init_random_state=True,
+            ep_time=7, swarm_obs='pos_vel', quads_obstacle_mode='dynamic', quads_obstacle_num=num_obstacles,
+            quads_obstacle_size=0.3, obstacle_obs_num=obstacle_obs_num,
+        )
+        layout = env.obs_layout
+        self.assertEqual(layout['obstacles'].shape, (obstacle_obs_num, 10))
+        self.assertEqual(layout['obstacles_mask'].shape, (obstacle_obs_num,))
+
+        # no obstacle is set right after reset, so every slot is padding
+        obs = env.reset()
+        self.assertEqual(obs.shape[1], env.observation_space.shape[0])
+        self.assertTrue(np.all(obs_component_view(obs, layout['obstacles_mask']) == 0.0))
+        self.assertTrue(np.all(obs_component_view(obs, layout['obstacles']) == 0.0))
+
+        obs, _, _, _ = env.step([env.action_space.sample() for _ in range(num_agents)])
+        obs_obstacles = obs_component_view(obs, layout['obstacles'])
+        mask = obs_component_view(obs, layout['obstacles_mask'])
+        self.assertTrue(np.all(mask == 1.0))
+
+        # relative positions of the observed obstacles are the closest ones, sorted by distance
+        obst_pos = np.stack([obstacle.pos for obstacle in env.multi_obstacles.obstacles])
+        dist = np.linalg.norm(env.pos[:, None, :] - obst_pos[None, :, :], axis=2)
+        expected = np.sort(dist, axis=1)[:, :obstacle_obs_num]
+        self.assertTrue(np.allclose(np.linalg.norm(obs_obstacles[:, :, :3], axis=2), expected))
+        env.close()
+
+        for obstacle_obs_num in [0, -2, num_obstacles + 1]:
+            with self.assertRaisesRegex(AssertionError, 'quads_obstacle_obs_num'):
+                QuadrotorEnvMulti(
+                    num_agents=num_agents, dynamics_params='Crazyflie', quads_obstacle_mode='dynamic',
+                    quads_obstacle_num=num_obstacles, obstacle_obs_num=obstacle_obs_num,
+                )
+
+    def test_batched_reward(self):
+        num_agents, dt = 8, 0.01
+        rng = np.random.default_rng(0)
+        # every term weighted, so that none of them is trivially zero
+        rew_coeff = dict(pos=1., effort=0.05, action_change=0.3, crash=1., orient=1., yaw=0.2, rot=0.4, attitude=0.5,
+                         spin=0.1, vel=0.6)
+
+        for trial in range(10):
+            pos, vel, omega = rng.uniform(-3, 3, size=(3, num_agents, 3))
+            goal = pos + rng.uniform(-1.5, 1.5, size=(num_agents, 3))
+            rot = rand_uniform_rot3d_batch(num_agents, rng)
+            action, action_prev = rng.uniform(-1, 1, size=(2, num_agents, 4))
+            crashed = rng.uniform(size=num_agents) < 0.3
+            quads_settle = trial % 2 == 1
+
+            rewards, rew_info = compute_reward_weighted_batch(
+                pos=pos, vel=vel, rot=rot, omega=omega, goal=goal, action=action, action_prev=action_prev, dt=dt,
+                crashed=crashed, rew_coeff=rew_coeff, quads_settle=quads_settle,
+            )
+            for i in range(num_agents):
+                dynamics = SimpleNamespace(pos=pos[i], vel=vel[i], rot=rot[i], omega=omega[i])
+                reward, drone_rew_info = compute_reward_weighted(
+                    dynamics, goal[i], action[i], dt, crashed[i], time_remain=0, rew_coeff=rew_coeff,
+                    action_prev=action_prev[i], quads_settle=quads_settle,
+                )
+                self.assertAlmostEqual(rewards[i], reward)
+                self.assertEqual(set(drone_rew_info.keys()), set(rew_info.dtype.names))
+                for key, value in drone_rew_info.items():
+                    self.assertAlmostEqual(rew_info[key][i], value, msg=key)
+
+    def test_info_array(self):
+        num_agents = 4
+        env = create_env(num_agents, use_numba=False)
+        env.reset()
+        _, _, _, infos = env.step([env.action_space.sample() for _ in range(num_agents)])
+        settle_keys = ['rew_quadsettle', 'rewraw_quadsettle']
+        self.assertEqual(list(infos[0]['rewards'].keys()), [key for key in env.rew_info_keys if key not in settle_keys])
+
+        # settle rewards are only reported by the drones that get them, as in circular_config
+        scenario_step = env.scenario.step
+
+        def settle_step(infos, rewards, pos):
+            infos[0]['rewards']['rew_quadsettle'], infos[0]['rewards']['rewraw_quadsettle'] = 0.5, 100
+            return scenario_step(infos=infos, rewards=rewards, pos=pos)
+
+        env.scenario.step = settle_step
+        _, _, _, infos = env.step([env.action_space.sample() for _ in range(num_agents)])
+        self.assertEqual(list(infos[0]['rewards'].keys()), env.rew_info_keys)
+        self.assertEqual(infos[0]['rewards']['rewraw_quadsettle'], 100)
+        self.assertNotIn('rew_quadsettle', infos[1]['rewards'])
+        env.close()
+
+        env = create_env(num_agents, use_numba=False, info_mode='array')
+        env.reset()
+        for _ in range(20):
+            _, rewards, _, infos = env.step([env.action_space.sample() for _ in range(num_agents)])
+
+        rew_array = infos[0]['rewards_array']
+        rew_terms = [key for key in env.rew_info_keys if key.startswith('rew_') and key != 'rew_main']
+        self.assertEqual(rew_array.dtype, env.rew_info_dtype)
+        self.assertEqual(len(rew_array), num_agents)
+        for i, info in enumerate(infos):
+            self.assertIs(info['rewards_array'], rew_array)
+            self.assertEqual(rew_array['crashed'][i], env.swarm_state.crashed[i])
+            self.assertAlmostEqual(rewards[i], sum(rew_array[key][i] for key in rew_terms))
+        env.close()
+
+    def test_batch_reset(self):
+        num_agents = 32
+        env = create_env(num_agents, use_numba=False)
+        for init_random_state in [True, False]:
+            for e in env.envs:
+                e.init_random_state = init_random_state
+            env.reset()
+
+            swarm_state = copy.deepcopy(env.swarm_state)
+            env.swarm_state.gather(env.envs)
+            for key in ['pos', 'vel', 'rot', 'omega', 'acc', 'goal', 'actions', 'crashed', 'arm']:
+                self.assertTrue(np.allclose(getattr(swarm_state, key), getattr(env.swarm_state, key)), key)
+
+            pos, rot = swarm_state.pos, swarm_state.rot
+            self.assertTrue(np.all(np.abs(pos[:, :2] - swarm_state.goal[:, :2]) <= env.envs[0].box))
+            self.assertTrue(np.all(pos[:, 2] >= 0.25))
+            self.assertTrue(np.allclose(rot @ rot.transpose(0, 2, 1), np.eye(3)))
+            self.assertTrue(np.allclose(np.linalg.det(rot), 1.0))
+            if not init_random_state:
+                # facing the room center
+                to_center = -pos[:, :2] / np.linalg.norm(pos[:, :2], axis=1, keepdims=True)
+                self.assertTrue(np.all(np.sum(rot[:, :2, 0] * to_center, axis=1) >= 0.5 - 1e-9))
+                self.assertTrue(np.all(swarm_state.vel == 0.0))
+            else:
+                self.assertTrue(np.all(np.linalg.norm(swarm_state.vel, axis=1) <= env.envs[0].max_init_vel))
+        env.close()
+
+    def test_async_reset(self):
+        num_agents = 8
+        env = create_env(num_agents, async_reset=True)
+        env.reset()
+        for episode in range(3):
+            self.assertIsNotNone(env.next_episode)
+            if episode == 1:
+                env_copy = copy.deepcopy(env)
+                self.assertIsNone(env_copy.next_episode)
+                env_copy.reset()
+                self.assertIsNotNone(env_copy.next_episode)
+                env_copy.close()
+
+            scenario = env.scenario
+            for _ in range(env.envs[0].ep_len + 1):
+                obs, rewards, dones, infos = env.step([env.action_space.sample() for _ in range(num_agents)])
+                if all(dones):
+                    break
+            self.assertTrue(all(dones))
+            self.assertIsNot(env.scenario, scenario)
+
+            # the prepared episode is swapped in, the drones spawn around the prepared goals
+            pos = env.swarm_state.pos
+            self.assertTrue(np.allclose(env.swarm_state.goal, np.array(env.scenario.goals)[:num_agents]))
+            self.assertTrue(np.all(np.abs(pos[:, :2] - env.swarm_state.goal[:, :2]) <= env.envs[0].box))
+            self.assertEqual(env.envs[0].tick, 0)
+            self.assertEqual(obs.shape[0], num_agents)
+        env.close()
+        self.assertIsNone(env.reset_executor)
+
+    def test_async_reset_rng(self):
+        num_agents = 4
+        prepared = []
+        for _ in range(2):
+            env = create_env(num_agents, async_reset=True)
+            for i, e in enumerate(env.envs):
+                e._seed(i)
+            env.reset()
+            # draws from np.random on the main thread do not change the prepared episode
+            np.random.uniform(size=np.random.randint(1, 100))
+            initial_states, _ = env.next_episode.result()
+            prepared.append((initial_states, np.array(env.next_scenario.goals)))
+            env.close()
+
+        (states_1, goals_1), (states_2, goals_2) = prepared
+        self.assertTrue(np.array_equal(goals_1, goals_2))
+        for state_1, state_2 in zip(states_1, states_2):
+            self.assertTrue(np.array_equal(state_1, state_2))
+
+    def test_async_reset_dynamics(self):
+        num_agents = 4
+        env = create_env(num_agents, episode_duration=1, async_reset=True, dyn_randomize_every=2)
+        env.reset()
+        for episode in range(4):
+            _, dynamics_params = env.next_episode.result()
+            for _ in range(env.envs[0].ep_len + 1):
+                obs, rewards, dones, infos = env.step([env.action_space.sample() for _ in range(num_agents)])
+                if all(dones):
+                    break
+
+            # the dynamics are randomized every other episode, with the params sampled by the background thread
+            due = episode % 2 == 0
+            for e, params in zip(env.envs, dynamics_params):
+                self.assertEqual(params is not None, due)
+                if due:
+                    self.assertIs(e.dynamics_params, params)
+        env.close()
+
+    def test_state_snapshot(self):
+        num_agents = 8
+        env = create_env(num_agents)
+        env.reset()
+        for _ in range(20):
+            env.step([env.action_space.sample() for _ in range(num_agents)])
+
+        state, episode_state = env.get_state()
+        self.assertEqual(state.shape, (env.state_size(),))
+        env_copy = copy.deepcopy(env)
+        for _ in range(30):
+            env.step([env.action_space.sample() for _ in range(num_agents)])
+
+        env.set_state(state, episode_state)
+        self.assertTrue(np.array_equal(env.get_state()[0], state))
+        self.assertEqual(env.envs[0].tick, env_copy.envs[0].tick)
+        for key in ['pos', 'vel', 'rot', 'omega', 'goal', 'actions', 'crashed']:
+            self.assertTrue(np.array_equal(getattr(env.swarm_state, key), getattr(env_copy.swarm_state, key)), key)
+        self.assertTrue(np.array_equal(env.scenario.goals, env_copy.scenario.goals))
+        # the spawn draws of the next reset continue from the snapshot
+        self.assertEqual(env.envs[0].np_random.uniform(), env_copy.envs[0].np_random.uniform())
+        env.set_state(state, episode_state)
+
+        # the crash flags come from the swarm state
+        env.swarm_state.crashed[:] = np.arange(num_agents) % 2 == 0
+        self.assertTrue(np.array_equal(env.state_views(env.get_state()[0])['crashed'], env.swarm_state.crashed))
+        env.set_state(state, episode_state)
+
+        # restoring does not tie the env to the snapshot
+        env.step([env.action_space.sample() for _ in range(num_agents)])
+        env.set_state(state, episode_state)
+        self.assertTrue(np.array_equal(env.get_state()[0], state))
+        env.close()
+
+    def test_stagger_resets(self):
+        num_agents = 4
+        env = create_env(num_agents, stagger_resets=True)
+        env.reset()
+        ep_len, first_len = env.scenario.episode_len(), env.envs[0].ep_len
+        self.assertTrue(1 <= first_len <= ep_len)
+        self.assertTrue(all(e.ep_len == first_len for e in env.envs))
+
+        for tick in range(first_len + 1):
+            obs, rewards, dones, infos = env.step([env.action_space.sample() for _ in range(num_agents)])
+            self.assertEqual(all(dones), tick == first_len)
+        # the following episodes have the full length
+        self.assertTrue(all(e.ep_len == ep_len for e in env.envs))
+        env.close()
+
+
+class TestRunningStats(TestCase):
+    def test_matches_history(self):
+        history = np.random.normal(size=(50, 8, 4))
+        stats = RunningStats(4)
+        for values in history:
+            stats.update(values)
+
+        history = history.reshape(-1, 4)
+        self.assertEqual(stats.count, len(history))
+        self.assertTrue(np.allclose(stats.mean(), history.mean(axis=0)))
+        self.assertTrue(np.allclose(stats.std(), history.std(axis=0)))
+        self.assertTrue(np.array_equal(stats.min, history.min(axis=0)))
+        self.assertTrue(np.array_equal(stats.max, history.max(axis=0)))
+
+        stats.reset()
+        self.assertEqual(stats.count, 0)
+        self.assertTrue(np.all(stats.sum == 0.0))
+
+        # per-drone stats, one sample of (num_agents, num_terms) per tick
+        history = np.random.normal(size=(50, 8, 3))
+        stats = RunningStats((8, 3))
+        for values in history:
+            stats.update(values)
+        self.assertEqual(stats.count, len(history))
+        self.assertTrue(np.allclose(stats.sum, history.sum(axis=0)))
+        self.assertTrue(np.array_equal(stats.max, history.max(axis=0)))
+
+
+class TestRngState(TestCase):
+    def test_round_trip(self):
+        # the Generator of gym 0.26 seeding, the RandomState of older versions
+        for rng in [np.random.default_rng(0), np.random.RandomState(0)]:
+            rng.normal()
+            state = get_rng_state(rng, np.empty(rng_state_size(rng)))
+            expected = rng.uniform(size=5)
+            rng.uniform(size=3)
+            set_rng_state(rng, state)
+            self.assertTrue(np.array_equal(rng.uniform(size=5), expected))
+
 
 class TestReplayBuffer(TestCase):
     def test_replay(self):
@@ -118,3 +459,36 @@ class TestReplayBuffer(TestCase):
             # this env self-resets
 
         env.close()
+
+    def test_snapshot_buffer(self):
+        num_agents = 8
+        env = create_env(num_agents)
+        env.reset()
+        checkpoints = SnapshotArray(3)
+        replay_buffer = ReplayBuffer(env.envs[0].control_freq, buffer_size=4)
+        for k in range(10):
+            obs, _, _, _ = env.step([env.action_space.sample() for _ in range(num_agents)])
+            checkpoints.save(k % 3, env, obs)
+            replay_buffer.write_cp_to_buffer(checkpoints, k % 3)
+            if k == 0:
+                states = replay_buffer.events.states
+        # the slots are allocated once
+        self.assertIs(replay_buffer.events.states, states)
+        self.assertEqual(states.shape, (4, env.state_size()))
+        self.assertEqual(len(replay_buffer), 4)
+        self.assertGreaterEqual(replay_buffer.nbytes(), states.nbytes + replay_buffer.events.obs.nbytes)
+
+        # full after 4 events, the following ones overwrite slots 0, 1, 2, 3, 0, 1
+        self.assertTrue(np.array_equal(replay_buffer.events.states[1], checkpoints.states[9 % 3]))
+
+        replay_buffer.num_replayed[1] = 10
+        replay_buffer.cleanup()
+        self.assertEqual(len(replay_buffer), 3)
+        self.assertIsNone(replay_buffer.events.episode_states[3])
+
+        idx = replay_buffer.sample_event()
+        self.assertEqual(replay_buffer.num_replayed[idx], 1)
+        obs = replay_buffer.events.restore(idx, env)
+        self.assertTrue(np.array_equal(obs, replay_buffer.events.obs[idx]))
+        self.assertTrue(np.array_equal(env.get_state()[0], replay_buffer.events.states[idx]))
+        env.close()
@@ -0,0 +1,95 @@
+import copy
+from unittest import TestCase
+
+import numpy as np
+
+from gym_art.quadrotor_multi.quadrotor_multi_obstacles import MultiObstacles
+
+
+class TestMultiObstacles(TestCase):
+    def create_obstacles(self, num_obstacles=6, traj='mix', obs_mode='relative'):
+        multi_obstacles = MultiObstacles(mode='dynamic', num_obstacles=num_obstacles, shape='random', traj=traj,
+                                         obs_mode=obs_mode)
+        set_obstacles = np.arange(num_obstacles) % 3 != 0
+        quads_pos = np.random.uniform(-2, 2, size=(8, 3))
+        quads_vel = np.random.uniform(-1, 1, size=(8, 3))
+        obs = multi_obstacles.reset(obs=np.zeros((8, 0)), quads_pos=quads_pos, quads_vel=quads_vel,
+                                    set_obstacles=set_obstacles)
+        return multi_obstacles, set_obstacles, quads_pos, quads_vel, obs
+
+    def test_matches_single_obstacles(self):
+        for obs_mode in ['relative', 'absolute', 'half_relative']:
+            multi_obstacles, set_obstacles, quads_pos, quads_vel, obs = self.create_obstacles(obs_mode=obs_mode)
+            single_obs = [o.update_obs(quads_pos, quads_vel, set_obstacles[i])
+                          for i, o in enumerate(multi_obstacles.obstacles)]
+            self.assertTrue(np.allclose(obs, np.concatenate(single_obs, axis=1)), obs_mode)
+
+        multi_obstacles, set_obstacles, quads_pos, quads_vel, _ = self.create_obstacles(traj='gravity')
+        singles = copy.deepcopy(multi_obstacles.obstacles)
+        multi_obstacles.step(obs=np.zeros((8, 0)), quads_pos=quads_pos, quads_vel=quads_vel,
+                             set_obstacles=set_obstacles)
+        for i, single in enumerate(singles):
+            single.step(quads_pos=quads_pos, quads_vel=quads_vel, set_obstacle=set_obstacles[i])
+            self.assertTrue(np.allclose(single.pos, multi_obstacles.pos[i]))
+            self.assertTrue(np.allclose(single.vel, multi_obstacles.vel[i]))
+
+        # drones placed close to the obstacles
+        pos_quads = np.repeat(multi_obstacles.pos, 3, axis=0) + np.random.uniform(-0.3, 0.3, size=(18, 3))
+        multi_obstacles.proximity_radius = 0.2
+        _, all_collisions, proximity_pairs, proximity_distances = multi_obstacles.collision_detection(
+            pos_quads=pos_quads, set_obstacles=set_obstacles)
+        collision_matrix = np.zeros((len(pos_quads), len(multi_obstacles.obstacles)))
+        collision_matrix[all_collisions[:, 0], all_collisions[:, 1]] = 1.0
+        for i, obstacle in enumerate(multi_obstacles.obstacles):
+            expected = obstacle.collision_detection(pos_quads) * set_obstacles[i]
+            self.assertTrue(np.array_equal(collision_matrix[:, i], expected))
+        self.assertEqual(len(all_collisions), collision_matrix.sum())
+
+        # every pair closer than the proximity radius to the obstacle surface, with its center distance
+        distances = np.linalg.norm(pos_quads[:, None] - multi_obstacles.pos[None], axis=2)
+        expected_pairs = np.argwhere(distances < 0.2 + multi_obstacles.size / 2)
+        self.assertTrue(np.array_equal(proximity_pairs, expected_pairs))
+        self.assertTrue(np.allclose(proximity_distances, distances[expected_pairs[:, 0], expected_pairs[:, 1]]))
+
+    def test_views_survive_copy(self):
+        multi_obstacles, *_ = self.create_obstacles()
+        multi_obstacles = copy.deepcopy(multi_obstacles)
+        multi_obstacles.pos += 1.0
+        for i, obstacle in enumerate(multi_obstacles.obstacles):
+            self.assertTrue(np.array_equal(obstacle.pos, multi_obstacles.pos[i]))
+
+    def test_grid(self):
+        num_obstacles = 8
+        multi_obstacles = MultiObstacles(mode='static', num_obstacles=num_obstacles, shape='random', use_grid=True,
+                                         proximity_radius=0.46)
+        set_obstacles = np.ones(num_obstacles, dtype=bool)
+        for _ in range(5):
+            multi_obstacles.reset(obs=np.zeros((1, 0)), quads_pos=np.zeros((1, 3)), quads_vel=np.zeros((1, 3)),
+                                  set_obstacles=set_obstacles)
+
+            # close to the obstacles and anywhere in the room
+            pos_quads = np.concatenate((
+                np.repeat(multi_obstacles.pos, 10, axis=0) + np.random.uniform(-0.6, 0.6, size=(80, 3)),
+                np.random.uniform((-5., -5., 0.), (5., 5., 10.), size=(80, 3)),
+            ))
+            result = multi_obstacles.collision_detection(pos_quads, set_obstacles)
+            grid, multi_obstacles.grid = multi_obstacles.grid, None
+            expected = multi_obstacles.collision_detection(pos_quads, set_obstacles)
+            multi_obstacles.grid = grid
+
+            # same collisions and proximity pairs as testing all obstacles
+            self.assertGreater(len(expected[1]), 0)
+            for value, expected_value in zip(result, expected):
+                self.assertTrue(np.array_equal(value, expected_value))
+
+    def test_shape_list_draws(self):
+        multi_obstacles = MultiObstacles(mode='static', num_obstacles=6, shape='random')
+        # np.random keeps the draws of randint, a Generator draws the same range
+        np.random.seed(0)
+        shape_list = multi_obstacles.get_shape_list()
+        np.random.seed(0)
+        expected = np.array(multi_obstacles.shape_list)[np.random.randint(low=0, high=len(multi_obstacles.shape_list), size=6)]
+        self.assertTrue(np.array_equal(shape_list, expected))
+
+        shape_list = multi_obstacles.get_shape_list(np.random.default_rng(0))
+        self.assertTrue(set(shape_list) <= set(multi_obstacles.shape_list))
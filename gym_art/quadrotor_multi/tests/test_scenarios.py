@@ -0,0 +1,118 @@
+from unittest import TestCase
+
+import numpy as np
+
+from gym_art.quadrotor_multi.quad_scenarios import create_scenario, SCENARIOS
+from gym_art.quadrotor_multi.quad_scenarios_utils import formation_template, bezier_curve, QUADS_MODE_LIST
+from gym_art.quadrotor_multi.tests.test_multi_env import create_env
+
+
+class TestGoalTrajectory(TestCase):
+    def run_scenario(self, env, quads_mode, precompute_goals, seed):
+        np.random.seed(seed)
+        scenario = create_scenario(quads_mode=quads_mode, envs=env.envs, num_agents=env.num_agents,
+                                   room_dims=env.room_dims, room_dims_callback=env.set_room_dims,
+                                   rew_coeff=env.rew_coeff, quads_formation='circle_horizontal',
+                                   quads_formation_size=2.0, precompute_goals=precompute_goals)
+        scenario.reset()
+        scenario.reset_ep_len()
+        scenario.reset_goal_trajectory()
+        for i, e in enumerate(env.envs):
+            e.goal = scenario.goals[i]
+        self.assertEqual(scenario.goal_trajectory is not None, precompute_goals)
+
+        goals = [np.array(scenario.goals)]
+        for tick in range(1, env.envs[0].ep_len + 2):
+            for e in env.envs:
+                e.tick = tick
+            scenario.step(infos=None, rewards=None, pos=None)
+            goals.append(np.array([e.goal for e in env.envs]))
+        return np.array(goals), scenario
+
+    def test_matches_live_goals(self):
+        num_agents = 8
+        env = create_env(num_agents)
+        for quads_mode in ['ep_lissajous3D', 'ep_rand_bezier', 'swap_goals', 'dynamic_formations']:
+            live_goals, live = self.run_scenario(env, quads_mode, precompute_goals=False, seed=7)
+            baked_goals, baked = self.run_scenario(env, quads_mode, precompute_goals=True, seed=7)
+            self.assertEqual(baked.goal_trajectory.shape, (env.envs[0].ep_len + 2, num_agents, 3))
+            self.assertTrue(np.allclose(live_goals, baked_goals), quads_mode)
+            self.assertAlmostEqual(live.formation_size, baked.formation_size)
+        env.close()
+
+
+class TestScenarioMix(TestCase):
+    def test_reuse(self):
+        self.assertTrue(set(QUADS_MODE_LIST + ['mix', 'tunnel', 'run_away']) <= set(SCENARIOS))
+        env = create_env(8)
+        with self.assertRaises(NotImplementedError):
+            create_scenario(quads_mode='unknown', envs=env.envs, num_agents=8, room_dims=env.room_dims,
+                            room_dims_callback=env.set_room_dims, rew_coeff=env.rew_coeff,
+                            quads_formation='circle_horizontal', quads_formation_size=2.0)
+
+        mix = create_scenario(quads_mode='mix', envs=env.envs, num_agents=8, room_dims=env.room_dims,
+                              room_dims_callback=env.set_room_dims, rew_coeff=env.rew_coeff,
+                              quads_formation='circle_horizontal', quads_formation_size=2.0)
+        scenarios = dict()
+        for _ in range(50):
+            mix.reset()
+            scenario = scenarios.setdefault(mix.scenario.quads_mode, mix.scenario)
+            self.assertIs(mix.scenario, scenario)
+            self.assertIs(mix.scenario, mix.scenario_pool[mix.scenario.quads_mode])
+            if mix.scenario.quads_mode == 'circular_config':
+                self.assertTrue(np.all(mix.scenario.settle_count == 0))
+                mix.scenario.settle_count += 1
+        env.close()
+
+    def test_state(self):
+        env = create_env(8)
+        kwargs = dict(quads_mode='mix', envs=env.envs, num_agents=8, room_dims=env.room_dims,
+                      room_dims_callback=env.set_room_dims, rew_coeff=env.rew_coeff,
+                      quads_formation='circle_horizontal', quads_formation_size=2.0)
+        mix, other = create_scenario(**kwargs), create_scenario(**kwargs)
+        mix.reset()
+        other.reset()
+        state = mix.get_state()
+        goals = np.array(mix.scenario.goals)
+        mix.reset()
+
+        # restored into the pooled scenario of the other instance
+        other.set_state(state, goals)
+        self.assertEqual(other.scenario.quads_mode, state['scenario'][0])
+        self.assertIs(other.scenario, other.scenario_pool[other.scenario.quads_mode])
+        self.assertTrue(np.array_equal(other.scenario.goals, goals))
+        self.assertIs(other.goals, other.scenario.goals)
+        self.assertTrue(np.all(other.scenario.settle_count == 0))
+        other.scenario.settle_count += 1
+        self.assertTrue(np.all(state['scenario'][1]['settle_count'] == 0))
+        env.close()
+
+
+class TestScenarioUtils(TestCase):
+    def test_template(self):
+        size_dir, layer_dir = formation_template('circle_vertical_xz', 10, 8)
+        self.assertIs(formation_template('circle_vertical_xz', 10, 8)[0], size_dir)
+        self.assertFalse(size_dir.flags.writeable)
+
+        # two layers, 8 drones on a unit circle in the xz plane and 2 above them
+        degree = np.concatenate([2 * np.pi * np.arange(8) / 8, [0.0, np.pi]])
+        self.assertTrue(np.allclose(size_dir, np.stack([np.cos(degree), np.zeros(10), np.sin(degree)], axis=1)))
+        self.assertEqual(layer_dir[:, 1].tolist(), [0.0] * 8 + [1.0] * 2)
+
+        for formation in ['grid_horizontal', 'cube']:
+            size_dir, _ = formation_template(formation, 27, 50)
+            self.assertTrue(np.allclose(size_dir.mean(axis=0), 0.0))
+            # neighbors one unit apart
+            dist = np.linalg.norm(size_dir[:, None] - size_dir[None], axis=2)
+            self.assertAlmostEqual(np.min(dist + np.eye(27) * 10), 1.0)
+
+    def test_bezier_curve(self):
+        nodes = np.random.uniform(-1, 1, size=(3, 3))
+        t = np.linspace(0, 1, 50)
+        # de Casteljau for the quadratic curve
+        a, b = nodes[:, :1] * (1 - t) + nodes[:, 1:2] * t, nodes[:, 1:2] * (1 - t) + nodes[:, 2:] * t
+        self.assertTrue(np.allclose(bezier_curve(nodes, 50), a * (1 - t) + b * t))
+
+        nodes = np.random.uniform(-1, 1, size=(3, 6))
+        curve = bezier_curve(nodes, 7)
+        self.assertTrue(np.allclose(curve[:, 0], nodes[:, 0]) and np.allclose(curve[:, -1], nodes[:, -1]))
@@ -67,7 +67,7 @@ setup(
     # For an analysis of "install_requires" vs pip's requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=[
-        'pytest', 'numpy>1.15', 'matplotlib>3', 'gym>=0.17', 'transforms3d', 'noise', 'tqdm', 'bezier<=2020.5.19', 'numba', 'scipy',
+        'pytest', 'numpy>1.15', 'matplotlib>3', 'gym>=0.17', 'transforms3d', 'noise', 'tqdm', 'numba', 'scipy',
         'sample-factory>=1.121.0', 'pyglet<=1.5.23',
     ],
 )
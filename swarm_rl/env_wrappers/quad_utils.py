@@ -95,7 +95,12 @@ def make_quadrotor_env_multi(cfg, render_mode=None, **kwargs):
         local_metric=cfg.quads_local_metric,
         local_coeff=cfg.quads_local_coeff,  # how much velocity matters in "distance" calculation
         use_replay_buffer=use_replay_buffer, obstacle_obs_mode=cfg.quads_obstacle_obs_mode,
-        obst_penalty_fall_off=cfg.quads_obst_penalty_fall_off,
+        obst_penalty_fall_off=cfg.quads_obst_penalty_fall_off, obs_dtype=cfg.quads_obs_dtype,
+        obstacle_obs_num=cfg.quads_obstacle_obs_num,
+        info_mode=cfg.quads_info_mode, collision_ccd=cfg.quads_collision_ccd,
+        obstacle_grid=cfg.quads_obstacle_grid, collision_log_dir=cfg.quads_collision_log_dir,
+        precompute_goals=cfg.quads_precompute_goals, async_reset=cfg.quads_async_reset,
+        stagger_resets=cfg.quads_stagger_resets,
     )
 
     if use_replay_buffer:
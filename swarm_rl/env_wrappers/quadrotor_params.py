@@ -34,6 +34,8 @@ def add_quadrotors_env_args(env, parser):
     p.add_argument('--quads_collision_hitbox_radius', default=2.0, type=float, help='When the distance between two drones are less than N arm_length, we would view them as collide.')
     p.add_argument('--quads_collision_falloff_radius', default=0.0, type=float, help='The falloff radius for the smooth penalty. 0: radius is 0 arm_length, which means we would not add extra penalty except drones collide')
     p.add_argument('--quads_collision_smooth_max_penalty', default=10.0, type=float, help='The upper bound of the collision function given distance among drones')
+    p.add_argument('--quads_collision_ccd', default=False, type=str2bool, help='Check drone-drone and drone-obstacle collisions along the path travelled during each control step (swept spheres) instead of the positions at its end only. Keeps fast drones from passing through each other, e.g. with a lower sim_freq')
+    p.add_argument('--quads_collision_log_dir', default=None, type=str, help='If set, every env appends its drone-drone, drone-obstacle and drone-floor collision events to a binary file in this directory. Load them with gym_art.quadrotor_multi.quad_collision_log.read_collision_log')
 
     p.add_argument('--neighbor_obs_type', default='none', type=str, choices=['none', 'pos_vel', 'pos_vel_goals', 'pos_vel_goals_ndist_gdist'], help='Choose what kind of obs to send to encoder.')
     p.add_argument('--quads_use_numba', default=False, type=str2bool, help='Whether to use numba for jit or not')
@@ -41,6 +43,8 @@ def add_quadrotors_env_args(env, parser):
     p.add_argument('--quads_obstacle_num', default=0, type=int, help='Choose the number of obstacle(s)')
     p.add_argument('--quads_obstacle_type', default='sphere', type=str, choices=['sphere', 'cube', 'random'], help='Choose the type of obstacle(s)')
     p.add_argument('--quads_obstacle_size', default=0.0, type=float, help='Choose the size of obstacle(s)')
+    p.add_argument('--quads_obstacle_obs_num', default=-1, type=int, help='Number of nearest obstacles each drone observes, padded and masked if fewer are present. -1=all obstacles')
+    p.add_argument('--quads_obstacle_grid', default=False, type=str2bool, help='Static obstacles only. Bake every obstacle layout into a grid whose cells list the obstacles within reach, so that collisions and proximity penalties only test the obstacles near each drone. Same results as testing all obstacles')
     p.add_argument('--quads_obstacle_traj', default='gravity', type=str, choices=['gravity', 'electron', 'mix'],  help='Choose the type of force to use')
     p.add_argument('--quads_local_obs', default=-1, type=int, help='Number of neighbors to consider. -1=all neighbors. 0=blind agents, 0<n<num_agents-1 = nonzero number of agents')
     p.add_argument('--quads_local_coeff', default=0.0, type=float, help='This parameter is used for the metric of select which drones are the N closest drones.')
@@ -50,10 +54,15 @@ def add_quadrotors_env_args(env, parser):
     p.add_argument('--quads_adaptive_env', default=False, type=str2bool, help='Iteratively shrink the environment into a tunnel to increase obstacle density based on statistics')
 
     p.add_argument('--quads_mode', default='static_same_goal', type=str, choices=['static_same_goal', 'static_diff_goal', 'dynamic_same_goal', 'dynamic_diff_goal', 'circular_config', 'ep_lissajous3D', 'ep_rand_bezier', 'swarm_vs_swarm', 'swap_goals', 'dynamic_formations', 'mix', 'tunnel'], help='Choose which scenario to run. Ep = evader pursuit')
+    p.add_argument('--quads_precompute_goals', default=False, type=str2bool, help='Scenarios with moving goals (ep_lissajous3D, ep_rand_bezier, swap_goals, dynamic_formations) compute the goals of the whole episode at reset instead of every step')
+    p.add_argument('--quads_async_reset', default=False, type=str2bool, help='Prepare the goals, spawn states, dynamics and obstacle layout of the next episode in a background thread while the current one runs')
+    p.add_argument('--quads_stagger_resets', default=False, type=str2bool, help='End the first episode of each env at a random tick, so that the envs of a worker do not all reset on the same tick')
     p.add_argument('--quads_formation', default='circle_horizontal', type=str, choices=['circle_xz_vertical', 'circle_yz_vertical', 'circle_horizontal', 'sphere', 'grid_xz_vertical', 'grid_yz_vertical', 'grid_horizontal'], help='Choose the swarm formation at the goal')
     p.add_argument('--quads_formation_size', default=-1.0, type=float, help='The size of the formation, interpreted differently depending on the formation type. Default (-1) means it is determined by the mode')
     p.add_argument('--room_dims', nargs='+', default=[10, 10, 10], type=float, help='Length, width, and height dimensions respectively of the quadrotor env')
     p.add_argument('--quads_obs_repr', default='xyz_vxyz_R_omega', type=str, help='obs space for drone itself')
+    p.add_argument('--quads_obs_dtype', default='float32', type=str, choices=['float32', 'float16'], help='Dtype of the observations sent to the learner. float16 halves the memory traffic per sample, the model decodes it back to float32')
+    p.add_argument('--quads_info_mode', default='dict', type=str, choices=['dict', 'array'], help='dict: every info carries a dict of reward terms. array: infos carry one structured array with the reward terms and collision flags of all drones, which is accumulated without per-key Python work')
     p.add_argument('--replay_buffer_sample_prob', default=0.0, type=float, help='Probability at which we sample from it rather than resetting the env. Set to 0.0 (default) to disable the replay. Set to value in (0.0, 1.0] to use replay buffer')
 
     p.add_argument('--anneal_collision_steps', default=0.0, type=float, help='Anneal collision penalties over this many steps. Default (0.0) is no annealing')
@@ -2,9 +2,12 @@ import copy
 
 import gym
 import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
 
 from sample_factory.envs.env_utils import RewardShapingInterface, TrainingInfoInterface
 
+from gym_art.quadrotor_multi.quad_utils import RunningStats
+
 
 DEFAULT_QUAD_REWARD_SHAPING_SINGLE = dict(
     quad_rewards=dict(
@@ -26,6 +29,10 @@ class QuadsRewardShapingWrapper(gym.Wrapper, TrainingInfoInterface):
 
         self.reward_shaping_scheme = reward_shaping_scheme
         self.cumulative_rewards = None
+        # with info_mode='array' the reward terms are accumulated as running stats of (num_agents, num_terms)
+        self.episode_rewards = None
+        self.rew_array_names = None
+        # running stats of the actions of all agents in the episode, per action dimension
         self.episode_actions = None
 
         self.num_agents = env.num_agents if hasattr(env, 'num_agents') else 1
@@ -47,11 +54,16 @@ class QuadsRewardShapingWrapper(gym.Wrapper, TrainingInfoInterface):
     def reset(self):
         obs = self.env.reset()
         self.cumulative_rewards = [dict() for _ in range(self.num_agents)]
-        self.episode_actions = []
+        if self.episode_rewards is not None:
+            self.episode_rewards.reset()
+        if self.episode_actions is not None:
+            self.episode_actions.reset()
         return obs
 
     def step(self, action):
-        self.episode_actions.append(action)
+        if self.episode_actions is None:
+            self.episode_actions = RunningStats(np.shape(action)[-1])
+        self.episode_actions.update(action)
 
         if self.reward_shaping_updated:
             # set the updated reward shaping scheme
@@ -67,16 +79,25 @@ class QuadsRewardShapingWrapper(gym.Wrapper, TrainingInfoInterface):
         else:
             infos_multi, dones_multi = [infos], [dones]
 
-        for i, info in enumerate(infos_multi):
-            rew_dict = info['rewards']
+        rew_array = infos_multi[0].get('rewards_array')
+        if rew_array is not None:
+            if self.episode_rewards is None:
+                self.rew_array_names = [key for key in rew_array.dtype.names if key.startswith('rew')]
+                self.episode_rewards = RunningStats((len(rew_array), len(self.rew_array_names)))
+            self.episode_rewards.update(structured_to_unstructured(rew_array[self.rew_array_names]))
 
-            for key, value in rew_dict.items():
-                if key.startswith('rew'):
-                    if key not in self.cumulative_rewards[i]:
-                        self.cumulative_rewards[i][key] = 0
-                    self.cumulative_rewards[i][key] += value
+        for i, info in enumerate(infos_multi):
+            if rew_array is None:
+                for key, value in info['rewards'].items():
+                    if key.startswith('rew'):
+                        if key not in self.cumulative_rewards[i]:
+                            self.cumulative_rewards[i][key] = 0
+                        self.cumulative_rewards[i][key] += value
 
             if dones_multi[i]:
+                if rew_array is not None:
+                    self.cumulative_rewards[i] = dict(zip(self.rew_array_names, self.episode_rewards.sum[i]))
+
                 true_reward = self.cumulative_rewards[i]['rewraw_main']
                 true_reward_consider_collisions = True
                 if true_reward_consider_collisions:
@@ -97,13 +118,13 @@ class QuadsRewardShapingWrapper(gym.Wrapper, TrainingInfoInterface):
                     for rew_key in ['rew_pos', 'rewraw_pos', 'rew_crash', 'rewraw_crash']:
                         extra_stats[f'{rew_key}_{scenario_name}'] = self.cumulative_rewards[i][rew_key]
 
-                episode_actions = np.array(self.episode_actions)
-                episode_actions = episode_actions.transpose()
-                for action_idx in range(episode_actions.shape[0]):
-                    mean_action = np.mean(episode_actions[action_idx])
-                    std_action = np.std(episode_actions[action_idx])
-                    extra_stats[f'z_action{action_idx}_mean'] = mean_action
-                    extra_stats[f'z_action{action_idx}_std'] = std_action
+                actions = self.episode_actions
+                mean_actions, std_actions = actions.mean(), actions.std()
+                for action_idx in range(actions.dim):
+                    extra_stats[f'z_action{action_idx}_mean'] = mean_actions[action_idx]
+                    extra_stats[f'z_action{action_idx}_std'] = std_actions[action_idx]
+                    extra_stats[f'z_action{action_idx}_min'] = actions.min[action_idx]
+                    extra_stats[f'z_action{action_idx}_max'] = actions.max[action_idx]
 
                 self.cumulative_rewards[i] = dict()
 
@@ -118,6 +139,8 @@ class QuadsRewardShapingWrapper(gym.Wrapper, TrainingInfoInterface):
                         extra_stats[f'z_anneal_{coeff_name}'] = env_reward_shaping[coeff_name]
 
         if any(dones_multi):
-            self.episode_actions = []
+            self.episode_actions.reset()
+            if self.episode_rewards is not None:
+                self.episode_rewards.reset()
 
         return obs, rewards, dones, infos
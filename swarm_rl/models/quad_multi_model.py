@@ -6,6 +6,9 @@ from sample_factory.algo.utils.torch_utils import calc_num_elements
 from sample_factory.model.encoder import Encoder
 from sample_factory.model.model_utils import fc_layer, nonlinearity
 
+from gym_art.quadrotor_multi.quad_obs_layout import get_self_obs_dim, get_neighbor_obs_dim, make_obs_layout, \
+    obs_component_view
+
 
 class QuadNeighborhoodEncoder(nn.Module):
     def __init__(self, cfg, self_obs_dim, neighbor_obs_dim, neighbor_hidden_size, num_use_neighbor_obs):
@@ -28,11 +31,9 @@ class QuadNeighborhoodEncoderDeepsets(QuadNeighborhoodEncoder):
             nonlinearity(cfg)
         )
 
-    def forward(self, self_obs, obs, all_neighbor_obs_size, batch_size):
-        obs_neighbors = obs[:, self.self_obs_dim:self.self_obs_dim + all_neighbor_obs_size]
-        obs_neighbors = obs_neighbors.reshape(-1, self.neighbor_obs_dim)
+    def forward(self, self_obs, obs_neighbors, batch_size):
+        # obs_neighbors: [batch_size, num_use_neighbor_obs, neighbor_obs_dim]
         neighbor_embeds = self.embedding_mlp(obs_neighbors)
-        neighbor_embeds = neighbor_embeds.reshape(batch_size, -1, self.neighbor_hidden_size)
         mean_embed = torch.mean(neighbor_embeds, dim=1)
         return mean_embed
 
@@ -68,29 +69,25 @@ class QuadNeighborhoodEncoderAttention(QuadNeighborhoodEncoder):
             fc_layer(neighbor_hidden_size, 1),
         )
 
-    def forward(self, self_obs, obs, all_neighbor_obs_size, batch_size):
-        obs_neighbors = obs[:, self.self_obs_dim:self.self_obs_dim + all_neighbor_obs_size]
-        obs_neighbors = obs_neighbors.reshape(-1, self.neighbor_obs_dim)
+    def forward(self, self_obs, obs_neighbors, batch_size):
+        # obs_neighbors: [batch_size, num_use_neighbor_obs, neighbor_obs_dim]
+        num_neighbors = obs_neighbors.shape[1]
 
         # concatenate self observation with neighbor observation
-
-        self_obs_repeat = self_obs.repeat(self.num_use_neighbor_obs, 1)
-        mlp_input = torch.cat((self_obs_repeat, obs_neighbors), dim=1)
+        self_obs_repeat = self_obs.unsqueeze(1).expand(-1, num_neighbors, -1)
+        mlp_input = torch.cat((self_obs_repeat, obs_neighbors), dim=2)
         neighbor_embeddings = self.embedding_mlp(mlp_input)  # e_i in the paper https://arxiv.org/pdf/1809.08835.pdf
 
         neighbor_values = self.neighbor_value_mlp(neighbor_embeddings)  # h_i in the paper
 
-        neighbor_embeddings_mean_input = neighbor_embeddings.reshape(batch_size, -1, self.neighbor_hidden_size)
-        neighbor_embeddings_mean = torch.mean(neighbor_embeddings_mean_input, dim=1)  # e_m in the paper
-        neighbor_embeddings_mean_repeat = neighbor_embeddings_mean.repeat(self.num_use_neighbor_obs, 1)
+        neighbor_embeddings_mean = torch.mean(neighbor_embeddings, dim=1, keepdim=True)  # e_m in the paper
+        neighbor_embeddings_mean_repeat = neighbor_embeddings_mean.expand(-1, num_neighbors, -1)
 
-        attention_mlp_input = torch.cat((neighbor_embeddings, neighbor_embeddings_mean_repeat), dim=1)
-        attention_weights = self.attention_mlp(attention_mlp_input).view(batch_size, -1)  # alpha_i in the paper
+        attention_mlp_input = torch.cat((neighbor_embeddings, neighbor_embeddings_mean_repeat), dim=2)
+        attention_weights = self.attention_mlp(attention_mlp_input)  # alpha_i in the paper
         attention_weights_softmax = torch.nn.functional.softmax(attention_weights, dim=1)
-        attention_weights_softmax = attention_weights_softmax.view(-1, 1)
 
         final_neighborhood_embedding = attention_weights_softmax * neighbor_values
-        final_neighborhood_embedding = final_neighborhood_embedding.view(batch_size, -1, self.neighbor_hidden_size)
         final_neighborhood_embedding = torch.sum(final_neighborhood_embedding, dim=1)
 
         return final_neighborhood_embedding
@@ -111,8 +108,8 @@ class QuadNeighborhoodEncoderMlp(QuadNeighborhoodEncoder):
             nonlinearity(cfg),
         )
 
-    def forward(self, self_obs, obs, all_neighbor_obs_size, batch_size):
-        obs_neighbors = obs[:, self.self_obs_dim:self.self_obs_dim + all_neighbor_obs_size]
+    def forward(self, self_obs, obs_neighbors, batch_size):
+        obs_neighbors = obs_neighbors.reshape(batch_size, -1)
         final_neighborhood_embedding = self.neighbor_mlp(obs_neighbors)
         return final_neighborhood_embedding
 
@@ -122,12 +119,7 @@ class QuadMultiEncoder(Encoder):
     def __init__(self, cfg, obs_space):
         super().__init__(cfg)
         # internal params -- cannot change from cmd line
-        if cfg.quads_obs_repr == 'xyz_vxyz_R_omega':
-            self.self_obs_dim = 18
-        elif cfg.quads_obs_repr == 'xyz_vxyz_R_omega_wall':
-            self.self_obs_dim = 24
-        else:
-            raise NotImplementedError(f'Layer {cfg.quads_obs_repr} not supported!')
+        self.self_obs_dim = get_self_obs_dim(cfg.quads_obs_repr)
 
         self.neighbor_hidden_size = cfg.quads_neighbor_hidden_size
 
@@ -139,18 +131,23 @@ class QuadMultiEncoder(Encoder):
         else:
             self.num_use_neighbor_obs = cfg.quads_local_obs
 
-        if self.neighbor_obs_type == 'pos_vel_goals':
-            self.neighbor_obs_dim = 9  # include goal pos info
-        elif self.neighbor_obs_type == 'pos_vel':
-            self.neighbor_obs_dim = 6
-        elif self.neighbor_obs_type == 'pos_vel_goals_ndist_gdist':
-            self.neighbor_obs_dim = 11
-        elif self.neighbor_obs_type == 'none':
+        self.neighbor_obs_dim = get_neighbor_obs_dim(self.neighbor_obs_type)
+        if self.neighbor_obs_type == 'none':
             # override these params so that neighbor encoder is a no-op during inference
-            self.neighbor_obs_dim = 0
             self.num_use_neighbor_obs = 0
+
+        if self.obstacle_mode == 'no_obstacles':
+            num_obstacle_obs = 0
+        elif cfg.quads_obstacle_obs_num == -1:
+            num_obstacle_obs = cfg.quads_obstacle_num
         else:
-            raise NotImplementedError(f'Unknown value {cfg.neighbor_obs_type} passed to --neighbor_obs_type')
+            num_obstacle_obs = cfg.quads_obstacle_obs_num
+        # observations are decoded to float32 in forward() before the views are taken
+        self.obs_layout = make_obs_layout(
+            obs_repr=cfg.quads_obs_repr, neighbor_obs_type=self.neighbor_obs_type,
+            num_use_neighbor_obs=self.num_use_neighbor_obs, num_obstacle_obs=num_obstacle_obs,
+            obstacle_obs_mask=cfg.quads_obstacle_obs_num > 0,
+        )
 
         # encode the neighboring drone's observations
         neighbor_encoder_out_size = 0
@@ -190,8 +187,10 @@ class QuadMultiEncoder(Encoder):
 
         # encode the obstacle observations
         obstacle_encoder_out_size = 0
-        if self.obstacle_mode != 'no_obstacles':
-            self.obstacle_obs_dim = 10  # internal param, pos_vel_size_type, 3 * 3 + 1, note: for size, we should consider it's length in xyz direction
+        self.obstacle_encoder = None
+        if 'obstacles' in self.obs_layout:
+            # pos_vel_size_type, 3 * 3 + 1, note: for size, we should consider it's length in xyz direction
+            self.obstacle_obs_dim = self.obs_layout['obstacles'].shape[-1]
             self.obstacle_hidden_size = cfg.quads_obstacle_hidden_size  # internal param
             self.obstacle_encoder = nn.Sequential(
                 fc_layer(self.obstacle_obs_dim, self.obstacle_hidden_size, spec_norm=self.use_spectral_norm),
@@ -213,23 +212,29 @@ class QuadMultiEncoder(Encoder):
 
     def forward(self, obs_dict):
         obs = obs_dict['obs']
-        obs_self = obs[:, :self.self_obs_dim]
+        if obs.dtype != torch.float32:
+            # decode half-precision observations (--quads_obs_dtype) before the first linear layer
+            obs = obs.float()
+        obs_self = obs_component_view(obs, self.obs_layout['self'])
         self_embed = self.self_encoder(obs_self)
         embeddings = self_embed
-        # embeddings = obs_self
         batch_size = obs_self.shape[0]
-        # relative xyz and vxyz for the entire minibatch (batch dimension is batch_size * num_neighbors)
-        all_neighbor_obs_size = self.neighbor_obs_dim * self.num_use_neighbor_obs
         if self.num_use_neighbor_obs > 0 and self.neighbor_encoder:
-            neighborhood_embedding = self.neighbor_encoder(obs_self, obs, all_neighbor_obs_size, batch_size)
+            # relative xyz and vxyz for the entire minibatch, [batch_size, num_neighbors, neighbor_obs_dim]
+            obs_neighbors = obs_component_view(obs, self.obs_layout['neighbors'])
+            neighborhood_embedding = self.neighbor_encoder(obs_self, obs_neighbors, batch_size)
             embeddings = torch.cat((embeddings, neighborhood_embedding), dim=1)
 
-        if self.obstacle_mode != 'no_obstacles':
-            obs_obstacles = obs[:, self.self_obs_dim + all_neighbor_obs_size:]
-            obs_obstacles = obs_obstacles.reshape(-1, self.obstacle_obs_dim)
+        if self.obstacle_encoder:
+            obs_obstacles = obs_component_view(obs, self.obs_layout['obstacles'])
             obstacle_embeds = self.obstacle_encoder(obs_obstacles)
-            obstacle_embeds = obstacle_embeds.reshape(batch_size, -1, self.obstacle_hidden_size)
-            obstacle_mean_embed = torch.mean(obstacle_embeds, dim=1)
+            if 'obstacles_mask' in self.obs_layout:
+                # only the nearest obstacles are observed, zero-padded slots are excluded from the mean
+                obstacles_mask = obs_component_view(obs, self.obs_layout['obstacles_mask']).unsqueeze(-1)
+                obstacle_mean_embed = torch.sum(obstacle_embeds * obstacles_mask, dim=1)
+                obstacle_mean_embed = obstacle_mean_embed / torch.clamp(torch.sum(obstacles_mask, dim=1), min=1.0)
+            else:
+                obstacle_mean_embed = torch.mean(obstacle_embeds, dim=1)
             embeddings = torch.cat((embeddings, obstacle_mean_embed), dim=1)
 
         out = self.feed_forward(embeddings)